@@ -0,0 +1,320 @@
+# admission.py
+# Admission control in front of the LLM routes (/quiz*, /chat_ai*).
+#
+# A request that would reach a model has to get past two checks:
+#
+#   1. Token buckets: one per user and one global, refilled continuously.
+#      A request takes a token from both or from neither, and gets them back
+#      if the concurrency check then turns it away. Buckets live in a
+#      BucketStore; the default one is a table in the app's SQLite database,
+#      so every worker process draws from the same buckets. Anything with
+#      take() and refund() methods of the same shape (e.g. Redis) can
+#      replace it.
+#   2. Concurrency: at most ADMISSION_CONCURRENCY admitted calls run at once
+#      in each process. The rest wait in a bounded queue, interactive requests
+#      ahead of prefetch work (quiz pre-generation, chat summaries); a full
+#      queue turns away prefetch waiters before interactive ones.
+#
+# Whatever does not get in is rejected at once with a Retry-After hint, so
+# one user's burst cannot tie up the request threads everyone else needs.
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from collections import Counter, deque
+
+from sqlalchemy import text
+
+import metrics
+from llm_dispatch import percentile
+
+INTERACTIVE = 0
+PREFETCH = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", PREFETCH: "prefetch"}
+
+DECISIONS = metrics.Counter(
+    "admission_decisions_total", "Admission decisions for LLM calls", ("priority", "outcome"))
+
+
+class Rejected(Exception):
+    # reason: user_rate, global_rate, queue_full, queue_timeout or displaced
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Request not admitted ({reason}), retry in {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+# =====================================================
+# Token bucket stores
+# =====================================================
+# take(buckets, cost) takes cost tokens from every bucket or from none.
+# buckets: [(key, tokens per second, burst)]. Returns None when granted,
+# otherwise (seconds to wait, key) for the bucket that is furthest off.
+# refund(buckets, cost) puts back what a granted take() took.
+class SQLiteBucketStore:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def take(self, buckets, cost=1):
+        now = time.time()
+        with self.engine.connect() as conn:
+            # The first statement writes, so the transaction holds the write
+            # lock from the start (and busy_timeout applies while waiting for it)
+            with conn.begin() as tx:
+                short = []
+                for key, rate, burst in buckets:
+                    granted = conn.execute(
+                        text("INSERT INTO rate_bucket (key, tokens, updated) VALUES (:key, :burst - :cost, :now) "
+                             "ON CONFLICT(key) DO UPDATE SET "
+                             "tokens = MIN(:burst, tokens + (:now - updated) * :rate) - :cost, updated = :now "
+                             "WHERE MIN(:burst, tokens + (:now - updated) * :rate) >= :cost"),
+                        {"key": key, "rate": rate, "burst": burst, "cost": cost, "now": now},
+                    ).rowcount
+                    if not granted:
+                        short.append((key, rate, burst))
+                if not short:
+                    return None
+                waits = []
+                for key, rate, burst in short:
+                    row = conn.execute(
+                        text("SELECT tokens, updated FROM rate_bucket WHERE key = :key"), {"key": key}
+                    ).one()
+                    available = min(burst, row.tokens + (now - row.updated) * rate)
+                    waits.append(((cost - available) / rate, key))
+                tx.rollback()  # undo the buckets that did have room
+        return max(waits)
+
+    def refund(self, buckets, cost=1):
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("UPDATE rate_bucket SET tokens = MIN(:burst, tokens + :cost) WHERE key = :key"),
+                [{"key": key, "burst": burst, "cost": cost} for key, _, burst in buckets],
+            )
+
+
+class MemoryBucketStore:
+    # Per process only; for a single worker or when there is no database
+    def __init__(self):
+        self._buckets = {}  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, buckets, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            levels, waits = {}, []
+            for key, rate, burst in buckets:
+                tokens, updated = self._buckets.get(key, (burst, now))
+                levels[key] = min(burst, tokens + (now - updated) * rate)
+                if levels[key] < cost:
+                    waits.append(((cost - levels[key]) / rate, key))
+            if waits:
+                return max(waits)
+            for key, level in levels.items():
+                self._buckets[key] = (level - cost, now)
+            return None
+
+    def refund(self, buckets, cost=1):
+        with self._lock:
+            for key, _, burst in buckets:
+                if key in self._buckets:
+                    tokens, updated = self._buckets[key]
+                    self._buckets[key] = (min(burst, tokens + cost), updated)
+
+
+# =====================================================
+# Concurrency gate
+# =====================================================
+class _Waiter:
+    __slots__ = ("event", "granted", "rejected")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+        self.rejected = None
+
+
+class PriorityGate:
+    def __init__(self, concurrency, max_queue, max_wait):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._heap = []  # (priority, seq, waiter); rejected waiters stay until popped
+        self._queued = 0
+        self._seq = itertools.count()
+        self._running = 0
+        self._hold = 1.0  # moving average of seconds a slot is held, for Retry-After
+
+    def _retry_after(self):
+        # Called with the lock held: roughly when a queue slot should free up
+        return self._hold * (self._queued + 1) / self.concurrency
+
+    def acquire(self, priority):
+        with self._lock:
+            if self._running < self.concurrency and not self._queued:
+                self._running += 1
+                return 0.0
+            if self._queued >= self.max_queue and not self._displace(priority):
+                raise Rejected("queue_full", self._retry_after())
+            waiter = _Waiter()
+            heapq.heappush(self._heap, (priority, next(self._seq), waiter))
+            self._queued += 1
+        started = time.monotonic()
+        waiter.event.wait(self.max_wait)
+        with self._lock:
+            if not waiter.granted and waiter.rejected is None:
+                waiter.rejected = Rejected("queue_timeout", self._retry_after())
+                self._queued -= 1
+        if waiter.rejected is not None:
+            raise waiter.rejected
+        return time.monotonic() - started
+
+    def _displace(self, priority):
+        # Called with the lock held: make room by turning away the newest
+        # waiter of lower priority, if there is one
+        victims = [entry for entry in self._heap if entry[0] > priority and entry[2].rejected is None]
+        if not victims:
+            return False
+        victim = max(victims, key=lambda entry: (entry[0], entry[1]))[2]
+        victim.rejected = Rejected("displaced", self._retry_after())
+        self._queued -= 1
+        victim.event.set()
+        return True
+
+    def release(self, held):
+        with self._lock:
+            self._hold = 0.8 * self._hold + 0.2 * held
+            while self._heap:
+                _, _, waiter = heapq.heappop(self._heap)
+                if waiter.rejected is None:
+                    # Hand the slot straight to the next waiter
+                    waiter.granted = True
+                    self._queued -= 1
+                    waiter.event.set()
+                    return
+            self._running -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "running": self._running,
+                "queued": self._queued,
+                "max_queue": self.max_queue,
+                "hold_ms_avg": round(self._hold * 1000, 1),
+            }
+
+
+# =====================================================
+# Admission controller
+# =====================================================
+class Ticket:
+    # An admitted call; release() (or leaving the with block) frees its slot.
+    # Safe to release more than once, e.g. from a streamed response's close.
+    def __init__(self, gate):
+        self._gate = gate
+        self._started = time.monotonic()
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._gate.release(time.monotonic() - self._started)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class AdmissionController:
+    def __init__(self, store, user_per_minute=None, user_burst=None, global_per_minute=None,
+                 global_burst=None, concurrency=None, max_queue=None, max_wait=None):
+        self.store = store
+        self.user_rate = float(user_per_minute or os.getenv("ADMISSION_USER_PER_MIN", 20)) / 60.0
+        self.user_burst = float(user_burst or os.getenv("ADMISSION_USER_BURST", 5))
+        self.global_rate = float(global_per_minute or os.getenv("ADMISSION_GLOBAL_PER_MIN", 300)) / 60.0
+        self.global_burst = float(global_burst or os.getenv("ADMISSION_GLOBAL_BURST", 60))
+        self.gate = PriorityGate(
+            int(concurrency or os.getenv("ADMISSION_CONCURRENCY") or os.getenv("LLM_MAX_WORKERS", 4)),
+            int(max_queue or os.getenv("ADMISSION_QUEUE", 16)),
+            float(max_wait or os.getenv("ADMISSION_MAX_WAIT", 10)),
+        )
+        self._lock = threading.Lock()
+        self._outcomes = Counter()  # (priority name, outcome) -> count
+        self._waits = deque(maxlen=1000)
+
+    def admit(self, client=None, priority=INTERACTIVE):
+        # client names the caller's own bucket ("user:42", "addr:10.0.0.7").
+        # Returns a Ticket, or raises Rejected. Prefetch work has its own
+        # budget (see pregen) and only competes for concurrency, so it never
+        # spends the tokens users are waiting for.
+        name = PRIORITY_NAMES[priority]
+        buckets = self._buckets(client) if priority == INTERACTIVE else None
+        try:
+            if buckets:
+                self._take_tokens(buckets)
+            try:
+                waited = self.gate.acquire(priority)
+            except Rejected:
+                if buckets:
+                    self.store.refund(buckets)  # turned away: the request does not count against the rate
+                raise
+        except Rejected as e:
+            self._count(name, e.reason)
+            raise
+        self._count(name, "admitted")
+        with self._lock:
+            self._waits.append(waited)
+        return Ticket(self.gate)
+
+    def _buckets(self, client):
+        buckets = [("global", self.global_rate, self.global_burst)]
+        if client is not None:
+            buckets.insert(0, (client, self.user_rate, self.user_burst))
+        return buckets
+
+    def _take_tokens(self, buckets):
+        refused = self.store.take(buckets)
+        if refused is not None:
+            wait, key = refused
+            raise Rejected("global_rate" if key == "global" else "user_rate", wait)
+
+    def _count(self, priority, outcome):
+        DECISIONS.inc(priority=priority, outcome=outcome)
+        with self._lock:
+            self._outcomes[(priority, outcome)] += 1
+
+    def stats(self):
+        with self._lock:
+            outcomes = {f"{p}.{o}": n for (p, o), n in sorted(self._outcomes.items())}
+            waits = sorted(self._waits)
+        return {
+            "user_per_minute": round(self.user_rate * 60, 2),
+            "user_burst": self.user_burst,
+            "global_per_minute": round(self.global_rate * 60, 2),
+            "global_burst": self.global_burst,
+            "store": type(self.store).__name__,
+            "decisions": outcomes,
+            "wait_ms_p95": round(percentile(waits, 0.95) * 1000, 2),
+            "wait_ms_max": round(waits[-1] * 1000, 2) if waits else 0.0,
+            **self.gate.stats(),
+        }
+
+
+def store_from_env(engine):
+    # ADMISSION_STORE: "sqlite" (shared by all worker processes) or "memory"
+    kind = os.getenv("ADMISSION_STORE", "sqlite").strip().lower()
+    if kind == "memory" or engine.dialect.name != "sqlite":
+        return MemoryBucketStore()
+    return SQLiteBucketStore(engine)
@@ -1,20 +1,20 @@
 # api.py
 from flask import Flask, render_template, request, jsonify
 import os
-import json
-import google.generativeai as genai
 from dotenv import load_dotenv
+from quiz_cache import QuizCache
+import quizgen
+from quizgen import QuizError
 
-# Load .env
+# Load .env (GEMINI_API_KEY is read by quizgen on the first quiz)
 load_dotenv()
-GEMINI_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_KEY:
-    raise RuntimeError("GEMINI_API_KEY not found in .env")
-
-genai.configure(api_key=GEMINI_KEY)
 
 app = Flask(__name__)
 
+# Shares the quiz cache table with app.py
+os.makedirs(app.instance_path, exist_ok=True)
+quiz_cache = QuizCache(os.path.join(app.instance_path, "notes.db"))
+
 # ===== Home page =====
 @app.route("/")
 def index():
@@ -30,54 +30,16 @@ def generate_quiz():
     if not topic:
         return jsonify({"ok": False, "error": "Missing topic"}), 400
 
-    # Gemini prompt
-    prompt = f"""
-    You are a helpful assistant that generates educational multiple-choice quizzes.
-    Produce exactly 5 MCQ questions about the topic: "{topic}".
-    For each question return: question (string), options (array of 4 strings), answer (index 0-3), explanation (short string).
-    Difficulty preference: {difficulty}.
-    Output must be STRICT JSON: an array of 5 objects, e.g.
-    [
-      {{
-        "question": "...",
-        "options": ["A","B","C","D"],
-        "answer": 2,
-        "explanation": "..."
-      }},
-      ...
-    ]
-    Do NOT output any extra commentary or text. Only JSON.
-    """
+    cached = quiz_cache.get(topic, difficulty)
+    if cached is not None:
+        return jsonify({"ok": True, "questions": cached, "cached": True})
 
     try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        resp = model.generate_content(prompt)
-        text = resp.text if hasattr(resp, "text") else str(resp)
-
-        # Parse JSON safely
-        try:
-            quiz = json.loads(text)
-        except Exception:
-            # Try extracting JSON substring
-            import re
-            m = re.search(r"(\[\\s*\\{.*\\}\\s*\\])", text, flags=re.S)
-            if m:
-                quiz = json.loads(m.group(1))
-            else:
-                return jsonify({"ok": False, "error": "Could not parse model output as JSON", "raw": text}), 500
-
-        # Validate structure
-        if not isinstance(quiz, list) or len(quiz) != 5:
-            return jsonify({"ok": False, "error": "Model returned unexpected structure", "raw": text}), 500
-
-        for i, q in enumerate(quiz):
-            if not all(k in q for k in ("question","options","answer","explanation")):
-                return jsonify({"ok": False, "error": f"Question {i} missing fields", "raw": text}), 500
-            if not isinstance(q["options"], list) or len(q["options"]) < 4:
-                return jsonify({"ok": False, "error": f"Question {i} must have 4 options", "raw": text}), 500
-
+        quiz = quizgen.generate_quiz(topic, difficulty)
+        quiz_cache.put(topic, difficulty, quiz)
         return jsonify({"ok": True, "questions": quiz})
-
+    except QuizError as e:
+        return jsonify({"ok": False, "error": str(e), "raw": e.raw}), 500
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
@@ -1,48 +1,194 @@
+# app.py
+# Flask app for the study planner. Build it with create_app() (which is what
+# "flask --app app run" and "gunicorn 'app:create_app()'" call); configuration
+# comes from the environment / .env:
+#
+#   SECRET_KEY     session signing key (default: generated once per instance folder)
+#   DATABASE_URL   SQLAlchemy URL (default: sqlite in the instance folder)
+#   UPLOAD_FOLDER  where attachments are stored (default: static/uploads)
+#   ASSETS_DIR     fingerprinted static files (default: instance/assets)
+#   THUMBNAIL_DIR  resized image attachments (default: instance/thumbnails)
+#   EMBEDDINGS_DIR vector index over notes for chat (default: instance/embeddings)
+#
+# Heavy clients are created lazily: the Gemini SDK is imported and configured
+# on the first quiz (see quizgen), Ollama connections on the first chat. With
+# gunicorn --preload, every process-bound resource (DB connections, thread
+# pools, LLM clients) is rebuilt in each worker after the fork.
+#
+# "uvicorn --factory asgi:create_app" serves the same app through asgi.py,
+# where the LLM routes wait for the model on an event loop instead of a thread.
 import os
-import uuid
 import json
 import random
+import secrets
+import tarfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+import click
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+from flask import Blueprint, Flask, Response, current_app, render_template, request, jsonify, redirect, url_for, flash, session, stream_with_context, g, send_file
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 # removed flask_socketio (group chat removed)
 from werkzeug.utils import secure_filename
-from sqlalchemy.exc import OperationalError
-from mistral import ask_mistral
-import google.generativeai as genai
+from sqlalchemy.exc import IntegrityError, OperationalError
+import mistral
+from quiz_cache import QuizCache, normalize_key, normalize_topic
+import conversations
+from conversations import ConversationMemory
+import quizgen
+from quizgen import QuizError
+from llm_dispatch import LLMDispatcher, DeadlineExceeded
+import llm_router
+from llm_router import AllProvidersFailed, LLMRouter
+import admission
+from admission import AdmissionController, Rejected
+import search
+import embeddings
+import reviews
+import notes_io
+import asgi
+from attachments import AttachmentStore
+import extraction
+from assets import AssetManifest
+import thumbnails
+import migrations
+import metrics
+from pregen import QuizPregenerator
 from dotenv import load_dotenv
 
 
 # =====================================================
-# Environment setup
+# Extensions and per-process services
 # =====================================================
-load_dotenv()
-GEMINI_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_KEY:
-    raise RuntimeError("GEMINI_API_KEY not found in .env")
-genai.configure(api_key=GEMINI_KEY)
-
-# =====================================================
-# Flask app setup
-# =====================================================
-app = Flask(__name__)
-app.secret_key = "your_secret_key"  # Change this to a secure value
-bcrypt = Bcrypt(app)
-# SocketIO/group-chat removed
-
-# File upload config
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-UPLOAD_FOLDER = os.path.join(BASE_DIR, "static", "uploads")
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp", "pdf", "doc", "docx", "txt"}
-app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
-app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16 MB
 
-# Database config
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///notes.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+db = SQLAlchemy()
+bcrypt = Bcrypt()
+bp = Blueprint("main", __name__, cli_group=None)
+
+# Set by _init_services() in create_app() and again in each forked worker
+quiz_cache = None
+llm = None
+quiz_router = None
+chat_router = None
+admission_control = None
+attachment_store = None
+thumbnail_service = None
+chat_memory = None
+pregen = None
+_services_app = None
+
+metrics.Gauge("llm_queue_depth", "Upstream calls waiting for an LLM worker", fn=lambda: llm.stats()["queue_depth"])
+metrics.Gauge("llm_running", "Upstream calls being executed", fn=lambda: llm.stats()["running"])
+metrics.Gauge("admission_queued", "LLM requests waiting to be admitted",
+              fn=lambda: admission_control.gate.stats()["queued"])
+
+def _secret_key(instance_path):
+    # Generated once and shared through the instance folder, so every worker
+    # process signs sessions with the same key
+    path = os.path.join(instance_path, "secret_key")
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path) as f:
+            return f.read().strip()
+    with os.fdopen(fd, "w") as f:
+        f.write(secrets.token_hex(32))
+    with open(path) as f:
+        return f.read().strip()
+
+def _init_services(app):
+    global quiz_cache, llm, quiz_router, chat_router, admission_control, attachment_store, thumbnail_service, chat_memory, pregen, \
+        _extraction_worker, _services_app
+    with app.app_context():
+        engine = db.engine
+        # Quiz cache shares the SQLite file with the app's tables
+        cache_path = engine.url.database if engine.dialect.name == "sqlite" else \
+            os.path.join(app.instance_path, "quiz_cache.db")
+    quiz_cache = QuizCache(
+        cache_path,
+        ttl=int(os.getenv("QUIZ_CACHE_TTL", 24 * 3600)),
+        max_entries=int(os.getenv("QUIZ_CACHE_SIZE", 512)),
+        variants=int(os.getenv("QUIZ_CACHE_VARIANTS", 3)),
+        create_table=engine.dialect.name != "sqlite",  # otherwise migrations.py made it
+    )
+    # Bounded pool for upstream model calls (LLM_MAX_WORKERS, LLM_TIMEOUT)
+    llm = LLMDispatcher()
+    # Providers in order of preference (QUIZ_PROVIDERS, CHAT_PROVIDERS); see llm_router for hedging
+    quiz_router = LLMRouter("quiz", llm_router.providers_from_env("QUIZ_PROVIDERS", "gemini,ollama"))
+    chat_router = LLMRouter("chat", llm_router.providers_from_env("CHAT_PROVIDERS", "ollama,gemini"))
+    # ADMISSION_USER_PER_MIN/_BURST, ADMISSION_GLOBAL_PER_MIN/_BURST, ADMISSION_CONCURRENCY,
+    # ADMISSION_QUEUE, ADMISSION_MAX_WAIT; buckets are shared through the database
+    admission_control = AdmissionController(admission.store_from_env(engine))
+    attachment_store = AttachmentStore(app.config["UPLOAD_FOLDER"])
+    # THUMBNAIL_CACHE_MB, THUMBNAIL_WORKERS; the render pool starts on first use
+    thumbnail_service = thumbnails.ThumbnailService(app.config["UPLOAD_FOLDER"], app.config["THUMBNAIL_DIR"])
+    # CHAT_HISTORY_TOKENS, CHAT_SUMMARY_TOKENS
+    chat_memory = ConversationMemory(engine, summarize_conversation)
+    pregen = QuizPregenerator(pregenerate_quiz)
+    # Started by start_serving(), not here: CLI commands create the app too
+    _extraction_worker = extraction.ExtractionWorker(engine, app.config["UPLOAD_FOLDER"])
+    _services_app = app
+
+def init_worker():
+    # Runs in the child after every fork (gunicorn --preload workers). Threads,
+    # locks and open connections do not survive a fork intact, so nothing
+    # created in the parent is reused.
+    global _user_cache_lock, _topping_up_lock, _serving_lock, _serving
+    _serving_lock = threading.Lock()
+    _serving = False
+    _user_cache_lock = threading.Lock()
+    _user_cache.clear()
+    _topping_up_lock = threading.Lock()
+    _topping_up.clear()
+    mistral.reset_client()
+    if _services_app is not None:
+        with _services_app.app_context():
+            db.engine.dispose(close=False)  # the parent's connections stay the parent's
+        _init_services(_services_app)
+
+os.register_at_fork(after_in_child=init_worker)
+
+def create_app(config=None):
+    load_dotenv()
+    app = Flask(__name__)
+    os.makedirs(app.instance_path, exist_ok=True)
+    app.config.from_mapping(
+        SECRET_KEY=os.getenv("SECRET_KEY") or _secret_key(app.instance_path),
+        SQLALCHEMY_DATABASE_URI=os.getenv("DATABASE_URL") or "sqlite:///" + os.path.join(app.instance_path, "notes.db"),
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        UPLOAD_FOLDER=os.getenv("UPLOAD_FOLDER") or os.path.join(BASE_DIR, "static", "uploads"),
+        ASSETS_DIR=os.getenv("ASSETS_DIR") or os.path.join(app.instance_path, "assets"),
+        THUMBNAIL_DIR=os.getenv("THUMBNAIL_DIR") or os.path.join(app.instance_path, "thumbnails"),
+        EMBEDDINGS_DIR=os.getenv("EMBEDDINGS_DIR") or os.path.join(app.instance_path, "embeddings"),
+        MAX_CONTENT_LENGTH=16 * 1024 * 1024,  # 16 MB
+        NOTES_PAGE_SIZE=int(os.getenv("NOTES_PAGE_SIZE", 20)),
+        IMPORT_MAX_BYTES=int(os.getenv("IMPORT_MAX_MB", 1024)) * 1024 * 1024,  # /notes/import bodies
+    )
+    if config:
+        app.config.update(config)
+    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+
+    db.init_app(app)
+    bcrypt.init_app(app)
+    app.register_blueprint(bp)
+
+    # Content-hashed copies of static/, rebuilt only for files that changed
+    # (by start_serving, or "flask build-assets")
+    manifest = AssetManifest(app.static_folder, app.config["ASSETS_DIR"])
+    app.extensions["assets"] = manifest
+    app.jinja_env.globals["asset_url"] = asset_url
+    with app.app_context():
+        migrations.tune_sqlite(db.engine)  # WAL, busy_timeout, cache size
+        init_db()  # bring the schema up to date
+        embeddings.configure(app.config["EMBEDDINGS_DIR"])  # filled in by start_serving
+        metrics.init_app(app, db.engine)  # timing instrumentation, scraped from /metrics
+    _init_services(app)
+    return app
 
 # =====================================================
 # Models
@@ -59,6 +205,21 @@ class Note(db.Model):
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
     attachment = db.Column(db.String(255))  # uploaded file name
+    attachment_text = db.Column(db.Text)  # filled in by the extraction worker
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))  # NULL for notes created before ownership
+    # Access path for "this user's notes, newest first" (keyset pagination)
+    __table_args__ = (db.Index("ix_note_user_id_id", "user_id", "id"),)
+
+search.watch(Note)  # keep the note_fts full-text index in sync
+embeddings.watch(Note)  # and the chunks behind the chat's embedding index
+
+# One row per stored upload; refcount = number of notes pointing at it
+class AttachmentBlob(db.Model):
+    __tablename__ = "attachment_blob"
+    path = db.Column(db.String(255), primary_key=True)  # e.g. "ab/cd/<sha256>.pdf"
+    sha256 = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
 
 # Subject model for Subject Focus Wheel
 class Subject(db.Model):
@@ -66,6 +227,8 @@ class Subject(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    # Also serves "subjects of this user" lookups
+    __table_args__ = (db.Index("ux_subject_user_name", "user_id", "name", unique=True),)
 
 # Removed Group, GroupMember, Message models (group chat removed)
 
@@ -75,78 +238,260 @@ class Subject(db.Model):
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def unique_filename(original_name: str) -> str:
-    name = secure_filename(original_name)
-    base, ext = os.path.splitext(name)
-    return f"{uuid.uuid4().hex}{ext.lower()}"
-
 def delete_file_if_exists(filename: str):
     if not filename:
         return
-    path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    path = os.path.join(current_app.config["UPLOAD_FOLDER"], filename)
     if os.path.exists(path):
         os.remove(path)
+    thumbnail_service.discard(filename)
+
+def stage_upload(file):
+    ext = os.path.splitext(secure_filename(file.filename))[1]
+    return attachment_store.stage(file.stream, ext)
+
+def acquire_attachment(staged):
+    db.session.execute(
+        db.text(
+            "INSERT INTO attachment_blob (path, sha256, size, refcount) VALUES (:path, :sha256, :size, 1) "
+            "ON CONFLICT(path) DO UPDATE SET refcount = refcount + 1"
+        ),
+        {"path": staged.path, "sha256": staged.digest, "size": staged.size},
+    )
+
+def release_attachment(path: str):
+    # Drop one reference; the file goes with the last one, but only once the
+    # transaction has committed (see remove_released_files)
+    if not path:
+        return
+    result = db.session.execute(
+        db.text("UPDATE attachment_blob SET refcount = refcount - 1 WHERE path = :path"), {"path": path}
+    )
+    if result.rowcount == 0:
+        # Uploads from before content addressing belong to a single note
+        db.session.info.setdefault("released_files", []).append((path, True))
+        return
+    remaining = db.session.execute(
+        db.text("SELECT refcount FROM attachment_blob WHERE path = :path"), {"path": path}
+    ).scalar()
+    if remaining <= 0:
+        db.session.execute(db.text("DELETE FROM attachment_blob WHERE path = :path"), {"path": path})
+        db.session.info.setdefault("released_files", []).append((path, False))
+
+def remove_released_files():
+    # Unlink the files whose last reference the committed transaction dropped.
+    # The unlink happens inside a write transaction that first re-checks the
+    # blob row, so a concurrent upload of the same content either took its
+    # reference before (the file stays) or waits and then re-creates the file.
+    for path, legacy in db.session.info.pop("released_files", []):
+        if legacy:
+            delete_file_if_exists(path)
+            continue
+        with db.engine.begin() as conn:
+            conn.execute(db.text("DELETE FROM attachment_blob WHERE path = :path AND refcount <= 0"), {"path": path})
+            if conn.execute(db.text("SELECT 1 FROM attachment_blob WHERE path = :path"), {"path": path}).first():
+                continue
+            attachment_store.remove(path)
+        thumbnail_service.discard(path)
 
-def ensure_attachment_column():
+def commit_with_upload(staged=None):
     try:
-        result = db.session.execute(db.text("PRAGMA table_info(note);"))
-        cols = [row[1] for row in result]
-        if "attachment" not in cols:
-            db.session.execute(db.text("ALTER TABLE note ADD COLUMN attachment VARCHAR(255);"))
-            db.session.commit()
+        db.session.commit()
     except Exception:
         db.session.rollback()
+        db.session.info.pop("released_files", None)
+        attachment_store.discard(staged)
+        raise
+    remove_released_files()
+    if staged:
+        attachment_store.commit(staged)
+        get_extraction_worker().notify()
+
+_extraction_worker = None
+
+def get_extraction_worker():
+    global _extraction_worker
+    if _extraction_worker is None:
+        _extraction_worker = extraction.ExtractionWorker(db.engine, current_app.config["UPLOAD_FOLDER"])
+    return _extraction_worker
+
+def sync_embeddings():
+    # Fill in anything missing from the mapped index files
+    index = embeddings.get_index()
+    if index is None:
+        return
+    try:
+        with db.engine.connect() as conn:
+            embedded = index.sync(conn)
+    except OperationalError as e:
+        print("Could not load the embedding index:", e)
+        return
+    if embedded:
+        print(f"Embedded {embedded} note chunks.")
+
+# Work only a serving process needs: building the static assets, catching
+# up the embedding index and starting the extraction worker (which picks up
+# jobs a previous process left pending). It runs before the first request of
+# each process rather than in create_app(), so one-shot CLI commands such as
+# "flask extract-attachments" do not compete with a worker of their own.
+_serving = False
+_serving_lock = threading.Lock()
+
+def start_serving(app):
+    global _serving
+    with _serving_lock:
+        if _serving:
+            return
+        _serving = True
+        app.extensions["assets"].build()
+        with app.app_context():
+            sync_embeddings()
+        get_extraction_worker().start()
+
+@bp.before_app_request
+def _start_serving():
+    if not _serving:
+        start_serving(current_app._get_current_object())
 
 def init_db():
     try:
-        db.create_all()
-        ensure_attachment_column()
+        applied = migrations.migrate(db.engine)
+        if applied:
+            print("Applied migrations:", ", ".join(applied))
     except Exception as e:
         print("Error creating/upgrading database:", e)
+    unowned = db.session.execute(db.text("SELECT COUNT(*) FROM note WHERE user_id IS NULL")).scalar()
+    db.session.remove()
+    if unowned:
+        print(f"{unowned} notes from before user accounts have no owner and are hidden; "
+              "assign them with: flask claim-notes <username>")
+
+# =====================================================
+# Identity: one user lookup per request
+# =====================================================
+# The session stores the user id; the user is loaded at most once per request
+# (cached on g) and usually not at all, thanks to a small process-level cache.
+CurrentUser = namedtuple("CurrentUser", "id username")
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 60  # seconds; bounds staleness across worker processes
+_user_cache = OrderedDict()  # user id -> (loaded_at, CurrentUser)
+_user_cache_lock = threading.Lock()
+
+def _cached_user(user_id):
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        if entry and time.monotonic() - entry[0] < USER_CACHE_TTL:
+            _user_cache.move_to_end(user_id)
+            return entry[1]
+    user = db.session.get(User, user_id)
+    if user is None:
+        invalidate_user(user_id)
+        return None
+    current = CurrentUser(user.id, user.username)
+    with _user_cache_lock:
+        _user_cache[user_id] = (time.monotonic(), current)
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+    return current
+
+def invalidate_user(user_id):
+    # Call whenever a user row changes or goes away
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+def current_user():
+    if "user" in g:
+        return g.user
+    user_id = session.get('user_id')
+    if user_id is None and 'username' in session:
+        # Sessions created before ids were stored
+        user = User.query.filter_by(username=session['username']).first()
+        user_id = user.id if user else None
+        if user_id is not None:
+            session['user_id'] = user_id
+    g.user = _cached_user(user_id) if user_id is not None else None
+    if g.user is None and user_id is not None:
+        session.clear()
+    return g.user
+
+def login_required(view=None, *, api=False):
+    # HTML routes redirect to the login page; api=True routes get a 401
+    if view is None:
+        return lambda v: login_required(v, api=api)
+
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if current_user() is None:
+            if api:
+                return jsonify({'error': 'Please log in.'}), 401
+            flash('Please log in.', 'error')
+            return redirect(url_for('.login'))
+        return view(*args, **kwargs)
+    return wrapped
+
+def page_size_arg(default):
+    try:
+        return max(1, min(int(request.args.get('limit', default)), 100))
+    except ValueError:
+        return default
+
+def notes_page(user_id, before=None, limit=20):
+    # Keyset pagination over (user_id, id): cost depends on the page size, not the table size
+    query = Note.query.filter(Note.user_id == user_id)
+    if before is not None:
+        query = query.filter(Note.id < before)
+    rows = query.order_by(Note.id.desc()).limit(limit + 1).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return rows[:limit], next_cursor
 
 # =====================================================
 # Routes: Home
 # =====================================================
-@app.route("/")
+@bp.route("/")
 def index():
     return render_template("index.html")
 
 # =====================================================
 # Auth: Signup / Login / Logout
 # =====================================================
-@app.route('/signup', methods=['GET', 'POST'])
+@bp.route('/signup', methods=['GET', 'POST'])
 def signup():
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '').strip()
         if not username or not password:
             flash("Username and password cannot be empty!", "error")
-            return redirect(url_for('signup'))
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+            return redirect(url_for('.signup'))
+        with metrics.timed("bcrypt"):
+            hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
         try:
             user = User(username=username, password=hashed_password)
             db.session.add(user)
             db.session.commit()
             flash('Account created! Please log in.', 'success')
-            return redirect(url_for('login'))
+            return redirect(url_for('.login'))
         except db.exc.IntegrityError:
             db.session.rollback()
             flash('Username already taken.', 'error')
-            return redirect(url_for('signup'))
+            return redirect(url_for('.signup'))
     return render_template('signup.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '').strip()
         user = User.query.filter_by(username=username).first()
-        if user and bcrypt.check_password_hash(user.password, password):
+        with metrics.timed("bcrypt"):
+            valid = user is not None and bcrypt.check_password_hash(user.password, password)
+        if valid:
+            session['user_id'] = user.id
             session['username'] = username
+            invalidate_user(user.id)
             flash('Logged in successfully!', 'success')
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('.dashboard'))
         flash('Invalid username or password.', 'error')
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     return render_template('login.html')
 
 # =====================================================
@@ -185,271 +530,874 @@ TASKS = {
 
 
 # Dashboard
-@app.route('/dashboard')
+@bp.route('/dashboard')
+@login_required
 def dashboard():
-    if 'username' not in session:
-        flash('Please log in.', 'error')
-        return redirect(url_for('login'))
-    user = User.query.filter_by(username=session['username']).first()
-    if not user:
-        session.pop('username', None)
-        flash('User not found.', 'error')
-        return redirect(url_for('login'))
-    
     # Get user's subjects (if any)
     try:
-        subjects = Subject.query.filter_by(user_id=user.id).all()
+        subjects = Subject.query.filter_by(user_id=g.user.id).all()
     except Exception:
         subjects = []
-    return render_template('dashboard.html', username=session['username'], subjects=subjects)
+    pregen.mark_active(g.user.id, [s.name for s in subjects])
+    return render_template('dashboard.html', username=g.user.username, subjects=subjects)
 
 # Add Subject
-@app.route('/add_subject', methods=['POST'])
+@bp.route('/add_subject', methods=['POST'])
+@login_required
 def add_subject():
-    if 'username' not in session:
-        flash('Please log in.', 'error')
-        return redirect(url_for('login'))
-    
-    user = User.query.filter_by(username=session['username']).first()
-    if not user:
-        session.pop('username', None)
-        flash('User not found.', 'error')
-        return redirect(url_for('login'))
-    
+    user = g.user
     subject_name = request.form.get('subject_name', '').strip()
     if not subject_name:
         flash('Subject name cannot be empty.', 'error')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('.dashboard'))
     
-    if Subject.query.filter_by(user_id=user.id, name=subject_name).first():
+    db.session.add(Subject(name=subject_name, user_id=user.id))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
         flash('Subject already exists.', 'error')
-        return redirect(url_for('dashboard'))
-    
-    subject = Subject(name=subject_name, user_id=user.id)
-    db.session.add(subject)
-    db.session.commit()
+        return redirect(url_for('.dashboard'))
     flash('Subject added!', 'success')
-    return redirect(url_for('dashboard'))
+    return redirect(url_for('.dashboard'))
 
 
 # Edit Subject
-@app.route('/edit_subject/<int:subject_id>', methods=['POST'])
+@bp.route('/edit_subject/<int:subject_id>', methods=['POST'])
+@login_required
 def edit_subject(subject_id):
-    if 'username' not in session:
-        flash('Please log in.', 'error')
-        return redirect(url_for('login'))
-
-    user = User.query.filter_by(username=session['username']).first()
-    subject = Subject.query.filter_by(id=subject_id, user_id=user.id).first()
+    subject = Subject.query.filter_by(id=subject_id, user_id=g.user.id).first()
     
     if not subject:
         flash('Subject not found.', 'error')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('.dashboard'))
 
     new_name = request.form.get('subject_name', '').strip()
     if not new_name:
         flash('New subject name cannot be empty.', 'error')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('.dashboard'))
 
     subject.name = new_name
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        flash('Subject already exists.', 'error')
+        return redirect(url_for('.dashboard'))
     flash('Subject updated!', 'success')
-    return redirect(url_for('dashboard'))
+    return redirect(url_for('.dashboard'))
 
 
 # Delete Subject
-@app.route('/delete_subject/<int:subject_id>', methods=['POST'])
+@bp.route('/delete_subject/<int:subject_id>', methods=['POST'])
+@login_required
 def delete_subject(subject_id):
-    if 'username' not in session:
-        flash('Please log in.', 'error')
-        return redirect(url_for('login'))
-
-    user = User.query.filter_by(username=session['username']).first()
-    subject = Subject.query.filter_by(id=subject_id, user_id=user.id).first()
+    subject = Subject.query.filter_by(id=subject_id, user_id=g.user.id).first()
 
     if not subject:
         flash('Subject not found.', 'error')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('.dashboard'))
 
     db.session.delete(subject)
     db.session.commit()
     flash('Subject deleted!', 'success')
-    return redirect(url_for('dashboard'))
+    return redirect(url_for('.dashboard'))
 
 
 # Spin Route (Wheel Logic)
-@app.route('/spin', methods=['GET'])
+@bp.route('/spin', methods=['GET'])
+@login_required(api=True)
 def spin():
-    if 'username' not in session:
-        return jsonify({'error': 'Please log in.'}), 401
-
-    user = User.query.filter_by(username=session['username']).first()
-    if not user:
-        return jsonify({'error': 'User not found.'}), 404
-
-    subjects = Subject.query.filter_by(user_id=user.id).all()
+    subjects = Subject.query.filter_by(user_id=g.user.id).all()
+    if subjects:
+        pregen.mark_active(g.user.id, [s.name for s in subjects])
     subject_names = [s.name for s in subjects] or ["Math", "Science", "History", "English"]
 
-    # Pick a random subject index
-    winning_index = random.randint(0, len(subject_names) - 1)
+    # Pick a subject, favouring those with quiz questions due for review
+    due = reviews.due_counts(db.session.connection(), g.user.id)
+    due = [due.get(normalize_topic(name), 0) for name in subject_names]
+    winning_index = random.choices(range(len(subject_names)), weights=[1 + n for n in due])[0]
     selected_subject = subject_names[winning_index]
 
     # Pick a task for the selected subject
-    selected_task = random.choice(TASKS.get(selected_subject, TASKS["default"]))
+    if due[winning_index]:
+        selected_task = f"Review {due[winning_index]} quiz questions due today"
+    else:
+        selected_task = random.choice(TASKS.get(selected_subject, TASKS["default"]))
 
-    return jsonify({
+    result = {
         'subjects': subject_names,    # frontend uses this to build the wheel
         'winning_index': winning_index,  # arrow points here
         'subject': selected_subject,
-        'task': selected_task
-    })
+        'task': selected_task,
+        'due': due,                   # questions due per subject, same order
+        'quiz_ready': pregen.ready(selected_subject, "auto"),
+    }
+    # ?with_quiz=1 hands out the ready quiz itself
+    if request.args.get('with_quiz') and result['quiz_ready']:
+        result['quiz'] = pregen.pop(selected_subject, "auto")
+    return jsonify(result)
 
 # Logout (single definition)
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
+    session.pop('user_id', None)
     session.pop('username', None)
     session.pop('recent_subjects', None)
     flash('Logged out.', 'success')
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
 
 # =====================================================
 # Notes System
 # =====================================================
-@app.route('/notes')
+@bp.route('/notes')
+@login_required
 def notes_index():
-    if 'username' not in session:
-        flash('Please log in.', 'error')
-        return redirect(url_for('login'))
+    user = g.user
+    before = request.args.get('before', type=int)
     try:
-        notes = Note.query.order_by(Note.id.desc()).all()
+        notes, next_cursor = notes_page(user.id, before, current_app.config["NOTES_PAGE_SIZE"])
     except OperationalError:
         init_db()
-        notes = []
-    return render_template('notes.html', notes=notes)
+        notes, next_cursor = [], None
+    return render_template('notes.html', notes=notes, next_cursor=next_cursor)
+
+@bp.route('/api/notes')
+@login_required(api=True)
+def notes_api():
+    user = g.user
+    before = request.args.get('before', type=int)
+    limit = page_size_arg(current_app.config["NOTES_PAGE_SIZE"])
+    notes, next_cursor = notes_page(user.id, before, limit)
+    return jsonify({
+        'notes': [
+            {'id': n.id, 'title': n.title, 'content': n.content, 'attachment': n.attachment}
+            for n in notes
+        ],
+        'next_cursor': next_cursor,
+    })
+
+@bp.route('/notes/search')
+@login_required(api=True)
+def notes_search():
+    user = g.user
+    query = request.args.get('q', '').strip()
+    limit = page_size_arg(current_app.config["NOTES_PAGE_SIZE"])
+    try:
+        results = search.search(db.session.connection(), user.id, query, limit)
+    except OperationalError:
+        init_db()
+        results = []
+    return jsonify({'query': query, 'results': results})
+
+# Bulk export/import as JSON Lines, or a tar stream with the attachments (see notes_io)
+@bp.route('/notes/export')
+@login_required(api=True)
+def notes_export():
+    user = g.user
+    name = secure_filename(user.username) or str(user.id)
+    if request.args.get('attachments'):
+        body = notes_io.export_tar(db.engine, attachment_store, user.id)
+        mimetype, filename = "application/x-tar", f"notes-{name}.tar"
+    else:
+        body = notes_io.export_jsonl(db.engine, user.id)
+        mimetype, filename = "application/x-ndjson", f"notes-{name}.jsonl"
+    return Response(body, mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@bp.route('/notes/import', methods=['POST'])
+@login_required(api=True)
+def notes_import():
+    # The body is the export itself, or a form upload in the "file" field
+    request.max_content_length = current_app.config["IMPORT_MAX_BYTES"]
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    importer = notes_io.NoteImporter(db.engine, attachment_store, g.user.id)
+    try:
+        stats = importer.read(stream)
+    except (notes_io.BadImport, tarfile.TarError) as e:
+        importer.flush()  # keep what was read before the error, as the batches before it were
+        return jsonify({'ok': False, 'error': str(e), **importer.stats}), 400
+    if stats['notes'] and stats['missing_attachments'] < stats['notes']:
+        get_extraction_worker().notify()
+    return jsonify({'ok': True, **stats})
+
+@bp.cli.command("export-notes")
+@click.argument("username")
+@click.option("--output", "-o", type=click.File("wb"), default="-", help="File to write (default: stdout).")
+@click.option("--attachments", is_flag=True, help="Write a tar stream with the attached files.")
+def export_notes(username, output, attachments):
+    """Export a user's subjects and notes as JSON Lines."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username!r}.")
+    store = AttachmentStore(current_app.config["UPLOAD_FOLDER"])
+    chunks = notes_io.export_tar(db.engine, store, user.id) if attachments else \
+        notes_io.export_jsonl(db.engine, user.id)
+    for chunk in chunks:
+        output.write(chunk)
+
+@bp.cli.command("import-notes")
+@click.argument("username")
+@click.argument("source", type=click.File("rb"))
+def import_notes(username, source):
+    """Import subjects and notes from an export (JSON Lines or tar; - for stdin)."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username!r}.")
+    started = time.perf_counter()
+    importer = notes_io.NoteImporter(db.engine, AttachmentStore(current_app.config["UPLOAD_FOLDER"]), user.id)
+    try:
+        stats = importer.read(source)
+    except (notes_io.BadImport, tarfile.TarError) as e:
+        importer.flush()
+        raise click.ClickException(f"{e} (imported {importer.stats['notes']} notes before it)")
+    for error in stats["errors"]:
+        print("Skipped", error)
+    print(f"Imported {stats['notes']} notes, {stats['subjects']} subjects and {stats['attachments']} attachments "
+          f"in {time.perf_counter() - started:.1f}s ({stats['skipped']} records skipped).")
+
+@bp.cli.command("claim-notes")
+@click.argument("username")
+def claim_notes(username):
+    """Give the notes that have no owner (from before user accounts) to a user."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username!r}.")
+    notes = Note.query.filter(Note.user_id.is_(None)).all()
+    for note in notes:
+        note.user_id = user.id  # the search and embedding indexes follow through the model events
+    db.session.commit()
+    print(f"Assigned {len(notes)} notes to {username}.")
+
+@bp.cli.command("rebuild-search-index")
+def rebuild_search_index():
+    """Rebuild the notes full-text index from the note table."""
+    with db.engine.begin() as conn:
+        total = search.rebuild(conn)
+    print(f"Indexed {total} notes.")
+
+@bp.cli.command("rebuild-embeddings")
+def rebuild_embeddings():
+    """Re-chunk every note and rebuild the embedding index files."""
+    index = embeddings.get_index()
+    if index is None:
+        print("NumPy is not installed; the embedding index is disabled.")
+        return
+    with db.engine.begin() as conn:
+        notes = embeddings.rebuild(conn)
+    with db.engine.connect() as conn:
+        chunks = index.sync(conn, force=True)
+    print(f"Indexed {chunks} chunks from {notes} notes.")
+
+@bp.route("/embeddings/stats")
+def embedding_stats():
+    index = embeddings.get_index()
+    return jsonify(index.stats() if index else {"enabled": False})
+
+@bp.route('/notes/<int:id>/extraction')
+@login_required(api=True)
+def note_extraction_status(id):
+    user = g.user
+    note = Note.query.filter_by(id=id, user_id=user.id).first_or_404()
+    status = extraction.job_status(db.session.connection(), note.id)
+    return jsonify({'note_id': note.id, 'job': status, 'has_text': bool(note.attachment_text)})
+
+@bp.route('/extraction/stats')
+def extraction_stats():
+    return jsonify(get_extraction_worker().stats())
+
+@bp.cli.command("extract-attachments")
+@click.option("--processes", default=os.cpu_count() or 2, show_default=True, help="Worker processes.")
+def extract_attachments(processes):
+    """Queue text extraction for every attachment without text and run it now."""
+    queued = 0
+    rows = db.session.execute(db.text(
+        "SELECT id, attachment FROM note WHERE attachment IS NOT NULL AND attachment_text IS NULL "
+        "AND id NOT IN (SELECT note_id FROM extraction_job WHERE status IN ('pending', 'running', 'skipped'))"
+    )).all()
+    for note_id, path in rows:
+        extraction.enqueue(db.session.connection(), note_id, path)
+        queued += 1
+    db.session.commit()
+    worker = extraction.ExtractionWorker(db.engine, current_app.config["UPLOAD_FOLDER"], processes=processes,
+                                         batch_size=processes * 8)
+    worker.drain()
+    worker.stop()
+    stats = worker.stats()
+    print(f"Queued {queued} attachments; extracted {stats['done']} ({stats['chars']} chars), "
+          f"{stats['failed']} failed, {stats['docs_per_second']} docs/s.")
+
+@bp.cli.command("migrate-uploads")
+def migrate_uploads():
+    """Move flat uploads into the content-addressed layout and count references."""
+    moved = 0
+    notes = Note.query.filter(Note.attachment.isnot(None)).order_by(Note.id).all()
+    for note in notes:
+        if "/" in note.attachment:
+            continue  # already content-addressed
+        if not os.path.exists(attachment_store.full_path(note.attachment)):
+            print(f"Note {note.id}: missing file {note.attachment}, clearing attachment")
+            note.attachment = None
+            continue
+        staged = attachment_store.adopt(note.attachment)
+        acquire_attachment(staged)
+        note.attachment = staged.path
+        moved += 1
+        if moved % 500 == 0:
+            db.session.commit()
+    db.session.commit()
+    print(f"Migrated {moved} attachments.")
 
-@app.route('/add', methods=['POST'])
+@bp.route('/add', methods=['POST'])
+@login_required
 def add_note():
-    if 'username' not in session:
-        flash('Please log in.', 'error')
-        return redirect(url_for('login'))
+    user = g.user
     title = request.form.get('title', '').strip()
     content = request.form.get('content', '').strip()
     if not title or not content:
         flash("Title and content cannot be empty!", "error")
-        return redirect(url_for('notes_index'))
+        return redirect(url_for('.notes_index'))
     file = request.files.get('attachment')
-    filename = None
+    staged = None
     if file and file.filename:
         if not allowed_file(file.filename):
             flash("Unsupported file type.", "error")
-            return redirect(url_for('notes_index'))
-        filename = unique_filename(file.filename)
-        file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
-    db.session.add(Note(title=title, content=content, attachment=filename))
-    db.session.commit()
+            return redirect(url_for('.notes_index'))
+        staged = stage_upload(file)
+        acquire_attachment(staged)
+    note = Note(title=title, content=content, attachment=staged.path if staged else None, user_id=user.id)
+    db.session.add(note)
+    if staged:
+        db.session.flush()
+        extraction.enqueue(db.session.connection(), note.id, staged.path)
+    commit_with_upload(staged)
     flash("Note added!", "success")
-    return redirect(url_for('notes_index'))
+    return redirect(url_for('.notes_index'))
 
-@app.route('/edit/<int:id>', methods=['POST'])
+@bp.route('/edit/<int:id>', methods=['POST'])
+@login_required
 def edit_note(id):
-    if 'username' not in session:
-        flash('Please log in.', 'error')
-        return redirect(url_for('login'))
-    note = Note.query.get_or_404(id)
+    user = g.user
+    note = Note.query.filter_by(id=id, user_id=user.id).first_or_404()
     new_title = request.form.get('title', '').strip()
     new_content = request.form.get('content', '').strip()
     if not new_title or not new_content:
         flash("Title and content cannot be empty!", "error")
-        return redirect(url_for('notes_index'))
+        return redirect(url_for('.notes_index'))
     file = request.files.get('attachment')
+    staged = None
     if file and file.filename:
         if not allowed_file(file.filename):
             flash("Unsupported file type.", "error")
-            return redirect(url_for('notes_index'))
-        if note.attachment:
-            delete_file_if_exists(note.attachment)
-        filename = unique_filename(file.filename)
-        file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
-        note.attachment = filename
+            return redirect(url_for('.notes_index'))
+        staged = stage_upload(file)
+        acquire_attachment(staged)
+        release_attachment(note.attachment)
+        note.attachment = staged.path
+        note.attachment_text = None
+        extraction.enqueue(db.session.connection(), note.id, staged.path)
     note.title = new_title
     note.content = new_content
-    db.session.commit()
+    commit_with_upload(staged)
     flash("Note updated!", "success")
-    return redirect(url_for('notes_index'))
+    return redirect(url_for('.notes_index'))
 
-@app.route('/delete/<int:id>')
+@bp.route('/delete/<int:id>')
+@login_required
 def delete_note(id):
-    if 'username' not in session:
-        flash('Please log in.', 'error')
-        return redirect(url_for('login'))
-    note = Note.query.get_or_404(id)
-    if note.attachment:
-        delete_file_if_exists(note.attachment)
+    user = g.user
+    note = Note.query.filter_by(id=id, user_id=user.id).first_or_404()
+    release_attachment(note.attachment)
     db.session.delete(note)
-    db.session.commit()
+    commit_with_upload()
     flash("Note deleted!", "success")
-    return redirect(url_for('notes_index'))
+    return redirect(url_for('.notes_index'))
+
+# =====================================================
+# Admission control for the LLM routes (see admission.py)
+# =====================================================
+# Only requests that will reach a model are admitted; cache and pre-generated
+# hits are served without touching the buckets.
+def admit():
+    user = current_user()
+    # Waiting for a slot and then for the model takes seconds; give the
+    # session's pooled connection back first so other requests can use it
+    db.session.close()
+    return admission_control.admit(f"user:{user.id}" if user else f"addr:{request.remote_addr}")
+
+@bp.errorhandler(Rejected)
+def not_admitted(e):
+    wait = e.retry_after_header
+    if e.reason == "user_rate":
+        message = f"You are sending requests too quickly, please try again in {wait}s"
+    else:
+        message = f"The assistant is busy right now, please try again in {wait}s"
+    response = jsonify({"ok": False, "error": message, "retry_after": int(wait)})
+    response.headers["Retry-After"] = wait
+    return response, 429
 
 # =====================================================
 # AI Chat (Mistral)
 # =====================================================
-@app.route("/chat_ai", methods=["POST"])
+CHAT_CONTEXT_PASSAGES = int(os.getenv("CHAT_CONTEXT_PASSAGES", 4))
+CHAT_CONTEXT_MIN_SCORE = 0.15  # cosine; below this a passage is rarely on topic
+
+def note_passages(message):
+    # The logged-in user's note passages closest to the message
+    index = embeddings.get_index()
+    user = current_user()
+    if index is None or user is None:
+        return []
+    with metrics.timed("note_retrieval"):
+        hits = [(chunk_id, score) for chunk_id, score in index.search(user.id, message, CHAT_CONTEXT_PASSAGES)
+                if score >= CHAT_CONTEXT_MIN_SCORE]
+        return embeddings.passages(db.session.connection(), user.id, hits)
+
+def grounded_prompt(message, passages):
+    if not passages:
+        return message
+    excerpts = "\n\n".join(f"[{i}] {p['text']}" for i, p in enumerate(passages, start=1))
+    return (
+        "Excerpts from the student's own notes:\n\n" + excerpts + "\n\n"
+        "Answer the question below. Use the excerpts where they are relevant and "
+        "say so when the notes do not cover it.\n\nQuestion: " + message
+    )
+
+def conversation_id():
+    # One conversation per browser session; /chat_ai/reset starts a new one
+    if "chat_id" not in session:
+        session["chat_id"] = ConversationMemory.new_id()
+    return session["chat_id"]
+
+def chat_user_id():
+    user = current_user()
+    return user.id if user else None
+
+# Runs on the chat memory's background thread, behind interactive requests
+def summarize_conversation(summary, turns):
+    with admission_control.admit(priority=admission.PREFETCH):
+        return llm.call(chat_router.complete_text, conversations.summary_prompt(summary, turns))
+
+@bp.route("/chat_ai", methods=["POST"])
+@login_required(api=True)
 def chat_ai():
     data = request.get_json(silent=True) or {}
     user_message = (data.get("message") or "").strip()
     if not user_message:
         return jsonify({"reply": "Please type a message."}), 400
-    try:
-        reply = ask_mistral(user_message)
-    except Exception as e:
-        reply = f"Error: {str(e)}"
-    return jsonify({"reply": reply}), 200
+    conversation = conversation_id()
+    passages = note_passages(user_message)
+    sources = [{"note_id": p["note_id"], "title": p["title"]} for p in passages]
+    # Excerpts go into this turn's prompt only; the history keeps the plain message
+    messages = chat_memory.messages(conversation, grounded_prompt(user_message, passages))
+    user_id = chat_user_id()
+
+    def respond(result):
+        try:
+            reply = result()
+            chat_memory.record(conversation, user_id, user_message, reply)
+        except DeadlineExceeded:
+            reply = "Error: the model took too long to answer, please try again."
+        except AllProvidersFailed as e:
+            print("Chat failed:", e)
+            reply = "Error: no chat model is available right now, please try again."
+        except Exception as e:
+            reply = f"Error: {str(e)}"
+        return jsonify({"reply": reply, "sources": sources}), 200
+
+    return model_reply(respond, lambda: llm.call(chat_router.complete, messages),
+                       lambda: chat_router.acomplete(messages), admit())
+
+def model_reply(respond, call, acall, ticket, key=None):
+    # respond(result) turns result() -- the model's answer, or the exception it
+    # raised -- into the response. call runs the model on the LLM pool while
+    # this thread waits; under ASGI the coroutine acall() is awaited on the
+    # event loop instead and no thread waits (see asgi.py).
+    if asgi.active():
+        return asgi.DeferredReply(acall, respond, ticket, key=key, timeout=llm.timeout)
+    with ticket:
+        return respond(call)
+
+def sse_event(data, event=None):
+    msg = f"event: {event}\n" if event else ""
+    return msg + f"data: {json.dumps(data)}\n\n"
+
+def event_stream(events, ticket=None):
+    response = Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    if ticket is not None:
+        # Runs when the stream ends, including when the client goes away before it starts
+        response.call_on_close(ticket.release)
+    return response
+
+# Streaming variant: tokens are pushed as Server-Sent Events while Mistral generates
+@bp.route("/chat_ai/stream", methods=["POST"])
+@login_required(api=True)
+def chat_ai_stream():
+    data = request.get_json(silent=True) or {}
+    user_message = (data.get("message") or "").strip()
+    if not user_message:
+        return jsonify({"reply": "Please type a message."}), 400
+    conversation = conversation_id()
+    user_id = chat_user_id()
+    messages = chat_memory.messages(conversation, grounded_prompt(user_message, note_passages(user_message)))
+    ticket = admit()
+
+    def events():
+        reply = []
+        try:
+            for token in llm.stream(chat_router.stream, messages):
+                reply.append(token)
+                yield sse_event({"token": token})
+        except Exception as e:
+            yield sse_event({"error": str(e)}, event="error")
+            return
+        chat_memory.record(conversation, user_id, user_message, "".join(reply))
+        yield sse_event({}, event="done")
+
+    async def async_events():
+        reply = []
+        try:
+            async for token in chat_router.astream(messages):
+                reply.append(token)
+                yield sse_event({"token": token})
+        except Exception as e:
+            yield sse_event({"error": str(e)}, event="error")
+            return
+        await asgi.run_sync(chat_memory.record, conversation, user_id, user_message, "".join(reply))
+        yield sse_event({}, event="done")
+
+    if asgi.active():
+        return asgi.DeferredStream(async_events(), ticket)
+    return event_stream(events(), ticket)
+
+@bp.route("/chat_ai/reset", methods=["POST"])
+def chat_ai_reset():
+    conversation = session.pop("chat_id", None)
+    if conversation:
+        chat_memory.forget(conversation)
+    return jsonify({"ok": True})
+
+@bp.route("/chat_ai/stats")
+def chat_ai_stats():
+    return jsonify(chat_memory.stats())
 
 # =====================================================
-# Gemini Quiz Generator
+# Quiz Generator (Gemini, with fallback through quiz_router)
 # =====================================================
-@app.route("/quiz", methods=["POST"])
+# Runs on the LLM pool; coalesced callers all receive this result
+def build_quiz(topic, difficulty):
+    quiz = quizgen.generate_quiz(topic, difficulty, call=quiz_router.complete_text)
+    quiz_cache.put(topic, difficulty, quiz)
+    return quiz
+
+async def abuild_quiz(topic, difficulty):
+    quiz = await quizgen.agenerate_quiz(topic, difficulty, call=quiz_router.acomplete_text)
+    await asgi.run_sync(quiz_cache.put, topic, difficulty, quiz)
+    return quiz
+
+def pregenerate_quiz(topic, difficulty):
+    # Not coalesced: every pooled quiz should be a fresh set of questions. Waits
+    # behind interactive requests for an LLM slot.
+    with admission_control.admit(priority=admission.PREFETCH):
+        return llm.call(build_quiz, topic, difficulty)
+
+# Keys being topped up in the background, one generation per key at a time
+_topping_up = set()
+_topping_up_lock = threading.Lock()
+
+def top_up_quiz_cache(topic, difficulty):
+    # After a cache hit: a key with fewer than QUIZ_CACHE_VARIANTS variants
+    # gets one more in the background, so repeat requests rotate through
+    # different question sets. Draws on the pre-generation budget.
+    if not quiz_cache.wants_more(topic, difficulty):
+        return
+    key = normalize_key(topic, difficulty)
+    with _topping_up_lock:
+        if key in _topping_up:
+            return
+        _topping_up.add(key)
+    if not pregen.budget.take():
+        with _topping_up_lock:
+            _topping_up.discard(key)
+        return
+
+    def run():
+        try:
+            pregenerate_quiz(topic, difficulty)
+        except Rejected:
+            pass  # users are busy; the next hit tries again
+        except Exception as e:
+            print(f"Quiz cache top-up failed for {topic!r}: {e}")
+        finally:
+            with _topping_up_lock:
+                _topping_up.discard(key)
+
+    threading.Thread(target=run, name="quiz-top-up", daemon=True).start()
+
+@bp.route("/quiz", methods=["POST"])
 def generate_quiz():
     data = request.get_json() or {}
     topic = data.get("topic", "").strip()
     difficulty = data.get("difficulty", "auto").strip().lower()
     if not topic:
         return jsonify({"ok": False, "error": "Missing topic"}), 400
-    prompt = f"""
-    You are an assistant that generates educational multiple-choice quizzes.
-    Produce exactly 5 questions on \"{topic}\".
-    Each question should include:
-      - \"question\": string
-      - \"options\": array of 4 strings
-      - \"answer\": index (0-3)
-      - \"explanation\": short string
-    Difficulty: {difficulty}
-    Output STRICT JSON: an array of 5 objects. Do NOT output anything else.
-    """
-    try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        resp = model.generate_content(prompt)
-        text = resp.text if hasattr(resp, "text") else str(resp)
+    ready = pregen.pop(topic, difficulty)
+    if ready is not None:
+        return jsonify({"ok": True, "questions": ready, "pregenerated": True})
+    cached = quiz_cache.get(topic, difficulty)
+    if cached is not None:
+        top_up_quiz_cache(topic, difficulty)
+        return jsonify({"ok": True, "questions": cached, "cached": True})
+
+    def respond(result):
         try:
-            quiz = json.loads(text)
-        except Exception:
-            import re
-            m = re.search(r"(\[.*\])", text, flags=re.S)
-            if m:
-                quiz = json.loads(m.group(1))
-            else:
-                return jsonify({"ok": False, "error": "Could not parse model output", "raw": text}), 500
-        if not isinstance(quiz, list) or len(quiz) != 5:
-            return jsonify({"ok": False, "error": "Unexpected structure", "raw": text}), 500
-        return jsonify({"ok": True, "questions": quiz})
-    except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+            return jsonify({"ok": True, "questions": result()})
+        except DeadlineExceeded:
+            return jsonify({"ok": False, "error": "Quiz generation timed out, please try again"}), 504
+        except QuizError as e:
+            return jsonify({"ok": False, "error": str(e), "raw": e.raw}), 500
+        except AllProvidersFailed as e:
+            print("Quiz generation failed:", e)
+            return jsonify({"ok": False, "error": "No quiz model is available right now, please try again"}), 503
+        except Exception as e:
+            return jsonify({"ok": False, "error": str(e)}), 500
+
+    key = ("quiz", normalize_key(topic, difficulty))
+    return model_reply(respond, lambda: llm.call(build_quiz, topic, difficulty, key=key),
+                       lambda: abuild_quiz(topic, difficulty), admit(), key=key)
+
+# Streaming variant: each question is sent as an SSE event once it has been
+# generated and validated, so the first one can be shown right away
+@bp.route("/quiz/stream", methods=["POST"])
+def generate_quiz_stream():
+    data = request.get_json(silent=True) or {}
+    topic = (data.get("topic") or "").strip()
+    difficulty = (data.get("difficulty") or "auto").strip().lower()
+    if not topic:
+        return jsonify({"ok": False, "error": "Missing topic"}), 400
+    ready = pregen.pop(topic, difficulty)
+    if ready is None:
+        ready = quiz_cache.get(topic, difficulty)
+        if ready is not None:
+            top_up_quiz_cache(topic, difficulty)
+    ticket = admit() if ready is None else None
+
+    def events():
+        if ready is not None:
+            for q in ready:
+                yield sse_event({"question": q})
+            yield sse_event({"count": len(ready)}, event="done")
+            return
+        quiz = []
+        try:
+            for q in llm.stream(quizgen.stream_quiz, topic, difficulty, stream=quiz_router.stream_text):
+                quiz.append(q)
+                yield sse_event({"question": q})
+        except Exception as e:
+            yield quiz_error_event(e, len(quiz))
+            return
+        quiz_cache.put(topic, difficulty, quiz)
+        yield sse_event({"count": len(quiz)}, event="done")
+
+    async def async_events():
+        quiz = []
+        try:
+            async for q in quizgen.astream_quiz(topic, difficulty, stream=quiz_router.astream_text):
+                quiz.append(q)
+                yield sse_event({"question": q})
+        except Exception as e:
+            yield quiz_error_event(e, len(quiz))
+            return
+        await asgi.run_sync(quiz_cache.put, topic, difficulty, quiz)
+        yield sse_event({"count": len(quiz)}, event="done")
+
+    if ticket is not None and asgi.active():
+        return asgi.DeferredStream(async_events(), ticket)
+    return event_stream(events(), ticket)
+
+def quiz_error_event(e, sent=0):
+    # sent: questions already streamed; "partial" tells the page that the
+    # quiz it has so far is incomplete
+    if isinstance(e, TimeoutError):  # DeadlineExceeded, or a stream that stopped mid-way
+        message = "Quiz generation timed out, please try again"
+    elif isinstance(e, AllProvidersFailed):
+        print("Quiz generation failed:", e)
+        message = "No quiz model is available right now, please try again"
+    else:
+        message = str(e)
+    payload = {"error": message, "partial": sent} if sent else {"error": message}
+    return sse_event(payload, event="error")
+
+# Several topics at once, packed into as few model calls as fit
+@bp.route("/quiz/batch", methods=["POST"])
+def generate_quiz_batch():
+    data = request.get_json(silent=True) or {}
+    topics = data.get("topics")
+    default_difficulty = data.get("difficulty") or "auto"
+    if not isinstance(topics, list) or not isinstance(default_difficulty, str):
+        return jsonify({"ok": False, "error": "topics must be a list of topics"}), 400
+    items = []
+    for entry in topics:
+        if isinstance(entry, dict):
+            topic, difficulty = entry.get("topic") or "", entry.get("difficulty") or default_difficulty
+        else:
+            topic, difficulty = entry, default_difficulty
+        if not isinstance(topic, str) or not isinstance(difficulty, str):
+            return jsonify({"ok": False, "error": "Each topic must be a string or {topic, difficulty}"}), 400
+        if topic.strip():
+            items.append((topic.strip(), difficulty.strip().lower()))
+    items = list(dict.fromkeys(items))
+    if not items:
+        return jsonify({"ok": False, "error": "Missing topics"}), 400
+    if len(items) > 20:
+        return jsonify({"ok": False, "error": "At most 20 topics per batch"}), 400
+
+    done, missing, failed = {}, [], {}
+    for topic, difficulty in items:
+        cached = quiz_cache.get(topic, difficulty)
+        if cached is not None:
+            top_up_quiz_cache(topic, difficulty)
+            done[(topic, difficulty)] = {"topic": topic, "difficulty": difficulty, "questions": cached, "cached": True}
+        else:
+            missing.append((topic, difficulty))
+    if missing:
+        call = lambda prompt: llm.call(quiz_router.complete_text, prompt)
+        with admit():
+            # A pack that runs past its deadline fails on its own; generate_batch
+            # reports its topics in failed with the rest of the errors
+            results, failed = quizgen.generate_batch(missing, call=call)
+        for (topic, difficulty), questions in results.items():
+            quiz_cache.put(topic, difficulty, questions)
+            done[(topic, difficulty)] = {"topic": topic, "difficulty": difficulty, "questions": questions}
+    # Both in request order; the same topic may appear at several difficulties
+    quizzes = [done[item] for item in items if item in done]
+    errors = [{"topic": topic, "difficulty": difficulty, "error": failed[(topic, difficulty)]}
+              for topic, difficulty in items if (topic, difficulty) in failed]
+    return jsonify({"ok": not errors, "quizzes": quizzes, "errors": errors})
+
+@bp.route("/quiz/cache_stats")
+def quiz_cache_stats():
+    return jsonify(quiz_cache.stats())
+
+@bp.route("/quiz/pregen_stats")
+def quiz_pregen_stats():
+    return jsonify(pregen.stats())
+
+@bp.route("/llm/stats")
+def llm_stats():
+    return jsonify(llm.stats())
+
+@bp.route("/llm/router_stats")
+def llm_router_stats():
+    return jsonify({"quiz": quiz_router.stats(), "chat": chat_router.stats()})
+
+@bp.route("/llm/admission_stats")
+def llm_admission_stats():
+    return jsonify(admission_control.stats())
+
+@bp.route("/asgi/stats")
+def asgi_stats():
+    return jsonify(asgi.stats())
+
+# =====================================================
+# Review scheduling (spaced repetition, see reviews.py)
+# =====================================================
+@bp.route("/quiz/answer", methods=["POST"])
+@login_required(api=True)
+def quiz_answer():
+    data = request.get_json(silent=True) or {}
+    topic = (data.get("topic") or "").strip()
+    question = data.get("question")
+    if not topic or not isinstance(question, dict) or not question.get("question"):
+        return jsonify({"ok": False, "error": "Missing topic or question"}), 400
+    quality = data.get("quality")
+    if quality is not None and (not isinstance(quality, int) or not 0 <= quality <= 5):
+        return jsonify({"ok": False, "error": "quality must be an integer from 0 to 5"}), 400
+    with db.engine.begin() as conn:
+        result = reviews.record_answer(conn, g.user.id, topic[:200], question,
+                                       choice=data.get("choice"), quality=quality)
+    return jsonify({"ok": True, **result})
+
+@bp.route("/reviews/due")
+@login_required(api=True)
+def reviews_due():
+    conn = db.session.connection()
+    counts = reviews.due_counts(conn, g.user.id)
+    items = reviews.due_items(conn, g.user.id, topic=request.args.get("topic"), limit=page_size_arg(20))
+    return jsonify({"due": sum(counts.values()), "topics": counts, "items": items})
+
+@bp.cli.command("recompute-reviews")
+def recompute_reviews():
+    """Rebuild every review schedule from the recorded quiz answers."""
+    started = time.perf_counter()
+    updated = reviews.recompute(db.engine)
+    print(f"Updated {updated} review items in {time.perf_counter() - started:.1f}s.")
+
+# =====================================================
+# Static assets
+# =====================================================
+def asset_url(path):
+    # Fingerprinted URL for a file under static/; falls back to the plain one
+    name = current_app.extensions["assets"].name_for(path)
+    if name is None:
+        return url_for('static', filename=path)
+    return url_for('.asset', name=name)
+
+@bp.route("/assets/<path:name>")
+def asset(name):
+    return current_app.extensions["assets"].response(name, request)
+
+@bp.cli.command("build-assets")
+def build_assets():
+    """Fingerprint and precompress static files (also runs before a server's first request)."""
+    manifest = current_app.extensions["assets"]
+    built, reused = manifest.build()
+    print(f"Built {built} assets, {reused} unchanged, into {manifest.build_root}.")
+
+# =====================================================
+# Thumbnails
+# =====================================================
+@bp.route("/thumbs/<size>/<path:path>")
+def thumbnail(size, path):
+    # Attachment paths are content-addressed (or unique per upload), so a
+    # thumbnail URL can be cached forever
+    original = url_for('static', filename='uploads/' + path)
+    if size not in thumbnails.SIZES:
+        return jsonify({"error": "unknown size"}), 404
+    if thumbnails.Image is None:
+        return redirect(original)
+    fmt = "webp" if "image/webp" in request.headers.get("Accept", "") else "jpeg"
+    try:
+        cached = thumbnail_service.get(path, size, fmt)
+    except FileNotFoundError:
+        return jsonify({"error": "not found"}), 404
+    except Exception as e:  # undecodable image, render timeout, ...
+        print(f"Thumbnail {size} of {path} failed: {e}")
+        return redirect(original)
+    response = send_file(cached, mimetype=thumbnails.FORMATS[fmt], max_age=thumbnails.MAX_AGE,
+                         etag=os.path.basename(cached), conditional=True)
+    response.headers["Vary"] = "Accept"
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@bp.route("/thumbs/stats")
+def thumbnail_stats():
+    return jsonify(thumbnail_service.stats())
+
+# Prometheus text format
+@bp.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 # =====================================================
 # Run app
 # =====================================================
 if __name__ == '__main__':
-    with app.app_context():
-        init_db()
     # Run the Flask app normally (SocketIO removed)
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    create_app().run(debug=True, host='0.0.0.0', port=5000)
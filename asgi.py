@@ -0,0 +1,388 @@
+# asgi.py
+# ASGI serving mode: the same Flask app, but calls to the models do not hold
+# a thread while they wait.
+#
+#   uvicorn --factory asgi:create_app --port 5000      (or hypercorn, ...)
+#   python asgi.py --port 5000                          (the same, through uvicorn.run)
+#
+# uvicorn (or another ASGI server) and httpx, for the async Ollama client,
+# are only needed for this mode.
+#
+# Every request still goes through Flask, on a bounded thread pool
+# (ASGI_THREADS): routing, sessions, login, SQLite, caches and admission
+# control work exactly as they do under a WSGI server. The LLM routes then
+# return a DeferredReply or DeferredStream instead of calling the model
+# themselves; the bridge awaits the model on the event loop with the async
+# Gemini and Ollama clients (LLMRouter.acomplete/astream) and only goes back
+# to the pool to build the response and write to the database. A request
+# waiting for a model costs a coroutine, so one process can hold hundreds of
+# them while the pool keeps serving /notes and /dashboard.
+#
+# Under ASGI the default ADMISSION_CONCURRENCY is 256 instead of
+# LLM_MAX_WORKERS, since it no longer counts threads. Request metrics of a
+# deferred route cover the Flask part only; the model call is in the
+# upstream_* metrics.
+import argparse
+import asyncio
+import functools
+import json
+import os
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response, has_request_context, request
+
+import metrics
+from llm_dispatch import DeadlineExceeded
+
+try:
+    import uvicorn
+except ImportError:  # optional: any ASGI server can run create_app
+    uvicorn = None
+
+THREADS = int(os.getenv("ASGI_THREADS", 32))
+ASYNC_ADMISSION_CONCURRENCY = 256
+
+_bridge = None  # the ASGIBridge of this process
+
+metrics.Gauge("asgi_llm_waiting", "Deferred LLM calls being awaited on the event loop",
+              fn=lambda: _bridge.stats()["llm_waiting"] if _bridge else 0)
+metrics.Gauge("asgi_threads_busy", "Pool threads running Flask code",
+              fn=lambda: _bridge.stats()["threads_busy"] if _bridge else 0)
+
+
+def active():
+    # True while a request served through the ASGI bridge is being handled
+    return has_request_context() and "asgi.bridge" in request.environ
+
+
+async def run_sync(fn, *args):
+    # Run blocking code (SQLite, caches) on the bridge's thread pool
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+
+def stats():
+    return _bridge.stats() if _bridge else {"mode": "wsgi"}
+
+
+# =====================================================
+# Deferred responses
+# =====================================================
+# Returned by a view in place of its response. Flask finishes the request as
+# usual (session cookie, after_request hooks); the bridge then takes over.
+class _Deferred(Response):
+    def __call__(self, environ, start_response):
+        environ["asgi.deferred"] = self
+        return super().__call__(environ, start_response)
+
+
+class DeferredReply(_Deferred):
+    # call: coroutine function for the model's answer. respond(result) builds
+    # the real response, where result() returns that answer or raises what the
+    # call raised; it runs on the pool inside an app context. ticket (an
+    # admission.Ticket) is released once the call is over; calls sharing a key
+    # are coalesced, like LLMDispatcher.call(key=...).
+    def __init__(self, call, respond, ticket=None, key=None, timeout=None):
+        super().__init__()
+        self.call = call
+        self.respond = respond
+        self.ticket = ticket
+        self.key = key
+        self.timeout = timeout
+
+
+class DeferredStream(_Deferred):
+    # events: async iterator of Server-Sent Events (str)
+    def __init__(self, events, ticket=None):
+        # An iterator body, so no Content-Length: 0 is added for the placeholder
+        super().__init__(iter(()), mimetype="text/event-stream",
+                         headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        self.events = events
+        self.ticket = ticket
+
+
+def _raiser(exc):
+    def result():
+        raise exc
+    return result
+
+
+# =====================================================
+# WSGI bridge
+# =====================================================
+class _Body:
+    # wsgi.input for a pool thread, pulling the body from the event loop
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b""
+        self._more = True
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message["type"] == "http.disconnect":
+            raise OSError("client disconnected")
+        self._buffer += message.get("body", b"")
+        self._more = message.get("more_body", False)
+
+    def read(self, size=-1):
+        while self._more and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while self._more and b"\n" not in self._buffer and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        end = self._buffer.find(b"\n") + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+def _environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True,  # read() returns b"" at the end, with or without Content-Length
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name, value = name.decode("latin-1").upper().replace("-", "_"), value.decode("latin-1")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+async def _disconnect(receive):
+    # Returns once the client has gone away
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def _start_message(status, headers):
+    return {
+        "type": "http.response.start",
+        "status": int(status.split(" ", 1)[0]),
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    }
+
+
+class ASGIBridge:
+    def __init__(self, wsgi_app, threads=THREADS):
+        self.app = wsgi_app
+        self.threads = threads
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="asgi")
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._inflight = {}  # key -> Task, for coalesced replies
+        self.counts = {"requests": 0, "deferred": 0, "streams": 0, "coalesced": 0, "timeouts": 0}
+        self._waiting = 0
+        self._loop = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            loop.set_default_executor(self._executor)  # for run_sync()
+            self._loop = loop
+        environ = _environ(scope, _Body(receive, loop))
+        environ["asgi.bridge"] = self
+        self.counts["requests"] += 1
+        deferred, start = await loop.run_in_executor(self._executor, self._run_wsgi, environ, send, loop)
+        if isinstance(deferred, DeferredReply):
+            await self._reply(deferred, start, send)
+        elif isinstance(deferred, DeferredStream):
+            await self._stream(deferred, start, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # ---------- Flask, on the pool ----------
+    def _run_wsgi(self, environ, send, loop):
+        # Returns (deferred response or None, start message); plain responses
+        # are sent from here, chunk by chunk
+        with self._lock:
+            self._busy += 1
+        try:
+            start = []
+            body = self.app(environ, lambda status, headers, exc_info=None: start.append((status, headers)))
+            try:
+                deferred = environ.get("asgi.deferred")
+                message = _start_message(*start[-1]) if start else None
+                if deferred is not None:
+                    return deferred, message
+                self._send_body(body, message, send, loop)
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+            return None, None
+        finally:
+            with self._lock:
+                self._busy -= 1
+
+    def _send_body(self, body, start, send, loop):
+        def post(*messages):
+            async def run():
+                for message in messages:
+                    await send(message)
+            asyncio.run_coroutine_threadsafe(run(), loop).result()
+
+        pending = None  # one chunk behind, so the last one goes out with more_body=False
+        try:
+            for chunk in body:
+                if not chunk:
+                    continue
+                if pending is not None:
+                    post(*filter(None, (start, {"type": "http.response.body", "body": pending, "more_body": True})))
+                    start = None
+                pending = chunk
+            post(*filter(None, (start, {"type": "http.response.body", "body": pending or b""})))
+        except OSError:
+            pass  # the client went away; closing the body runs the response's cleanup
+
+    def _respond(self, respond, result):
+        with self._lock:
+            self._busy += 1
+        try:
+            with self.app.app_context():
+                response = self.app.make_response(respond(result))
+                return response.status, list(response.headers.items()), response.get_data()
+        finally:
+            with self._lock:
+                self._busy -= 1
+
+    # ---------- Deferred responses, on the event loop ----------
+    async def _await_call(self, deferred):
+        if deferred.key is None:
+            task = asyncio.ensure_future(deferred.call())
+        else:
+            task = self._inflight.get(deferred.key)
+            if task is not None:
+                self.counts["coalesced"] += 1
+            else:
+                task = self._inflight[deferred.key] = asyncio.ensure_future(deferred.call())
+                task.add_done_callback(lambda t, key=deferred.key: self._inflight.pop(key, None))
+        try:
+            # A shared call keeps running for the other waiters when one gives up
+            return await asyncio.wait_for(asyncio.shield(task) if deferred.key else task, deferred.timeout)
+        except asyncio.TimeoutError:
+            self.counts["timeouts"] += 1
+            raise DeadlineExceeded("LLM call exceeded its deadline")
+
+    async def _reply(self, deferred, start, send):
+        self.counts["deferred"] += 1
+        self._waiting += 1
+        try:
+            value = await self._await_call(deferred)
+            result = lambda: value
+        except Exception as e:
+            result = _raiser(e)
+        finally:
+            self._waiting -= 1
+            if deferred.ticket is not None:
+                deferred.ticket.release()
+        status, headers, body = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._respond, deferred.respond, result)
+        # Cookies and the like come from Flask's handling of the original request
+        headers += [(name, value) for name, value in deferred.headers.items() if name.lower() in ("set-cookie", "vary")]
+        await send(_start_message(status, headers))
+        await send({"type": "http.response.body", "body": body})
+
+    async def _stream(self, deferred, start, receive, send):
+        self.counts["streams"] += 1
+        self._waiting += 1
+        disconnected = asyncio.ensure_future(_disconnect(receive))
+        try:
+            await send(start)
+            async for event in deferred.events:
+                if disconnected.done():
+                    break
+                await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+            if not disconnected.done():
+                await send({"type": "http.response.body", "body": b""})
+        except OSError:
+            pass
+        finally:
+            self._waiting -= 1
+            disconnected.cancel()
+            await deferred.events.aclose()
+            if deferred.ticket is not None:
+                deferred.ticket.release()
+
+    def stats(self):
+        with self._lock:
+            busy = self._busy
+        return {"mode": "asgi", "threads": self.threads, "threads_busy": busy, "llm_waiting": self._waiting,
+                "inflight_keys": len(self._inflight), **self.counts}
+
+
+def create_app(config=None):
+    global _bridge
+    os.environ.setdefault("ADMISSION_CONCURRENCY", str(ASYNC_ADMISSION_CONCURRENCY))
+    import app as app_module
+
+    _bridge = ASGIBridge(app_module.create_app(config))
+    return _bridge
+
+
+# =====================================================
+# Running it
+# =====================================================
+def serve(app, host="127.0.0.1", port=5000, ready=None):
+    # Serve through uvicorn; ready(port) is called once the socket listens
+    # (port=0 picks a free one, for bench.py)
+    if uvicorn is None:
+        raise SystemExit("Serving the ASGI app needs uvicorn (pip install uvicorn), or run it under another "
+                         "ASGI server with the factory asgi:create_app")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)  # connections made before uvicorn starts wait in the backlog
+    if ready is not None:
+        ready(sock.getsockname()[1])
+    config = uvicorn.Config(app, lifespan="on", backlog=1024, access_log=False, log_level="warning")
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the app through the ASGI bridge with uvicorn.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args(argv)
+    serve(create_app(), args.host, args.port, ready=lambda port: print(json.dumps({"port": port}), flush=True))
+
+
+if __name__ == "__main__":
+    main()
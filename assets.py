@@ -0,0 +1,183 @@
+# assets.py
+# Fingerprinted, precompressed static assets.
+#
+# build() copies every file under static/ (except user uploads) into the
+# build folder under a content-hashed name, e.g.
+#
+#   css/style.css  ->  css/style.3f2a9c1b4d5e.css  (+ .gz, + .br)
+#   logo.png       ->  logo.8e61d0a2c7f4.png        (+ .webp)
+#
+# Text assets get gzip (and brotli, if the package is installed) siblings;
+# PNG and JPEG images get a WebP sibling when Pillow is available.
+# manifest.json remembers each source's size and mtime, so a restart only
+# re-hashes files that changed. Templates call asset_url("css/style.css"), and
+# /assets/<name> serves the best variant the client accepts with immutable,
+# year-long cache headers, so repeat page loads make no static requests.
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import tempfile
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # optional: images are served as-is
+    Image = None
+
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt", ".map"}
+OPTIMIZABLE = {".png", ".jpg", ".jpeg"}
+SKIP_DIRS = {"uploads"}  # user content, not build inputs
+MAX_AGE = 365 * 24 * 3600
+MIN_SAVING = 0.95  # keep a variant only if it is at least 5% smaller
+
+
+def _write_atomic(path, data):
+    # Several workers may build at once; readers never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def _sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class AssetManifest:
+    def __init__(self, static_root, build_root):
+        self.static_root = static_root
+        self.build_root = build_root
+        self.entries = {}   # source path -> entry
+        self._by_name = {}  # built name -> entry
+        self._manifest_path = os.path.join(build_root, "manifest.json")
+
+    # ---------- Build ----------
+    def _sources(self):
+        for root, dirs, files in os.walk(self.static_root):
+            rel_root = os.path.relpath(root, self.static_root)
+            dirs[:] = [d for d in dirs if not d.startswith(".") and
+                       not (rel_root == "." and d in SKIP_DIRS)]
+            for filename in files:
+                if not filename.startswith("."):
+                    full = os.path.join(root, filename)
+                    yield os.path.relpath(full, self.static_root).replace(os.sep, "/"), full
+
+    def _build_one(self, path, full, st):
+        digest = _sha256(full)
+        base, ext = os.path.splitext(path)
+        ext = ext.lower()
+        name = f"{base}.{digest[:12]}{ext}"
+        target = os.path.join(self.build_root, *name.split("/"))
+        entry = {
+            "name": name, "hash": digest, "size": st.st_size, "mtime": st.st_mtime,
+            "type": mimetypes.guess_type(path)[0] or "application/octet-stream",
+            "encodings": [], "webp": False,
+        }
+        with open(full, "rb") as f:
+            data = f.read()
+        if not os.path.exists(target):
+            _write_atomic(target, data)
+        if ext in OPTIMIZABLE and Image is not None:
+            entry["webp"] = self._add_webp(data, target)
+        if ext in COMPRESSIBLE:
+            variants = [("gzip", ".gz", lambda d: gzip.compress(d, 9, mtime=0))]
+            if brotli is not None:
+                variants.insert(0, ("br", ".br", lambda d: brotli.compress(d, quality=11)))
+            for encoding, suffix, compress in variants:
+                if os.path.exists(target + suffix):
+                    entry["encodings"].append(encoding)
+                    continue
+                packed = compress(data)
+                if len(packed) < len(data) * MIN_SAVING:
+                    _write_atomic(target + suffix, packed)
+                    entry["encodings"].append(encoding)
+        return entry
+
+    def _add_webp(self, data, target):
+        # Returns whether a .webp sibling exists. method=4 is ~30x faster than
+        # method=6 for the same size within a few percent.
+        if os.path.exists(target + ".webp"):
+            return True
+        try:
+            with Image.open(io.BytesIO(data)) as im:
+                buf = io.BytesIO()
+                im.save(buf, "WEBP", quality=82, method=4)
+        except (OSError, ValueError) as e:
+            print(f"Could not convert {target} to WebP: {e}")
+            return False
+        if buf.tell() >= len(data) * MIN_SAVING:
+            return False
+        _write_atomic(target + ".webp", buf.getvalue())
+        return True
+
+    def build(self):
+        # Returns (built, reused) counts
+        try:
+            with open(self._manifest_path) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = {}
+        entries, built, reused = {}, 0, 0
+        for path, full in self._sources():
+            st = os.stat(full)
+            old = previous.get(path)
+            if (old and old["size"] == st.st_size and old["mtime"] == st.st_mtime
+                    and os.path.exists(os.path.join(self.build_root, *old["name"].split("/")))):
+                entries[path] = old
+                reused += 1
+            else:
+                entries[path] = self._build_one(path, full, st)
+                built += 1
+        if entries != previous:
+            _write_atomic(self._manifest_path, json.dumps(entries, indent=1, sort_keys=True).encode())
+        self.entries = entries
+        self._by_name = {e["name"]: e for e in entries.values()}
+        return built, reused
+
+    # ---------- Lookup and serving ----------
+    def name_for(self, path):
+        entry = self.entries.get(path)
+        return entry["name"] if entry else None
+
+    def response(self, name, request):
+        from flask import abort, send_file
+
+        entry = self._by_name.get(name)
+        if entry is None:
+            abort(404)
+        path = os.path.join(self.build_root, *name.split("/"))
+        mimetype, variant, encoding = entry["type"], "id", None
+        vary = []
+        if entry["webp"]:
+            vary.append("Accept")
+            if "image/webp" in request.headers.get("Accept", ""):
+                path, mimetype, variant = path + ".webp", "image/webp", "webp"
+        if entry["encodings"]:
+            vary.append("Accept-Encoding")
+            accepted = request.headers.get("Accept-Encoding", "")
+            for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+                if candidate in entry["encodings"] and candidate in accepted:
+                    path, encoding, variant = path + suffix, candidate, candidate
+                    break
+        response = send_file(path, mimetype=mimetype, max_age=MAX_AGE, etag=f"{entry['hash'][:20]}-{variant}",
+                             conditional=True)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if vary:
+            response.headers["Vary"] = ", ".join(vary)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
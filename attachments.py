@@ -0,0 +1,93 @@
+# attachments.py
+# Content-addressed attachment storage. Uploads are hashed (SHA-256) while
+# they stream to a temp file, then stored once under a sharded layout:
+#
+#   static/uploads/ab/cd/abcd1234...ef.pdf
+#
+# Reference counting lives in the database (see AttachmentBlob in app.py);
+# this module only deals with the files.
+import hashlib
+import os
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StagedFile:
+    def __init__(self, tmp_path, digest, ext, size):
+        self.tmp_path = tmp_path
+        self.digest = digest
+        self.ext = ext
+        self.size = size
+
+    @property
+    def path(self):
+        # Path relative to the uploads folder, also what Note.attachment stores
+        return f"{self.digest[:2]}/{self.digest[2:4]}/{self.digest}{self.ext}"
+
+
+class AttachmentStore:
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, ".tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def full_path(self, path):
+        return os.path.join(self.root, *path.split("/"))
+
+    def stage(self, stream, ext):
+        # Copy the upload to a temp file in chunks, hashing as we go
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return StagedFile(tmp_path, sha.hexdigest(), ext.lower(), size)
+
+    def commit(self, staged):
+        # Called after the database commit that took the reference
+        target = self.full_path(staged.path)
+        if os.path.exists(target):
+            os.remove(staged.tmp_path)
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(staged.tmp_path, target)
+
+    def discard(self, staged):
+        if staged and os.path.exists(staged.tmp_path):
+            os.remove(staged.tmp_path)
+
+    def remove(self, path):
+        target = self.full_path(path)
+        if os.path.exists(target):
+            os.remove(target)
+        # Tidy up empty shard directories
+        for parent in (os.path.dirname(target), os.path.dirname(os.path.dirname(target))):
+            if parent != self.root:
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+
+    def adopt(self, path):
+        # Move a legacy flat upload (uuid name) into the content-addressed layout
+        source = self.full_path(path)
+        sha = hashlib.sha256()
+        size = 0
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+                size += len(chunk)
+        staged = StagedFile(source, sha.hexdigest(), os.path.splitext(path)[1].lower(), size)
+        self.commit(staged)  # renames (or drops, if already stored) the legacy file
+        return staged
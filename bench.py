@@ -0,0 +1,448 @@
+# bench.py
+# Load test for the Flask app, run against local stand-ins for Gemini and
+# Ollama (fake_llm.py) and a freshly seeded SQLite database:
+#
+#   python bench.py run --concurrency 1,8,32 --duration 20 --out before.json
+#   python bench.py compare before.json after.json
+#
+# "run" starts the app in a child process ("python bench.py serve") with the
+# fakes installed and the database, uploads, assets, thumbnails and embedding
+# index all in a temp directory, so the dev instance is never touched. Each
+# worker thread logs in as one of the seeded users and then sends a weighted
+# mix of requests. The report has throughput and p50/p95/p99 latency per
+# route for every concurrency level, plus the app's own LLM and cache stats,
+# as JSON. Requests turned away by admission control (429) are counted as
+# "throttled", not as errors; set the ADMISSION_* variables to change the
+# limits the server runs with.
+#
+# --server asgi runs the app through asgi.py under uvicorn (needs uvicorn and
+# httpx) instead of the threaded WSGI server, so the two modes can be
+# compared on the same mix:
+#
+#   python bench.py run --concurrency 32,256 --out threaded.json
+#   python bench.py run --concurrency 32,256 --server asgi --out asgi.json
+#   python bench.py compare threaded.json asgi.json
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+from llm_dispatch import percentile
+
+PASSWORD = "bench-password"
+SUBJECTS = ["Math", "Science", "History", "English", "Biology", "Chemistry"]
+TOPICS = [
+    "photosynthesis", "world war 2", "linear algebra", "french revolution", "cell biology",
+    "thermodynamics", "shakespeare", "probability", "plate tectonics", "organic chemistry",
+    "the cold war", "calculus limits", "genetics", "electric circuits", "poetry",
+    "ancient rome", "statistics", "the water cycle", "python basics", "microeconomics",
+]
+WORDS = (
+    "study exam review chapter summary formula theory practice lecture notes question answer "
+    "definition example proof energy cell history war equation graph model reaction essay"
+).split()
+# Route name -> weight in the default mix
+DEFAULT_MIX = {"login": 2, "dashboard": 15, "spin": 15, "notes": 25, "add": 8, "quiz": 15, "chat_ai": 20}
+
+
+# =====================================================
+# Server side (child process)
+# =====================================================
+def seed(app_module, app, users, notes_per_user):
+    from sqlalchemy import text
+
+    import search
+
+    db = app_module.db
+    rng = random.Random(1)
+    with app.app_context():
+        if db.session.execute(text("SELECT COUNT(*) FROM user")).scalar():
+            return
+        # One bcrypt hash for everybody: seeding should not take minutes
+        password = app_module.bcrypt.generate_password_hash(PASSWORD).decode("utf-8")
+        db.session.execute(
+            text("INSERT INTO user (id, username, password) VALUES (:id, :username, :password)"),
+            [{"id": i, "username": f"bench{i}", "password": password} for i in range(1, users + 1)],
+        )
+        db.session.execute(
+            text("INSERT INTO subject (name, user_id) VALUES (:name, :user_id)"),
+            [{"name": name, "user_id": i} for i in range(1, users + 1) for name in rng.sample(SUBJECTS, 4)],
+        )
+        db.session.execute(
+            text("INSERT INTO note (title, content, user_id) VALUES (:title, :content, :user_id)"),
+            [
+                {
+                    "title": f"Note {n} on {rng.choice(TOPICS)}",
+                    "content": " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 200))),
+                    "user_id": i,
+                }
+                for i in range(1, users + 1) for n in range(notes_per_user)
+            ],
+        )
+        search.rebuild(db.session.connection())
+        db.session.commit()
+
+
+def serve(args):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    from fake_llm import FakeGemini, FakeOllamaServer
+
+    FakeGemini(
+        latency=args.gemini_latency, token_delay=args.token_delay,
+        error_rate=args.error_rate if args.gemini_error_rate is None else args.gemini_error_rate,
+        slow_rate=args.gemini_slow_rate, slow_latency=args.gemini_slow_latency,
+    ).install()
+    ollama = FakeOllamaServer(
+        reply="Here is a short fake answer to your study question, one token at a time.",
+        latency=args.ollama_latency, token_delay=args.token_delay, error_rate=args.error_rate,
+    ).start()
+    os.environ["OLLAMA_HOST"] = ollama.url
+
+    if args.server == "asgi":
+        import asgi
+        import app as app_module
+
+        bridge = asgi.create_app()
+        seed(app_module, bridge.app, args.users, args.notes_per_user)
+        asgi.serve(bridge, port=0, ready=lambda port: print(json.dumps({"port": port}), flush=True))
+        return
+
+    import app as app_module
+
+    app = app_module.create_app()
+    seed(app_module, app, args.users, args.notes_per_user)
+
+    class Handler(WSGIRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive between benchmark requests
+
+        def log_request(self, *a, **kw):
+            pass
+
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=Handler)
+    print(json.dumps({"port": server.port}), flush=True)
+    server.serve_forever()
+
+
+# =====================================================
+# Client side
+# =====================================================
+class Client:
+    # One keep-alive connection and cookie jar per simulated user
+    def __init__(self, base_url, timeout=60):
+        url = urlsplit(base_url)
+        self.conn = http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+        self.cookies = {}
+        self.last_status = None
+
+    def request(self, method, path, form=None, json_body=None):
+        headers = {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif json_body is not None:
+            body = json.dumps(json_body)
+            headers["Content-Type"] = "application/json"
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            resp = self.conn.getresponse()
+            data = resp.read()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()  # reconnects on the next request
+            raise
+        self.last_status = resp.status
+        for header in resp.headers.get_all("Set-Cookie") or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        return resp.status, data
+
+    def login(self, username):
+        status, _ = self.request("POST", "/login", form={"username": username, "password": PASSWORD})
+        return status == 302 and "session" in self.cookies
+
+
+def _json_ok(data, check):
+    try:
+        return check(json.loads(data))
+    except ValueError:
+        return False
+
+
+# Route name -> fn(client, rng) returning True on success
+ROUTES = {
+    "dashboard": lambda c, rng: c.request("GET", "/dashboard")[0] == 200,
+    "notes": lambda c, rng: c.request("GET", "/notes")[0] == 200,
+    "spin": lambda c, rng: _json_ok(c.request("GET", "/spin")[1], lambda d: "subject" in d),
+    "add": lambda c, rng: c.request("POST", "/add", form={
+        "title": f"Bench note {rng.randrange(10**6)}",
+        "content": " ".join(rng.choice(WORDS) for _ in range(50)),
+    })[0] == 302,
+    "quiz": lambda c, rng: _json_ok(c.request("POST", "/quiz", json_body={
+        "topic": rng.choice(TOPICS), "difficulty": rng.choice(["auto", "easy", "hard"]),
+    })[1], lambda d: d.get("ok")),
+    "chat_ai": lambda c, rng: _json_ok(c.request("POST", "/chat_ai", json_body={
+        "message": f"Explain {rng.choice(TOPICS)} briefly",
+    })[1], lambda d: not d.get("reply", "Error").startswith("Error")),
+}
+
+
+def run_level(base_url, concurrency, duration, mix, users, seed_value):
+    samples = defaultdict(list)  # route -> [(seconds, outcome)], outcome True, False or "throttled"
+    lock = threading.Lock()
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    logged_in = threading.Barrier(concurrency + 1)
+    go = threading.Event()
+    stop_at = [0.0]
+
+    def worker(n):
+        rng = random.Random(seed_value * 1000 + n)
+        client = Client(base_url)
+        username = f"bench{n % users + 1}"
+        client.login(username)
+        logged_in.wait()
+        go.wait()
+        local = defaultdict(list)
+        while time.monotonic() < stop_at[0]:
+            route = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                if route == "login":
+                    ok = client.login(username)
+                else:
+                    ok = ROUTES[route](client, rng)
+            except Exception:
+                ok = False
+            if not ok and client.last_status == 429:
+                ok = "throttled"
+            local[route].append((time.perf_counter() - started, ok))
+        with lock:
+            for route, values in local.items():
+                samples[route].extend(values)
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    logged_in.wait()
+    started = time.monotonic()
+    stop_at[0] = started + duration
+    go.set()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+
+    routes = {}
+    for route, values in sorted(samples.items()):
+        times = sorted(v for v, _ in values)
+        routes[route] = {
+            "requests": len(values),
+            "errors": sum(1 for _, ok in values if not ok),
+            "throttled": sum(1 for _, ok in values if ok == "throttled"),
+            "rps": round(len(values) / elapsed, 2),
+            "mean_ms": round(sum(times) / len(times) * 1000, 2),
+            "p50_ms": round(percentile(times, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(times, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(times, 0.99) * 1000, 2),
+            "max_ms": round(times[-1] * 1000, 2),
+        }
+    total = sum(r["requests"] for r in routes.values())
+    return {
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 2),
+        "requests": total,
+        "errors": sum(r["errors"] for r in routes.values()),
+        "throttled": sum(r["throttled"] for r in routes.values()),
+        "throughput_rps": round(total / elapsed, 2),
+        "routes": routes,
+    }
+
+
+def server_stats(base_url):
+    client = Client(base_url)
+    stats = {}
+    for name, path in (("llm", "/llm/stats"), ("quiz_cache", "/quiz/cache_stats"), ("pregen", "/quiz/pregen_stats"),
+                       ("admission", "/llm/admission_stats"), ("asgi", "/asgi/stats")):
+        try:
+            status, data = client.request("GET", path)
+            stats[name] = json.loads(data) if status == 200 else None
+        except (OSError, ValueError):
+            stats[name] = None
+    return stats
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(args, workdir):
+    env = dict(os.environ)
+    env.update({
+        # Every path the app would otherwise put under instance/ or static/
+        "DATABASE_URL": "sqlite:///" + os.path.join(workdir, "bench.db"),
+        "UPLOAD_FOLDER": os.path.join(workdir, "uploads"),
+        "ASSETS_DIR": os.path.join(workdir, "assets"),
+        "THUMBNAIL_DIR": os.path.join(workdir, "thumbnails"),
+        "EMBEDDINGS_DIR": os.path.join(workdir, "embeddings"),
+        "SECRET_KEY": "bench",
+        "GEMINI_API_KEY": env.get("GEMINI_API_KEY") or "bench",
+        "PYTHONUNBUFFERED": "1",
+    })
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "serve",
+        "--users", str(args.users), "--notes-per-user", str(args.notes_per_user),
+        "--gemini-latency", str(args.gemini_latency), "--ollama-latency", str(args.ollama_latency),
+        "--token-delay", str(args.token_delay), "--error-rate", str(args.error_rate),
+        "--gemini-slow-rate", str(args.gemini_slow_rate), "--gemini-slow-latency", str(args.gemini_slow_latency),
+        "--server", args.server,
+    ]
+    if args.gemini_error_rate is not None:
+        cmd += ["--gemini-error-rate", str(args.gemini_error_rate)]
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, text=True)
+    # The app prints migration notes first; the port comes as a JSON line
+    for line in proc.stdout:
+        if line.startswith("{"):
+            return proc, f"http://127.0.0.1:{json.loads(line)['port']}"
+    raise RuntimeError(f"Benchmark server exited with code {proc.wait()}")
+
+
+def run(args):
+    mix = dict(DEFAULT_MIX)
+    for part in filter(None, (args.mix or "").split(",")):
+        name, _, weight = part.partition("=")
+        if name not in mix:
+            raise SystemExit(f"Unknown route in --mix: {name}")
+        mix[name] = float(weight)
+    mix = {name: weight for name, weight in mix.items() if weight > 0}
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    proc = None
+    try:
+        if args.url:
+            base_url = args.url
+        else:
+            proc, base_url = start_server(args, workdir)
+        levels = []
+        for concurrency in (int(c) for c in args.concurrency.split(",")):
+            if args.warmup:
+                run_level(base_url, concurrency, args.warmup, mix, args.users, seed_value=0)
+            level = run_level(base_url, concurrency, args.duration, mix, args.users, seed_value=concurrency)
+            level["server"] = server_stats(base_url)
+            levels.append(level)
+            print(f"concurrency {concurrency}: {level['throughput_rps']} req/s, "
+                  f"{level['errors']} errors, {level['throttled']} throttled", file=sys.stderr)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "revision": git_revision(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k != "func"},
+        "mix": mix,
+        "levels": levels,
+    }
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    def label(report):
+        return f"{report.get('revision')} ({report.get('config', {}).get('server', 'threaded')})"
+
+    old_levels = {level["concurrency"]: level for level in before["levels"]}
+    print(f"{label(before)} -> {label(after)}")
+    for level in after["levels"]:
+        old = old_levels.get(level["concurrency"])
+        if old is None:
+            continue
+        print(f"\nconcurrency {level['concurrency']}: {old['throughput_rps']} -> {level['throughput_rps']} req/s "
+              f"({change(old['throughput_rps'], level['throughput_rps'])})")
+        print(f"  {'route':<10} {'p50 ms':>18} {'p95 ms':>18} {'p99 ms':>18} {'errors':>9} {'throttled':>11}")
+        for route, new in level["routes"].items():
+            prev = old["routes"].get(route)
+            if prev is None:
+                continue
+            cells = [f"{prev[k]:.0f}->{new[k]:.0f} {change(prev[k], new[k]):>7}" for k in ("p50_ms", "p95_ms", "p99_ms")]
+            throttled = f"{prev.get('throttled', 0)}->{new.get('throttled', 0)}"
+            print(f"  {route:<10} {cells[0]:>18} {cells[1]:>18} {cells[2]:>18} {prev['errors']:>4}->{new['errors']:<4} "
+                  f"{throttled:>11}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the study planner against fake LLM backends.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def backend_options(p):
+        p.add_argument("--users", type=int, default=50)
+        p.add_argument("--notes-per-user", type=int, default=200)
+        p.add_argument("--gemini-latency", type=float, default=0.5, help="seconds before Gemini answers")
+        p.add_argument("--ollama-latency", type=float, default=0.2, help="seconds before the first Ollama token")
+        p.add_argument("--token-delay", type=float, default=0.01, help="seconds between streamed tokens")
+        p.add_argument("--error-rate", type=float, default=0.0, help="share of upstream calls that fail (0..1)")
+        # A degraded Gemini, to watch the router hedge and fall back to Ollama
+        p.add_argument("--gemini-error-rate", type=float, help="override --error-rate for Gemini only")
+        p.add_argument("--gemini-slow-rate", type=float, default=0.0, help="share of Gemini calls that are slow")
+        p.add_argument("--gemini-slow-latency", type=float, default=5.0, help="seconds a slow Gemini call takes")
+        p.add_argument("--server", choices=("threaded", "asgi"), default="threaded",
+                       help="serve through the threaded WSGI server or the ASGI bridge (asgi.py)")
+
+    p = sub.add_parser("run", help="run the benchmark and print or save a JSON report")
+    backend_options(p)
+    p.add_argument("--concurrency", default="1,8,32", help="comma-separated worker counts")
+    p.add_argument("--duration", type=float, default=15.0, help="seconds per concurrency level")
+    p.add_argument("--warmup", type=float, default=2.0, help="unrecorded seconds before each level")
+    p.add_argument("--mix", help="route weights, e.g. notes=50,quiz=0 (routes: %s)" % ", ".join(DEFAULT_MIX))
+    p.add_argument("--url", help="benchmark an already running server instead of starting one")
+    p.add_argument("--out", help="write the JSON report here instead of stdout")
+    p.set_defaults(func=run)
+
+    p = sub.add_parser("serve", help="(internal) run the app with fake backends")
+    backend_options(p)
+    p.set_defaults(func=serve)
+
+    p = sub.add_parser("compare", help="compare two JSON reports")
+    p.add_argument("before")
+    p.add_argument("after")
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
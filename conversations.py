@@ -0,0 +1,189 @@
+# conversations.py
+# Per-session chat memory for /chat_ai with a bounded prompt.
+#
+# Turns are stored in chat_turn. A prompt is built from
+#
+#   system message (+ running summary of older turns)
+#   the most recent turns that fit in the token budget
+#   the new user message (with any note excerpts it carries)
+#
+# The system message, summary and new message are counted first; the turns
+# get what is left of the budget, and only as many of the newest turns are
+# read as could possibly fit. When some stored turns no longer fit, the
+# oldest ones are folded into the summary by a background thread (one model
+# call) and deleted, which leaves the turns at half the budget. While the
+# stored turns fit, the prompt only grows at the end, so Ollama can reuse its
+# evaluated prefix and only processes the newest turn (see OllamaClient.chat).
+# Calls made after they outgrow the budget but before the compaction lands
+# (or after it failed) get a window that slides from the front instead, and
+# Ollama re-evaluates the whole prompt for them. Either way the prompt stays
+# within the budget, unless the system message and new message alone are
+# larger than it.
+#
+# Token counts are estimates (about 4 characters per token), which is all the
+# budget needs.
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+SYSTEM_PROMPT = "You are a friendly study assistant. Answer clearly and concisely."
+MESSAGE_OVERHEAD = 4  # role markers etc. per message
+
+
+def estimate_tokens(value):
+    return len(value) // 4 + MESSAGE_OVERHEAD
+
+
+class ConversationMemory:
+    def __init__(self, engine, summarize, budget=None, summary_budget=None):
+        # summarize(previous summary, [(role, content)]) -> new summary text
+        self.engine = engine
+        self.summarize = summarize
+        self.budget = int(budget or os.getenv("CHAT_HISTORY_TOKENS", 1500))
+        self.summary_budget = int(summary_budget or os.getenv("CHAT_SUMMARY_TOKENS", 300))
+        self._executor = None
+        self._compacting = set()
+        self._lock = threading.Lock()
+        self.compactions = 0
+        self.compaction_errors = 0
+        self.folded_turns = 0
+
+    @staticmethod
+    def new_id():
+        return secrets.token_urlsafe(16)
+
+    # ---------- Prompt ----------
+    def messages(self, conversation_id, user_message, system=SYSTEM_PROMPT):
+        # The chat messages for the next call; user_message may carry extra
+        # context (note excerpts) that is not kept in the history
+        with self.engine.connect() as conn:
+            summary = conn.execute(
+                text("SELECT summary FROM chat_summary WHERE conversation_id = :id"), {"id": conversation_id}
+            ).scalar()
+            if summary:
+                system = f"{system}\n\nSummary of the conversation so far:\n{summary}"
+            available = max(0, self.budget - estimate_tokens(system) - estimate_tokens(user_message))
+            # Every turn costs at least MESSAGE_OVERHEAD, so one row more than
+            # this tells whether anything was left out. Folded turns are
+            # deleted, so all stored turns come after the summary.
+            turns = conn.execute(
+                text("SELECT role, content, tokens FROM chat_turn WHERE conversation_id = :id "
+                     "ORDER BY id DESC LIMIT :limit"),
+                {"id": conversation_id, "limit": available // MESSAGE_OVERHEAD + 1},
+            ).all()
+        # The newest turns that fit; once the turns outgrow the budget this
+        # drops old ones from the front until the pending compaction lands
+        window, used = [], 0
+        for turn in turns:
+            if used + turn.tokens > available:
+                break
+            window.append({"role": turn.role, "content": turn.content})
+            used += turn.tokens
+        left_out = len(window) < len(turns)
+        window.reverse()
+        if window and window[0]["role"] == "assistant":
+            window.pop(0)  # an answer without its question only confuses the model
+        if left_out:
+            self._compact_later(conversation_id)
+        return [{"role": "system", "content": system}] + window + [{"role": "user", "content": user_message}]
+
+    def record(self, conversation_id, user_id, user_message, reply):
+        now = time.time()
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("INSERT INTO chat_turn (conversation_id, user_id, role, content, tokens, created_at) "
+                     "VALUES (:id, :user_id, :role, :content, :tokens, :now)"),
+                [{"id": conversation_id, "user_id": user_id, "role": role, "content": content,
+                  "tokens": estimate_tokens(content), "now": now}
+                 for role, content in (("user", user_message), ("assistant", reply))],
+            )
+
+    def forget(self, conversation_id):
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM chat_turn WHERE conversation_id = :id"), {"id": conversation_id})
+            conn.execute(text("DELETE FROM chat_summary WHERE conversation_id = :id"), {"id": conversation_id})
+
+    # ---------- Compaction ----------
+    def _compact_later(self, conversation_id):
+        with self._lock:
+            if conversation_id in self._compacting:
+                return
+            self._compacting.add(conversation_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
+        self._executor.submit(self._compact, conversation_id)
+
+    def _compact(self, conversation_id):
+        try:
+            self.compact(conversation_id)
+        except Exception as e:
+            self.compaction_errors += 1
+            print("Chat summary failed:", e)
+        finally:
+            with self._lock:
+                self._compacting.discard(conversation_id)
+
+    def compact(self, conversation_id):
+        # Fold the oldest turns into the summary until the rest fit in half the budget
+        with self.engine.connect() as conn:
+            summary = conn.execute(
+                text("SELECT summary FROM chat_summary WHERE conversation_id = :id"), {"id": conversation_id}
+            ).scalar() or ""
+            turns = conn.execute(
+                text("SELECT id, role, content, tokens FROM chat_turn WHERE conversation_id = :id ORDER BY id"),
+                {"id": conversation_id},
+            ).all()
+        remaining = sum(t.tokens for t in turns)
+        folded = []
+        for turn in turns:
+            if remaining <= self.budget // 2:
+                break
+            folded.append(turn)
+            remaining -= turn.tokens
+        if folded and folded[-1].role == "user" and len(folded) < len(turns):
+            folded.append(turns[len(folded)])  # keep question and answer together
+        if not folded:
+            return 0
+        new_summary = self.summarize(summary, [(t.role, t.content) for t in folded])
+        new_summary = new_summary.strip()[: self.summary_budget * 4]
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("INSERT INTO chat_summary (conversation_id, summary, turns, updated_at) "
+                     "VALUES (:id, :summary, :turns, :now) "
+                     "ON CONFLICT(conversation_id) DO UPDATE SET summary = excluded.summary, "
+                     "turns = chat_summary.turns + excluded.turns, updated_at = excluded.updated_at"),
+                {"id": conversation_id, "summary": new_summary, "turns": len(folded), "now": time.time()},
+            )
+            conn.execute(
+                text("DELETE FROM chat_turn WHERE conversation_id = :id AND id <= :last"),
+                {"id": conversation_id, "last": folded[-1].id},
+            )
+        self.compactions += 1
+        self.folded_turns += len(folded)
+        return len(folded)
+
+    def stats(self):
+        with self._lock:
+            compacting = len(self._compacting)
+        return {
+            "budget_tokens": self.budget,
+            "summary_budget_tokens": self.summary_budget,
+            "compacting": compacting,
+            "compactions": self.compactions,
+            "compaction_errors": self.compaction_errors,
+            "folded_turns": self.folded_turns,
+        }
+
+
+def summary_prompt(summary, turns):
+    transcript = "\n".join(f"{role.capitalize()}: {content}" for role, content in turns)
+    previous = f"Summary so far:\n{summary}\n\n" if summary else ""
+    return (
+        f"{previous}New messages:\n{transcript}\n\n"
+        "Write an updated summary of this study conversation in at most 150 words. Keep the topics, "
+        "facts the student asked about and anything they said about themselves. Reply with the summary only."
+    )
@@ -0,0 +1,401 @@
+# embeddings.py
+# Vector index over note text (title, content and extracted attachment text)
+# used to ground /chat_ai answers in the user's own notes.
+#
+# Notes are split into overlapping word windows ("chunks"). The chunk rows
+# live in the note_chunk table and are written in the same transaction as the
+# note (mapper events, like search.py). Their vectors live in a float32
+# memory-mapped matrix, row = chunk id, next to an int32 owner column:
+#
+#   instance/embeddings/vectors.f32   (capacity x DIM)
+#   instance/embeddings/owners.i32    (capacity; 0 = free row)
+#
+# Rows are written after the transaction commits, so a rolled back edit never
+# reaches the files. Every worker process maps the same files shared, so an
+# update made by one is visible to all, and a search is a single matrix-vector
+# product over the mapped rows (a few ms for 100k chunks).
+#
+# The embedder is a signed feature-hashing of words and word pairs: purely
+# lexical, but local, deterministic and dependency-free apart from NumPy.
+# Anything with the same embed(texts) -> (n, dim) unit-vector interface can
+# replace it; the index rebuilds itself when the embedder or size changes.
+import fcntl
+import json
+import os
+import re
+import zlib
+
+from sqlalchemy import Column, Integer, MetaData, Table, Text, event, insert, inspect, text
+from sqlalchemy.orm import Session, object_session
+
+try:
+    import numpy as np
+except ImportError:  # optional: chat then runs without note context
+    np = None
+
+DIM = int(os.getenv("EMBEDDING_DIM", 256))
+CHUNK_WORDS = 120
+CHUNK_OVERLAP = 20
+MAX_CHUNKS = 64  # per note; long attachments are only indexed from the start
+GROW_ROWS = 4096
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+STOPWORDS = frozenset(
+    "a an and are as at be been but by can do does for from had has have how i if in into is it its "
+    "me my no not of on or our so that the their them then there these they this to was we were what "
+    "when where which who why will with you your".split()
+)
+
+
+# =====================================================
+# Chunking and embedding
+# =====================================================
+def chunk_note(title, content, attachment_text=None):
+    # Returns the chunk texts for one note, in order
+    words = " ".join(part for part in (content, attachment_text) if part).split()
+    step = CHUNK_WORDS - CHUNK_OVERLAP
+    chunks = []
+    for start in range(0, max(len(words), 1), step):
+        piece = " ".join(words[start:start + CHUNK_WORDS])
+        if piece or not chunks:
+            chunks.append(f"{title or ''}\n{piece}".strip())
+        if start + CHUNK_WORDS >= len(words) or len(chunks) >= MAX_CHUNKS:
+            break
+    return [c for c in chunks if c]
+
+
+def _terms(value):
+    words = []
+    for word in _WORD.findall(value.lower()):
+        if word in STOPWORDS or len(word) < 2:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]  # crude plural folding: "notes" ~ "note"
+        words.append(word)
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class HashingEmbedder:
+    name = "hashing-v1"
+
+    def __init__(self, dim=DIM):
+        self.dim = dim
+
+    def embed(self, texts):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, value in enumerate(texts):
+            hashes = np.fromiter((zlib.crc32(t.encode("utf-8")) for t in _terms(value)), dtype=np.uint32)
+            if not hashes.size:
+                continue
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+            vector = np.bincount(hashes % self.dim, weights=signs, minlength=self.dim)
+            # Sublinear term frequency, then unit length so dot product = cosine
+            vector = np.sign(vector) * np.log1p(np.abs(vector))
+            norm = np.linalg.norm(vector)
+            if norm:
+                out[row] = vector / norm
+        return out
+
+
+# =====================================================
+# Index files
+# =====================================================
+class EmbeddingIndex:
+    def __init__(self, directory, embedder=None):
+        self.directory = directory
+        self.embedder = embedder or HashingEmbedder()
+        self.dim = self.embedder.dim
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._owners_path = os.path.join(directory, "owners.i32")
+        self.vectors = None
+        self.owners = None
+        self.capacity = 0
+        self.searches = 0
+        self.updates = 0
+        os.makedirs(directory, exist_ok=True)
+        self._check_meta()
+        self._map()
+
+    def _check_meta(self):
+        # Start over if the files were written by a different embedder
+        meta_path = os.path.join(self.directory, "meta.json")
+        meta = {"embedder": self.embedder.name, "dim": self.dim}
+        try:
+            with open(meta_path) as f:
+                if json.load(f) == meta:
+                    return
+        except (OSError, ValueError):
+            pass
+        with self._locked():
+            for path in (self._vectors_path, self._owners_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+
+    def _locked(self):
+        # Cross-process lock for growing and resetting the files
+        return _FileLock(os.path.join(self.directory, ".lock"))
+
+    def _map(self):
+        rows = os.path.getsize(self._owners_path) // 4 if os.path.exists(self._owners_path) else 0
+        if rows == self.capacity and self.vectors is not None:
+            return
+        if rows == 0:
+            self.vectors, self.owners, self.capacity = None, None, 0
+            return
+        self.vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(rows, self.dim))
+        self.owners = np.memmap(self._owners_path, dtype=np.int32, mode="r+", shape=(rows,))
+        self.capacity = rows
+
+    def _ensure_capacity(self, rows):
+        self._map()  # another process may already have grown the files
+        if rows <= self.capacity:
+            return
+        with self._locked():
+            current = os.path.getsize(self._owners_path) // 4 if os.path.exists(self._owners_path) else 0
+            if rows > current:
+                target = max(rows, current * 2, GROW_ROWS)
+                target = -(-target // GROW_ROWS) * GROW_ROWS
+                # Vectors first: a mapped owners row always has a vector row behind it
+                with open(self._vectors_path, "ab") as f:
+                    f.truncate(target * self.dim * 4)
+                with open(self._owners_path, "ab") as f:
+                    f.truncate(target * 4)
+        self._map()
+
+    # ---------- Updates ----------
+    def apply(self, changes):
+        # changes: [(chunk_id, user_id, text)]; user_id 0 frees the row
+        if not changes:
+            return
+        self._ensure_capacity(max(c[0] for c in changes) + 1)
+        ids = np.fromiter((c[0] for c in changes), dtype=np.int64, count=len(changes))
+        owners = np.fromiter((c[1] for c in changes), dtype=np.int32, count=len(changes))
+        live = owners != 0
+        if live.any():
+            self.vectors[ids[live]] = self.embedder.embed([c[2] for c in changes if c[1]])
+        self.owners[ids] = owners
+        self.updates += len(changes)
+
+    def sync(self, conn, batch_size=2000, force=False):
+        # Bring the files in line with note_chunk (first start, a crash between
+        # commit and write, a new embedder): rows whose owner disagrees with
+        # the table are embedded again or freed. force re-embeds every chunk,
+        # for when ids were reused with new text (rebuild()). Returns the
+        # number of chunks embedded.
+        max_id = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM note_chunk")).scalar()
+        self._ensure_capacity(max_id + 1)
+        expected = np.zeros(self.capacity, dtype=np.int32)
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                text("SELECT id, user_id FROM note_chunk WHERE id > :last ORDER BY id LIMIT :n"),
+                {"last": last_id, "n": batch_size},
+            ).all()
+            if not rows:
+                break
+            ids, owners = zip(*rows)
+            expected[list(ids)] = owners
+            last_id = ids[-1]
+        stale = np.flatnonzero(expected) if force else np.flatnonzero(expected != self.owners)
+        if not stale.size:
+            return 0
+        freed = stale[expected[stale] == 0]
+        self.owners[freed] = 0
+        live = stale[expected[stale] != 0]
+        for start in range(0, live.size, batch_size):
+            ids = ",".join(str(int(i)) for i in live[start:start + batch_size])
+            rows = conn.execute(text("SELECT id, user_id, text FROM note_chunk WHERE id IN (%s)" % ids)).all()
+            self.apply([tuple(r) for r in rows])
+        self.vectors.flush()
+        self.owners.flush()
+        return int(live.size)
+
+    # ---------- Search ----------
+    def search(self, user_id, query, k=4):
+        # Returns [(chunk_id, score)] best first, only chunks owned by user_id
+        self._map()
+        if not self.capacity or not user_id:
+            return []
+        q = self.embedder.embed([query])[0]
+        if not q.any():
+            return []
+        self.searches += 1
+        # The scan is memory-bound (1 KB per row at DIM=256), so only the
+        # user's own rows are read: their ids come from the small owners column.
+        rows = np.flatnonzero(self.owners == user_id)
+        if not rows.size:
+            return []
+        if rows.size > self.capacity // 4:
+            scores = (np.asarray(self.vectors) @ q)[rows]  # gathering most rows costs more than scanning all
+        else:
+            scores = np.asarray(self.vectors[rows]) @ q
+        k = min(k, rows.size)
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+    def stats(self):
+        self._map()
+        return {
+            "embedder": self.embedder.name,
+            "dim": self.dim,
+            "capacity": self.capacity,
+            "chunks": int(np.count_nonzero(self.owners)) if self.capacity else 0,
+            "bytes": self.capacity * (self.dim + 1) * 4,
+            "searches": self.searches,
+            "updates": self.updates,
+        }
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._f = open(self.path, "a")
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+
+
+# =====================================================
+# Keeping note_chunk and the index in step with notes
+# =====================================================
+_index = None
+
+
+def configure(directory):
+    # Opens the index for this process; without NumPy retrieval stays off
+    global _index
+    _index = EmbeddingIndex(directory) if np is not None else None
+    return _index
+
+
+def get_index():
+    return _index
+
+
+def index_note(conn, note_id):
+    # Rewrite the chunks of one note; returns the changes for apply().
+    # Existing chunk ids are reused so edits do not grow the files.
+    row = conn.execute(
+        text("SELECT title, content, attachment_text, user_id FROM note WHERE id = :id"), {"id": note_id}
+    ).one_or_none()
+    old_ids = [r[0] for r in conn.execute(
+        text("SELECT id FROM note_chunk WHERE note_id = :id ORDER BY ord"), {"id": note_id})]
+    chunks = chunk_note(row.title, row.content, row.attachment_text) if row and row.user_id else []
+    changes = []
+    for ord_, chunk in enumerate(chunks):
+        params = {"note_id": note_id, "user_id": row.user_id, "ord": ord_, "text": chunk}
+        if ord_ < len(old_ids):
+            params["id"] = old_ids[ord_]
+            conn.execute(text("UPDATE note_chunk SET user_id = :user_id, ord = :ord, text = :text WHERE id = :id"),
+                         params)
+            chunk_id = old_ids[ord_]
+        else:
+            chunk_id = conn.execute(
+                text("INSERT INTO note_chunk (note_id, user_id, ord, text) "
+                     "VALUES (:note_id, :user_id, :ord, :text) RETURNING id"), params).scalar()
+        changes.append((chunk_id, row.user_id, chunk))
+    for chunk_id in old_ids[len(chunks):]:
+        conn.execute(text("DELETE FROM note_chunk WHERE id = :id"), {"id": chunk_id})
+        changes.append((chunk_id, 0, None))
+    return changes
+
+
+_chunk_table = Table("note_chunk", MetaData(), Column("id", Integer, primary_key=True), Column("note_id", Integer),
+                     Column("user_id", Integer), Column("ord", Integer), Column("text", Text))
+
+
+def index_rows(conn, rows):
+    # Bulk variant of index_note() for new notes; rows: mappings with id,
+    # title, content, attachment_text, user_id. Returns the changes for apply().
+    params = [{"note_id": r["id"], "user_id": r["user_id"], "ord": i, "text": chunk}
+              for r in rows if r["user_id"]
+              for i, chunk in enumerate(chunk_note(r["title"], r["content"], r["attachment_text"]))]
+    if not params:
+        return []
+    ids = conn.execute(insert(_chunk_table).returning(_chunk_table.c.id, sort_by_parameter_order=True), params)
+    return [(chunk_id, p["user_id"], p["text"]) for (chunk_id,), p in zip(ids, params)]
+
+
+def remove_note(conn, note_id):
+    ids = [r[0] for r in conn.execute(text("SELECT id FROM note_chunk WHERE note_id = :id"), {"id": note_id})]
+    conn.execute(text("DELETE FROM note_chunk WHERE note_id = :id"), {"id": note_id})
+    return [(chunk_id, 0, None) for chunk_id in ids]
+
+
+def apply(changes):
+    if _index is not None:
+        _index.apply(changes)
+
+
+def _queue(note, changes):
+    # Hold the file writes until the session commits
+    object_session(note).info.setdefault("embedding_changes", []).extend(changes)
+
+
+def _on_update(conn, note):
+    state = inspect(note)
+    if any(state.attrs[name].history.has_changes() for name in ("title", "content", "attachment_text", "user_id")):
+        _queue(note, index_note(conn, note.id))
+
+
+def _after_commit(session):
+    changes = session.info.pop("embedding_changes", None)
+    if changes:
+        try:
+            apply(changes)
+        except Exception as e:  # the notes are saved either way; "flask rebuild-embeddings" repairs
+            print("Embedding index update failed:", e)
+
+
+def watch(model):
+    event.listen(model, "after_insert", lambda mapper, conn, note: _queue(note, index_note(conn, note.id)))
+    event.listen(model, "after_update", lambda mapper, conn, note: _on_update(conn, note))
+    event.listen(model, "after_delete", lambda mapper, conn, note: _queue(note, remove_note(conn, note.id)))
+    event.listen(Session, "after_commit", _after_commit)
+    event.listen(Session, "after_soft_rollback", lambda session, previous: session.info.pop("embedding_changes", None))
+
+
+def rebuild(conn, batch_size=2000):
+    # Re-chunk every note (compacting chunk ids); call sync() afterwards
+    conn.execute(text("DELETE FROM note_chunk"))
+    last_id, total = 0, 0
+    while True:
+        rows = conn.execute(
+            text("SELECT id, title, content, attachment_text, user_id FROM note "
+                 "WHERE id > :last AND user_id IS NOT NULL ORDER BY id LIMIT :n"),
+            {"last": last_id, "n": batch_size},
+        ).all()
+        if not rows:
+            break
+        conn.execute(
+            text("INSERT INTO note_chunk (note_id, user_id, ord, text) VALUES (:note_id, :user_id, :ord, :text)"),
+            [{"note_id": r.id, "user_id": r.user_id, "ord": i, "text": chunk}
+             for r in rows for i, chunk in enumerate(chunk_note(r.title, r.content, r.attachment_text))],
+        )
+        last_id, total = rows[-1].id, total + len(rows)
+    return total
+
+
+def passages(conn, user_id, hits):
+    # Chunk texts and note titles for search() hits, best first. Only the
+    # user's own notes: the owners column in the files is not the authority.
+    if not hits:
+        return []
+    scores = dict(hits)
+    rows = conn.execute(
+        text("SELECT c.id, c.note_id, c.text, n.title FROM note_chunk c JOIN note n ON n.id = c.note_id "
+             "WHERE c.id IN (%s) AND c.user_id = :user_id AND n.user_id = :user_id"
+             % ",".join(str(int(i)) for i in scores)),
+        {"user_id": user_id},
+    ).all()
+    found = [{"note_id": r.note_id, "title": r.title, "text": r.text, "score": round(scores[r.id], 4)}
+             for r in rows]
+    return sorted(found, key=lambda p: -p["score"])
@@ -0,0 +1,270 @@
+# extraction.py
+# Background text extraction for note attachments (PDF, DOCX, TXT).
+#
+# Jobs are rows in the extraction_job table (created in migrations.py), so
+# they survive restarts: a job left "running" by a crashed worker is picked up
+# again once its lease runs out, and a job that failed waits an exponentially
+# growing delay (not_before) before its next attempt. An ExtractionWorker
+# thread claims jobs and runs the extractors on a process pool, so large PDFs
+# never block a request thread or the GIL.
+import multiprocessing
+import os
+import threading
+import time
+import zipfile
+from codecs import getincrementaldecoder
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree.ElementTree import iterparse
+
+from sqlalchemy import text
+
+import embeddings
+import search
+
+CHUNK_SIZE = 64 * 1024
+MAX_CHARS = int(os.getenv("EXTRACT_MAX_CHARS", 200_000))
+MAX_ATTEMPTS = 3
+LEASE_SECONDS = 300
+RETRY_SECONDS = int(os.getenv("EXTRACT_RETRY_SECONDS", 60))  # doubled after each failed attempt
+EXTRACTABLE = {".txt", ".pdf", ".docx"}
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+class UnsupportedFile(Exception):
+    pass
+
+
+# =====================================================
+# Extractors (run in worker processes)
+# =====================================================
+class _TextBuffer:
+    # Collects text pieces up to a character budget
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.parts = []
+
+    @property
+    def full(self):
+        return self.size >= self.limit
+
+    def add(self, piece):
+        if self.full or not piece:
+            return
+        piece = piece[: self.limit - self.size]
+        self.parts.append(piece)
+        self.size += len(piece)
+
+    def value(self):
+        return "".join(self.parts).strip()
+
+
+def _extract_txt(path, out):
+    decoder = getincrementaldecoder("utf-8")(errors="replace")
+    with open(path, "rb") as f:
+        while not out.full:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            out.add(decoder.decode(chunk))
+    out.add(decoder.decode(b"", final=True))
+
+
+def _extract_docx(path, out):
+    # Stream word/document.xml instead of loading the whole tree
+    with zipfile.ZipFile(path) as zf, zf.open("word/document.xml") as xml:
+        for _, elem in iterparse(xml, events=("end",)):
+            if elem.tag == _W + "t":
+                out.add(elem.text)
+            elif elem.tag == _W + "p":
+                out.add("\n")
+                elem.clear()
+            if out.full:
+                break
+
+
+def _extract_pdf(path, out):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise UnsupportedFile("PDF extraction needs the 'pypdf' package")
+    reader = PdfReader(path)
+    for page in reader.pages:
+        out.add(page.extract_text() or "")
+        out.add("\n")
+        if out.full:
+            break
+
+
+def extract_text(path, max_chars=MAX_CHARS):
+    ext = os.path.splitext(path)[1].lower()
+    out = _TextBuffer(max_chars)
+    if ext == ".txt":
+        _extract_txt(path, out)
+    elif ext == ".docx":
+        _extract_docx(path, out)
+    elif ext == ".pdf":
+        _extract_pdf(path, out)
+    else:
+        raise UnsupportedFile(f"No text extractor for {ext or 'this file'}")
+    return out.value()
+
+
+# =====================================================
+# Job queue
+# =====================================================
+def enqueue(conn, note_id, path):
+    if os.path.splitext(path)[1].lower() not in EXTRACTABLE:
+        return
+    conn.execute(
+        text("INSERT INTO extraction_job (note_id, path, created_at) VALUES (:note_id, :path, :now)"),
+        {"note_id": note_id, "path": path, "now": time.time()},
+    )
+
+
+def job_status(conn, note_id):
+    row = conn.execute(
+        text("SELECT status, attempts, error, chars, created_at, finished_at, not_before FROM extraction_job "
+             "WHERE note_id = :note_id ORDER BY id DESC LIMIT 1"),
+        {"note_id": note_id},
+    ).mappings().first()
+    return dict(row) if row else None
+
+
+def _claim(engine, limit):
+    now = time.time()
+    with engine.begin() as conn:
+        # Jobs stuck in "running" past their lease belonged to a crashed worker
+        conn.execute(
+            text("UPDATE extraction_job SET status = 'failed', error = 'Too many attempts', finished_at = :now "
+                 "WHERE status = 'running' AND started_at < :expired AND attempts >= :max"),
+            {"now": now, "expired": now - LEASE_SECONDS, "max": MAX_ATTEMPTS},
+        )
+        rows = conn.execute(
+            text("UPDATE extraction_job SET status = 'running', started_at = :now, attempts = attempts + 1 "
+                 "WHERE id IN (SELECT id FROM extraction_job "
+                 "   WHERE (status = 'pending' AND (not_before IS NULL OR not_before <= :now)) "
+                 "   OR (status = 'running' AND started_at < :expired) ORDER BY id LIMIT :limit) "
+                 "RETURNING id, note_id, path, attempts"),
+            {"now": now, "expired": now - LEASE_SECONDS, "limit": limit},
+        ).mappings().all()
+    return [dict(r) for r in rows]
+
+
+def _finish(engine, job, status, result=None, error=None, retry_in=None):
+    now = time.time()
+    with engine.begin() as conn:
+        conn.execute(
+            text("UPDATE extraction_job SET status = :status, error = :error, chars = :chars, finished_at = :now, "
+                 "not_before = :not_before WHERE id = :id"),
+            {"status": status, "error": error, "chars": len(result) if result is not None else None,
+             "now": now, "not_before": now + retry_in if retry_in is not None else None, "id": job["id"]},
+        )
+        if result is None:
+            return
+        # Skip if the note was deleted or got a different attachment meanwhile
+        updated = conn.execute(
+            text("UPDATE note SET attachment_text = :text WHERE id = :note_id AND attachment = :path"),
+            {"text": result, "note_id": job["note_id"], "path": job["path"]},
+        )
+        if not updated.rowcount:
+            return
+        search.set_attachment_text(conn, job["note_id"], result)
+        changes = embeddings.index_note(conn, job["note_id"])
+    embeddings.apply(changes)  # after the commit, like the mapper-driven updates
+
+
+class ExtractionWorker:
+    def __init__(self, engine, upload_root, processes=None, batch_size=None):
+        self.engine = engine
+        self.upload_root = upload_root
+        self.processes = int(processes or os.getenv("EXTRACT_PROCESSES", 2))
+        self.batch_size = batch_size or self.processes * 2
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pool = None
+        self.done = 0
+        self.failed = 0
+        self.chars = 0
+        self.busy_seconds = 0.0
+
+    def _executor(self):
+        if self._pool is None:
+            # spawn: never fork a process that is running Flask threads
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                max_tasks_per_child=50,  # bounds memory growth from parser leaks
+            )
+        return self._pool
+
+    def run_once(self):
+        # Claim a batch, extract it in parallel, record the results.
+        jobs = _claim(self.engine, self.batch_size)
+        if not jobs:
+            return 0
+        started = time.monotonic()
+        pool = self._executor()
+        futures = [
+            (job, pool.submit(extract_text, os.path.join(self.upload_root, *job["path"].split("/"))))
+            for job in jobs
+        ]
+        for job, future in futures:
+            try:
+                result = future.result()
+            except UnsupportedFile as e:
+                _finish(self.engine, job, "skipped", error=str(e))
+            except Exception as e:
+                # Leave it pending for a later attempt unless it has used them all
+                if job["attempts"] >= MAX_ATTEMPTS:
+                    _finish(self.engine, job, "failed", error=f"{type(e).__name__}: {e}")
+                    self.failed += 1
+                else:
+                    _finish(self.engine, job, "pending", error=f"{type(e).__name__}: {e}",
+                            retry_in=RETRY_SECONDS * 2 ** (job["attempts"] - 1))
+            else:
+                _finish(self.engine, job, "done", result=result)
+                self.done += 1
+                self.chars += len(result)
+        self.busy_seconds += time.monotonic() - started
+        return len(jobs)
+
+    def drain(self):
+        while self.run_once():
+            pass
+
+    def notify(self):
+        self.start()
+        self._wake.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception as e:
+                print("Extraction worker error:", e)
+            self._wake.wait(timeout=10)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="extraction", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "processes": self.processes,
+            "done": self.done,
+            "failed": self.failed,
+            "chars": self.chars,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "docs_per_second": round(self.done / self.busy_seconds, 2) if self.busy_seconds else 0.0,
+        }
@@ -0,0 +1,320 @@
+# fake_llm.py
+# Local stand-ins for Ollama and Gemini, for tests, benchmarks (bench.py) and
+# offline development:
+#
+#   with FakeOllamaServer(reply="Hello there") as server:
+#       client = OllamaClient(host=server.url)
+#
+#   FakeGemini(latency=0.5).install()   # quizgen now talks to the fake
+#
+#   router = LLMRouter("quiz", [FakeProvider("a", latency=0.2), FakeProvider("b")])
+#
+# All take a fixed latency before the first token, a delay between streamed
+# tokens and an error_rate (0..1) of calls that fail. FakeGemini and
+# FakeProvider also answer the async calls the ASGI mode makes.
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def quiz_reply(prompt):
+    # Well-formed quiz JSON for quiz prompts (single or batched, see
+    # quizgen), None for anything else
+    m = re.search(r"exactly (\d+) questions", prompt)
+    if not m:
+        return None
+    count = int(m.group(1))
+    ids = re.findall(r'^\s*- "(\w+)": "', prompt, flags=re.M)
+    if ids:
+        return json.dumps({item_id: _questions(count, item_id) for item_id in ids})
+    return json.dumps(_questions(count))
+
+
+def _questions(count, tag=""):
+    return [
+        {
+            "question": f"Fake question {i + 1}{' for ' + tag if tag else ''}?",
+            "options": ["Option A", "Option B", "Option C", "Option D"],
+            "answer": random.randrange(4),
+            "explanation": "Because this is a fake answer.",
+        }
+        for i in range(count)
+    ]
+
+
+def _split_tokens(text):
+    # Split on spaces but keep them, so joined tokens equal the full reply
+    return [w + " " for w in text.split(" ")[:-1]] + [text.split(" ")[-1]]
+
+
+class _OllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real server
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        server.requests.append((self.path, payload))
+        if self.path not in ("/api/generate", "/api/chat"):
+            return self._send_json(404, {"error": f"unknown endpoint {self.path}"})
+        if server.should_fail():
+            time.sleep(server.latency)
+            return self._send_json(500, {"error": "injected failure"})
+
+        chat = self.path == "/api/chat"
+        if chat:
+            prompt = "\n".join(f"{m.get('role')}: {m.get('content')}" for m in payload.get("messages", []))
+        else:
+            prompt = payload.get("prompt", "")
+        tokens = server.reply_for(prompt)
+        model = payload.get("model")
+
+        def item(text, done=False):
+            obj = {"model": model, "done": done}
+            if chat:
+                obj["message"] = {"role": "assistant", "content": text}
+            else:
+                obj["response"] = text
+            if done:
+                obj.update(prompt_eval_count=server.evaluated(prompt), eval_count=len(tokens))
+            return obj
+
+        if not payload.get("stream", True):
+            time.sleep(server.latency)
+            return self._send_json(200, item("".join(tokens), done=True))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(server.latency)
+        try:
+            for token in tokens:
+                self._chunk(item(token))
+                time.sleep(server.token_delay)
+            self._chunk(item("", done=True))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # client went away mid-stream
+
+    def _chunk(self, obj):
+        data = (json.dumps(obj) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # listen backlog; the default 5 resets bursts of async connections
+
+    def __init__(self, reply="This is a fake reply.", latency=0.0, token_delay=0.0, error_rate=0.0, port=0):
+        super().__init__(("127.0.0.1", port), _OllamaHandler)
+        self.reply = reply
+        self.latency = latency
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.requests = []
+        self._last_prompt = ""
+        self._thread = None
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def evaluated(self, prompt):
+        # Like Ollama, only the part after the prefix shared with the previous
+        # prompt is evaluated again (~4 characters per token)
+        reused = len(os.path.commonprefix([self._last_prompt, prompt]))
+        self._last_prompt = prompt
+        return (len(prompt) - reused) // 4 + 1
+
+    def reply_for(self, prompt):
+        if callable(self.reply):
+            text = self.reply(prompt)
+        else:
+            text = quiz_reply(prompt) or self.reply
+        return _split_tokens(text)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+
+# =====================================================
+# Gemini
+# =====================================================
+class FakeGeminiError(RuntimeError):
+    pass
+
+
+class _FakeGeminiResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class _FakeGeminiModel:
+    def __init__(self, fake, model_name):
+        self.fake = fake
+        self.model_name = model_name
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        fake = self.fake
+        fake.calls += 1
+        slow = fake.slow_rate > 0 and random.random() < fake.slow_rate
+        time.sleep(fake.slow_latency if slow else fake.latency)
+        if fake.error_rate > 0 and random.random() < fake.error_rate:
+            raise FakeGeminiError("injected failure")
+        text = fake.reply_for(prompt)
+        if not stream:
+            time.sleep(fake.token_delay * (len(text) // fake.chunk_size))
+            return _FakeGeminiResponse(text)
+        return self._chunks(text)
+
+    def _chunks(self, text):
+        size = self.fake.chunk_size
+        for i in range(0, len(text), size):
+            if i:
+                time.sleep(self.fake.token_delay)
+            yield _FakeGeminiResponse(text[i:i + size])
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        # Like the SDK: awaiting gives the response, or with stream=True an async iterator of chunks
+        fake = self.fake
+        fake.calls += 1
+        slow = fake.slow_rate > 0 and random.random() < fake.slow_rate
+        await asyncio.sleep(fake.slow_latency if slow else fake.latency)
+        if fake.error_rate > 0 and random.random() < fake.error_rate:
+            raise FakeGeminiError("injected failure")
+        text = fake.reply_for(prompt)
+        if not stream:
+            await asyncio.sleep(fake.token_delay * (len(text) // fake.chunk_size))
+            return _FakeGeminiResponse(text)
+        return self._achunks(text)
+
+    async def _achunks(self, text):
+        size = self.fake.chunk_size
+        for i in range(0, len(text), size):
+            if i:
+                await asyncio.sleep(self.fake.token_delay)
+            yield _FakeGeminiResponse(text[i:i + size])
+
+
+class FakeGemini:
+    # Stands in for google.generativeai.GenerativeModel. Quiz prompts (single
+    # or batched, see quizgen) get well-formed quiz JSON back; anything else
+    # gets `reply`.
+    def __init__(self, latency=0.0, token_delay=0.0, error_rate=0.0, chunk_size=40, reply="Fake Gemini reply.",
+                 slow_rate=0.0, slow_latency=5.0):
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.reply = reply
+        self.calls = 0
+
+    def install(self):
+        import google.generativeai as genai
+
+        genai.GenerativeModel = lambda model_name="", **kwargs: _FakeGeminiModel(self, model_name)
+        return self
+
+    def reply_for(self, prompt):
+        return quiz_reply(prompt) or self.reply
+
+
+# =====================================================
+# Router providers
+# =====================================================
+class FakeProviderError(RuntimeError):
+    pass
+
+
+class FakeProvider:
+    # Stands in for an llm_router provider without any server. slow_rate of
+    # the calls take slow_latency instead of latency, to exercise hedging.
+    def __init__(self, name, latency=0.0, token_delay=0.0, error_rate=0.0, slow_rate=0.0, slow_latency=5.0,
+                 reply="Fake provider reply."):
+        self.name = name
+        self.latency = latency
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.reply = reply
+        self.calls = 0
+
+    def _start(self):
+        self.calls += 1
+        slow = self.slow_rate > 0 and random.random() < self.slow_rate
+        time.sleep(self.slow_latency if slow else self.latency)
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            raise FakeProviderError("injected failure")
+
+    def complete(self, messages):
+        self._start()
+        return quiz_reply(messages[-1]["content"]) or self.reply
+
+    def stream(self, messages):
+        self._start()
+        for i, token in enumerate(_split_tokens(quiz_reply(messages[-1]["content"]) or self.reply)):
+            if i:
+                time.sleep(self.token_delay)
+            yield token
+
+    async def _astart(self):
+        self.calls += 1
+        slow = self.slow_rate > 0 and random.random() < self.slow_rate
+        await asyncio.sleep(self.slow_latency if slow else self.latency)
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            raise FakeProviderError("injected failure")
+
+    async def acomplete(self, messages):
+        await self._astart()
+        return quiz_reply(messages[-1]["content"]) or self.reply
+
+    async def astream(self, messages):
+        await self._astart()
+        for i, token in enumerate(_split_tokens(quiz_reply(messages[-1]["content"]) or self.reply)):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            yield token
+
+
+if __name__ == "__main__":
+    server = FakeOllamaServer(port=11434)
+    print(f"Fake Ollama listening on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,209 @@
+# json_stream.py
+# Incremental parser for JSON written by an LLM. Text is fed in chunks as it
+# streams in, and every object inside the top-level array (or, in grouped
+# mode, inside each array of the top-level object) is decoded and checked
+# against a compiled schema as soon as its closing brace arrives. Items that
+# fail to decode or validate are recorded in .rejected and skipped; the rest
+# of the output is still used. Anything before the first bracket (```json
+# fences, "Here is your quiz:") is ignored.
+import json
+import re
+
+# Characters that can change the parser state, outside and inside strings
+_STRUCTURAL = re.compile(r'[\[\]{}"]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+# =====================================================
+# Schemas
+# =====================================================
+_TYPES = {
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "string": lambda v: isinstance(v, str),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+}
+
+
+def compile_schema(schema, path="$"):
+    # Turns a small JSON Schema subset (type, required, properties, items,
+    # minItems, maxItems, minLength, minimum, maximum) into a single function
+    # returning None for a valid value or a short reason why it is not.
+    checks = []
+    kind = schema.get("type")
+    if kind:
+        is_type = _TYPES[kind]
+        checks.append(lambda v: None if is_type(v) else f"{path}: expected {kind}")
+    if "required" in schema:
+        required = tuple(schema["required"])
+
+        def check_required(v):
+            missing = [k for k in required if k not in v]
+            return f"{path}: missing {', '.join(missing)}" if missing else None
+        checks.append(check_required)
+    if "properties" in schema:
+        props = {k: compile_schema(s, f"{path}.{k}") for k, s in schema["properties"].items()}
+
+        def check_properties(v):
+            for k, sub in props.items():
+                if k in v:
+                    error = sub(v[k])
+                    if error:
+                        return error
+        checks.append(check_properties)
+    if "minItems" in schema or "maxItems" in schema:
+        min_items, max_items = schema.get("minItems", 0), schema.get("maxItems")
+        checks.append(lambda v: None if min_items <= len(v) and (max_items is None or len(v) <= max_items)
+                      else f"{path}: wrong length ({len(v)})")
+    if "items" in schema:
+        item = compile_schema(schema["items"], f"{path}[]")
+
+        def check_items(v):
+            for x in v:
+                error = item(x)
+                if error:
+                    return error
+        checks.append(check_items)
+    if "minLength" in schema:
+        min_length = schema["minLength"]
+        checks.append(lambda v: None if len(v) >= min_length else f"{path}: too short")
+    if "minimum" in schema or "maximum" in schema:
+        minimum, maximum = schema.get("minimum"), schema.get("maximum")
+        checks.append(lambda v: None if (minimum is None or v >= minimum) and (maximum is None or v <= maximum)
+                      else f"{path}: {v} out of range")
+
+    def check(value):
+        # The type check runs first, so later checks can rely on it
+        for c in checks:
+            error = c(value)
+            if error:
+                return error
+        return None
+    return check
+
+
+# =====================================================
+# Incremental parser
+# =====================================================
+class JSONItemStream:
+    def __init__(self, check=None, grouped=False):
+        # grouped=False: expects [ {...}, {...} ] and feed() returns items.
+        # grouped=True: expects {"key": [ {...} ], ...} and feed() returns
+        # (key, item) pairs.
+        self.check = check
+        self.grouped = grouped
+        self.opener = "{" if grouped else "["
+        self.item_depth = 3 if grouped else 2
+        self.rejected = []   # (group, reason); group is None when not grouped
+        self.done = False
+        self._raw = []
+        self._buf = ""
+        self._pos = 0        # scan position in _buf
+        self._stack = []
+        self._in_string = False
+        self._item_start = None
+        self._key_start = None
+        self._key = None
+        self._group = None
+
+    @property
+    def text(self):
+        return "".join(self._raw)
+
+    def feed(self, chunk):
+        self._raw.append(chunk)
+        if self.done:
+            return []
+        buf = self._buf + chunk
+        out = []
+        i, n = self._pos, len(buf)
+        while i < n and not self.done:
+            if self._in_string:
+                m = _STRING_SPECIAL.search(buf, i)
+                if not m:
+                    i = n
+                    break
+                i = m.start()
+                if buf[i] == "\\":
+                    if i + 1 == n:
+                        break  # wait for the escaped character
+                    i += 2
+                    continue
+                self._in_string = False
+                if self._key_start is not None:
+                    try:
+                        self._key = json.loads(buf[self._key_start:i + 1])
+                    except ValueError:
+                        self._key = None
+                    self._key_start = None
+                i += 1
+                continue
+
+            m = _STRUCTURAL.search(buf, i)
+            if not m:
+                i = n
+                break
+            i = m.start()
+            c = buf[i]
+            if not self._stack:
+                # Still in the preamble, wait for the top-level container
+                if c == self.opener:
+                    self._stack.append(c)
+            elif c == '"':
+                self._in_string = True
+                if self.grouped and len(self._stack) == 1:
+                    self._key_start = i
+            elif c in "[{":
+                self._stack.append(c)
+                depth = len(self._stack)
+                if depth == self.item_depth and c == "{" and self._stack[-2] == "[":
+                    self._item_start = i
+                elif self.grouped and depth == 2 and c == "[":
+                    self._group = self._key
+            else:
+                depth = len(self._stack)
+                self._stack.pop()
+                if depth == self.item_depth and self._item_start is not None:
+                    out.extend(self._emit(buf[self._item_start:i + 1]))
+                    self._item_start = None
+                if not self._stack:
+                    self.done = True
+            i += 1
+
+        # Drop text that no open item or key can still need
+        keep = min(x for x in (self._item_start, self._key_start, i) if x is not None)
+        if self._item_start is not None:
+            self._item_start -= keep
+        if self._key_start is not None:
+            self._key_start -= keep
+        self._buf = buf[keep:]
+        self._pos = i - keep
+        return out
+
+    def _emit(self, text):
+        try:
+            item = json.loads(text)
+        except ValueError as e:
+            self.rejected.append((self._group, f"invalid JSON: {e}"))
+            return []
+        error = self.check(item) if self.check else None
+        if error:
+            self.rejected.append((self._group, error))
+            return []
+        return [(self._group, item)] if self.grouped else [item]
+
+    def close(self):
+        # Call once the stream has ended; notes an item cut off mid-way
+        if self._item_start is not None:
+            self.rejected.append((self._group, "truncated item"))
+            self._item_start = None
+
+    def summary(self):
+        if not self._stack and not self.done:
+            return "No JSON found in model output"
+        if not self.rejected:
+            return "No items in model output"
+        reasons = "; ".join(dict.fromkeys(reason for _, reason in self.rejected))
+        return f"{len(self.rejected)} item(s) rejected: {reasons}"
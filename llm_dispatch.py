@@ -0,0 +1,175 @@
+# llm_dispatch.py
+# Every upstream model call (Gemini quizzes, Mistral chat) goes through one
+# LLMDispatcher. It runs calls on a bounded thread pool, coalesces identical
+# in-flight requests (single-flight) and enforces per-call deadlines.
+#
+# A caller stops waiting at the deadline, but the pool thread would go on
+# with the upstream request. So the deadline also travels with the call (a
+# context variable) and the clients use time_left() as their request or
+# socket timeout, which makes the upstream request itself give up.
+import contextvars
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import closing
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+_limit = contextvars.ContextVar("llm_limit", default=None)  # (deadline, gap) of the running call
+
+
+def time_left(default=None):
+    # Seconds an upstream request started now may take: what is left of the
+    # running call's deadline, or for a stream the gap allowed between items.
+    # default (None: no limit) outside a dispatcher call.
+    limit = _limit.get()
+    if limit is None:
+        return default
+    deadline, gap = limit
+    left = max(0.001, deadline - time.monotonic()) if deadline is not None else gap
+    return left if default is None else min(default, left)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(p * (len(sorted_values) - 1))))]
+
+
+class LLMDispatcher:
+    def __init__(self, max_workers=None, timeout=None):
+        self.max_workers = int(max_workers or os.getenv("LLM_MAX_WORKERS", 4))
+        self.timeout = float(timeout or os.getenv("LLM_TIMEOUT", 60))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="llm")
+        self._lock = threading.RLock()
+        self._inflight = {}  # key -> Future
+        self._queued = 0
+        self._running = 0
+        self._waits = deque(maxlen=1000)  # seconds spent queued, most recent calls
+        self.submitted = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    # ---------- Internals ----------
+    def _submit(self, limit, fn, *args, **kwargs):
+        # limit: (deadline, gap) for time_left() while fn runs
+        enqueued = time.monotonic()
+
+        def run():
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._waits.append(time.monotonic() - enqueued)
+            token = _limit.set(limit)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _limit.reset(token)
+                with self._lock:
+                    self._running -= 1
+
+        with self._lock:
+            self._queued += 1
+            self.submitted += 1
+        future = self._executor.submit(run)
+        # A cancelled future never runs, so undo its queue accounting here
+        future.add_done_callback(lambda f: f.cancelled() and self._cancelled())
+        return future
+
+    def _cancelled(self):
+        with self._lock:
+            self._queued -= 1
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    # ---------- Public API ----------
+    def call(self, fn, *args, key=None, timeout=None, **kwargs):
+        # Run fn on the pool and wait for it. Calls sharing a key while one is
+        # already in flight wait on that call instead of starting another.
+        wait = timeout or self.timeout
+        limit = (time.monotonic() + wait, None)
+        if key is None:
+            future = self._submit(limit, fn, *args, **kwargs)
+        else:
+            with self._lock:
+                future = self._inflight.get(key)
+                if future is not None:
+                    self.coalesced += 1
+                else:
+                    future = self._submit(limit, fn, *args, **kwargs)
+                    self._inflight[key] = future
+                    future.add_done_callback(lambda f: self._forget(key, f))
+        try:
+            return future.result(timeout=wait)
+        except FutureTimeout:
+            with self._lock:
+                self.timeouts += 1
+            # Shared calls keep running so other waiters still get the result
+            if key is None:
+                future.cancel()
+            raise DeadlineExceeded("LLM call exceeded its deadline")
+
+    def stream(self, gen_fn, *args, timeout=None, **kwargs):
+        # Run a generator on the pool and relay its items. The deadline applies
+        # to the first item and to every gap between items.
+        items = queue.Queue()
+        stop = threading.Event()
+        _done = object()
+
+        def produce():
+            try:
+                with closing(gen_fn(*args, **kwargs)) as gen:
+                    for item in gen:
+                        if stop.is_set():
+                            break
+                        items.put(item)
+                items.put(_done)
+            except Exception as e:
+                items.put(e)
+
+        wait = timeout or self.timeout
+        future = self._submit((None, wait), produce)
+        try:
+            while True:
+                try:
+                    item = items.get(timeout=wait)
+                except queue.Empty:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise DeadlineExceeded("LLM stream exceeded its deadline")
+                if item is _done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            future.cancel()
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "max_workers": self.max_workers,
+                "queue_depth": self._queued,
+                "running": self._running,
+                "inflight_keys": len(self._inflight),
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "timeouts": self.timeouts,
+                "wait_ms_avg": round(sum(waits) / len(waits) * 1000, 2) if waits else 0.0,
+                "wait_ms_p95": round(percentile(waits, 0.95) * 1000, 2),
+                "wait_ms_max": round(waits[-1] * 1000, 2) if waits else 0.0,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
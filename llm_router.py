@@ -0,0 +1,590 @@
+# llm_router.py
+# Sends each model call to the best available provider (Gemini, Ollama, ...)
+# and falls back to the next one when it fails.
+#
+# Per provider the router keeps the latency and outcome of recent calls:
+#
+#   - providers whose last LLM_BREAKER_FAILURES calls all failed are skipped
+#     for LLM_BREAKER_COOLDOWN seconds, then get one trial call; other calls
+#     keep skipping them until that call has succeeded. While every provider
+#     is skipped, calls fail at once.
+#   - the first configured provider is used unless another one is clearly
+#     faster (LLM_SWITCH_RATIO) once error rates are taken into account;
+#     every LLM_EXPLORE_EVERY-th call goes to the runner-up instead, so its
+#     latency figures stay current
+#   - a call still running after the primary's p95 latency (LLM_HEDGE_PERCENTILE)
+#     is hedged: the
+#     next provider gets the same request and the first answer wins. At most
+#     LLM_HEDGE_RATIO of calls are hedged, so a slow upstream cannot double
+#     the load on the others.
+#
+# Streams are hedged and failed over on the first token; after that the
+# stream stays with its provider. Quiz generation and chat use separate
+# routers, because their latencies are not comparable.
+#
+# acomplete() and astream() do the same on an event loop (ASGI mode), with
+# attempts as tasks instead of pool threads; both kinds of call share the
+# health figures.
+import asyncio
+import contextvars
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import aclosing, closing
+
+import metrics
+import mistral
+import quizgen
+from llm_dispatch import percentile
+
+MIN_SAMPLES = 5
+ERROR_PENALTY = 10  # an error costs as much as this many median calls
+
+ROUTED = metrics.Counter(
+    "llm_router_attempts_total", "Provider attempts made by the router",
+    ("task", "provider", "role", "outcome"))
+
+
+class AllProvidersFailed(RuntimeError):
+    pass
+
+
+class CircuitOpen(RuntimeError):
+    # The provider's breaker is open, or its one trial call is already running
+    pass
+
+
+def _discard_result(task):
+    # Retrieve a hedge loser's outcome so asyncio does not log it as unhandled
+    if not task.cancelled():
+        task.exception()
+
+
+# =====================================================
+# Providers
+# =====================================================
+def flatten(messages):
+    # Chat messages as one prompt, for providers without a chat API
+    lines = []
+    for m in messages:
+        if m["role"] == "system":
+            lines.append(m["content"])
+        else:
+            lines.append(f"{m['role'].capitalize()}: {m['content']}")
+    if len(messages) == 1 and messages[0]["role"] == "user":
+        return messages[0]["content"]
+    return "\n\n".join(lines) + "\n\nAssistant:"
+
+
+class GeminiProvider:
+    name = "gemini"
+
+    def complete(self, messages):
+        return quizgen.call_model(flatten(messages))
+
+    def stream(self, messages):
+        return quizgen.stream_model(flatten(messages))
+
+    async def acomplete(self, messages):
+        return await quizgen.acall_model(flatten(messages))
+
+    def astream(self, messages):
+        return quizgen.astream_model(flatten(messages))
+
+
+class OllamaProvider:
+    name = "ollama"
+
+    def complete(self, messages):
+        return mistral.chat_mistral(messages)
+
+    def stream(self, messages):
+        return mistral.stream_chat_mistral(messages)
+
+    async def acomplete(self, messages):
+        return await mistral.achat_mistral(messages)
+
+    def astream(self, messages):
+        return mistral.astream_chat_mistral(messages)
+
+
+PROVIDERS = {"gemini": GeminiProvider, "ollama": OllamaProvider}
+
+
+def providers_from_env(variable, default):
+    # e.g. QUIZ_PROVIDERS="gemini,ollama": preferred first
+    value = os.getenv(variable) or default
+    names = [n.strip().lower() for n in value.split(",") if n.strip()]
+    if not names or any(name not in PROVIDERS for name in names):
+        raise ValueError(f"{variable} must list providers from {', '.join(sorted(PROVIDERS))}; got {value!r}")
+    return [PROVIDERS[name]() for name in names]
+
+
+# =====================================================
+# Health and latency tracking
+# =====================================================
+class ProviderHealth:
+    def __init__(self, provider, window):
+        self.provider = provider
+        self.latencies = {"call": deque(maxlen=window), "first_token": deque(maxlen=window)}
+        self.outcomes = deque(maxlen=window)  # True for success
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False  # the trial call after a cooldown is in flight
+        self.calls = 0
+        self.errors = 0
+        self.wins = 0
+
+    def record(self, mode, seconds, ok):
+        self.calls += 1
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies[mode].append(seconds)
+            self.consecutive_failures = 0
+        else:
+            self.errors += 1
+            self.consecutive_failures += 1
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def latency(self, mode, p):
+        samples = self.latencies[mode]
+        return percentile(sorted(samples), p) if len(samples) >= MIN_SAMPLES else None
+
+    def expected(self, mode):
+        # Median latency inflated by the error rate; None until there is data
+        p50 = self.latency(mode, 0.5)
+        return None if p50 is None else p50 * (1 + ERROR_PENALTY * self.error_rate())
+
+
+# =====================================================
+# Router
+# =====================================================
+class LLMRouter:
+    def __init__(self, task, providers, hedge=None, hedge_ratio=None, window=100, max_workers=None):
+        self.task = task
+        self.health = [ProviderHealth(p, window) for p in providers]
+        self.hedge = (hedge if hedge is not None else os.getenv("LLM_HEDGE", "1") == "1")
+        self.hedge_ratio = float(hedge_ratio if hedge_ratio is not None else os.getenv("LLM_HEDGE_RATIO", 0.1))
+        self.hedge_percentile = float(os.getenv("LLM_HEDGE_PERCENTILE", 0.95))
+        self.hedge_min_delay = float(os.getenv("LLM_HEDGE_MIN_DELAY", 0.2))
+        self.explore_every = int(os.getenv("LLM_EXPLORE_EVERY", 20))
+        self.breaker_failures = int(os.getenv("LLM_BREAKER_FAILURES", 3))
+        self.breaker_cooldown = float(os.getenv("LLM_BREAKER_COOLDOWN", 30))
+        self.switch_ratio = float(os.getenv("LLM_SWITCH_RATIO", 1.5))
+        self.item_timeout = float(os.getenv("LLM_TIMEOUT", 60))
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(max_workers or os.getenv("LLM_ROUTER_WORKERS", 8)),
+            thread_name_prefix=f"router-{task}")
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedges = 0
+        self.fallbacks = 0
+
+    # ---------- Choosing providers ----------
+    def order(self, mode="call", explore=False):
+        # Providers to try, best first
+        now = time.monotonic()
+        with self._lock:
+            healthy = [h for h in self.health if h.open_until <= now and not h.probing]
+            if not healthy:
+                return []
+            expected = {id(h): h.expected(mode) for h in healthy}
+            known = [h for h in healthy if expected[id(h)] is not None]
+            first = healthy[0]
+            if known and expected[id(first)] is not None:
+                best = min(known, key=lambda h: expected[id(h)])
+                if expected[id(first)] > self.switch_ratio * expected[id(best)]:
+                    healthy.remove(best)
+                    healthy.insert(0, best)
+            if explore and len(healthy) > 1:
+                healthy[0], healthy[1] = healthy[1], healthy[0]
+            return healthy
+
+    def _start_call(self, mode):
+        with self._lock:
+            self.calls += 1
+            explore = self.explore_every > 0 and self.calls % self.explore_every == 0
+        order = self.order(mode, explore)
+        if not order:
+            raise AllProvidersFailed("every provider is failing; retrying after the breaker cooldown")
+        return order
+
+    def _submit(self, fn, *args):
+        # Attempts run in the caller's context, so they see its deadline (llm_dispatch.time_left)
+        return self._executor.submit(contextvars.copy_context().run, fn, *args)
+
+    def _hedge_delay(self, health, mode):
+        if not self.hedge:
+            return None
+        with self._lock:
+            if self.hedges >= self.hedge_ratio * self.calls:
+                return None
+        delay = health.latency(mode, self.hedge_percentile)
+        return None if delay is None else max(delay, self.hedge_min_delay)
+
+    def _claim(self, health):
+        # Raises CircuitOpen unless the call may go to this provider. Once the
+        # cooldown is over only the first caller gets through (the trial call);
+        # the breaker closes when it succeeds and reopens when it fails.
+        with self._lock:
+            if health.consecutive_failures < self.breaker_failures:
+                return
+            if health.probing or health.open_until > time.monotonic():
+                raise CircuitOpen(f"{health.provider.name} is failing, skipped")
+            health.probing = True
+
+    def _record(self, health, mode, seconds, ok):
+        with self._lock:
+            health.record(mode, seconds, ok)
+            health.probing = False
+            if not ok and health.consecutive_failures >= self.breaker_failures:
+                health.open_until = time.monotonic() + self.breaker_cooldown
+
+    def _abandon(self, health):
+        # An attempt cancelled before it had an outcome frees the trial slot
+        with self._lock:
+            health.probing = False
+
+    def _attempt(self, health, messages):
+        self._claim(health)
+        started = time.monotonic()
+        try:
+            result = health.provider.complete(messages)
+        except Exception:
+            self._record(health, "call", time.monotonic() - started, False)
+            raise
+        self._record(health, "call", time.monotonic() - started, True)
+        return result
+
+    # ---------- Calls ----------
+    def complete(self, messages):
+        order = self._start_call("call")
+        pending, errors = {}, []
+
+        def launch(role):
+            health = order[len(pending) + len(errors)]
+            pending[self._submit(self._attempt, health, messages)] = (health, role)
+
+        launch("primary")
+        hedge_delay = self._hedge_delay(order[0], "call") if len(order) > 1 else None
+        hedge_at = time.monotonic() + hedge_delay if hedge_delay else None
+        while pending:
+            timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedge_at = None
+                if len(pending) + len(errors) < len(order):
+                    with self._lock:
+                        self.hedges += 1
+                    launch("hedge")
+                continue
+            for future in done:
+                health, role = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append((health.provider.name, e))
+                    ROUTED.inc(task=self.task, provider=health.provider.name, role=role, outcome="error")
+                    if not pending and len(errors) < len(order):
+                        with self._lock:
+                            self.fallbacks += 1
+                        launch("fallback")
+                    continue
+                with self._lock:
+                    health.wins += 1
+                ROUTED.inc(task=self.task, provider=health.provider.name, role=role, outcome="won")
+                for other, other_role in pending.values():  # left to finish; their timings still count
+                    ROUTED.inc(task=self.task, provider=other.provider.name, role=other_role, outcome="lost")
+                return result
+        raise AllProvidersFailed("; ".join(f"{name}: {e}" for name, e in errors))
+
+    def stream(self, messages):
+        # Yields the tokens of the first provider to produce one
+        order = self._start_call("first_token")
+        items = queue.Queue()
+        attempts = []  # (health, role, stop event)
+        errors = []
+
+        def produce(index, health, stop):
+            try:
+                self._claim(health)
+            except CircuitOpen as e:
+                items.put((index, "error", e))
+                return
+            started = time.monotonic()
+            first = True
+            try:
+                with closing(health.provider.stream(messages)) as tokens:
+                    for token in tokens:
+                        if first:
+                            self._record(health, "first_token", time.monotonic() - started, True)
+                            first = False
+                        if stop.is_set():
+                            return
+                        items.put((index, "token", token))
+                if first:
+                    self._record(health, "first_token", time.monotonic() - started, True)
+                items.put((index, "done", None))
+            except Exception as e:
+                if first:
+                    self._record(health, "first_token", time.monotonic() - started, False)
+                items.put((index, "error", e))
+
+        def launch(role):
+            health, stop = order[len(attempts)], threading.Event()
+            attempts.append((health, role, stop))
+            self._submit(produce, len(attempts) - 1, health, stop)
+
+        launch("primary")
+        hedge_delay = self._hedge_delay(order[0], "first_token") if len(order) > 1 else None
+        hedge_at = time.monotonic() + hedge_delay if hedge_delay else None
+        winner = None
+        live = 1
+        try:
+            while True:
+                timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at else self.item_timeout
+                try:
+                    index, kind, value = items.get(timeout=timeout)
+                except queue.Empty:
+                    if hedge_at is None:
+                        raise TimeoutError(f"{attempts[winner or 0][0].provider.name} stopped responding")
+                    hedge_at = None
+                    if len(attempts) < len(order):
+                        with self._lock:
+                            self.hedges += 1
+                        launch("hedge")
+                        live += 1
+                    continue
+                health, role, _ = attempts[index]
+                if winner is None and kind != "error":
+                    winner = index
+                    hedge_at = None
+                    with self._lock:
+                        health.wins += 1
+                    ROUTED.inc(task=self.task, provider=health.provider.name, role=role, outcome="won")
+                    for i, (other, other_role, stop) in enumerate(attempts):
+                        if i != index:
+                            stop.set()
+                            ROUTED.inc(task=self.task, provider=other.provider.name, role=other_role, outcome="lost")
+                if winner is None:  # an error before anyone produced a token
+                    live -= 1
+                    errors.append((health.provider.name, value))
+                    ROUTED.inc(task=self.task, provider=health.provider.name, role=role, outcome="error")
+                    if live == 0:
+                        if len(attempts) >= len(order):
+                            raise AllProvidersFailed("; ".join(f"{name}: {e}" for name, e in errors))
+                        with self._lock:
+                            self.fallbacks += 1
+                        launch("fallback")
+                        live += 1
+                    continue
+                if index != winner:
+                    continue
+                if kind == "token":
+                    yield value
+                elif kind == "done":
+                    return
+                else:
+                    raise value
+        finally:
+            for _, _, stop in attempts:
+                stop.set()
+
+    # ---------- Calls on an event loop ----------
+    async def _aattempt(self, health, messages):
+        self._claim(health)
+        started = time.monotonic()
+        try:
+            result = await health.provider.acomplete(messages)
+        except asyncio.CancelledError:
+            self._abandon(health)
+            raise
+        except Exception:
+            self._record(health, "call", time.monotonic() - started, False)
+            raise
+        self._record(health, "call", time.monotonic() - started, True)
+        return result
+
+    async def acomplete(self, messages):
+        order = self._start_call("call")
+        pending, errors = {}, []
+
+        def launch(role):
+            health = order[len(pending) + len(errors)]
+            pending[asyncio.ensure_future(self._aattempt(health, messages))] = (health, role)
+
+        launch("primary")
+        hedge_delay = self._hedge_delay(order[0], "call") if len(order) > 1 else None
+        hedge_at = time.monotonic() + hedge_delay if hedge_delay else None
+        while pending:
+            timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedge_at = None
+                if len(pending) + len(errors) < len(order):
+                    with self._lock:
+                        self.hedges += 1
+                    launch("hedge")
+                continue
+            for task in done:
+                health, role = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    errors.append((health.provider.name, e))
+                    ROUTED.inc(task=self.task, provider=health.provider.name, role=role, outcome="error")
+                    if not pending and len(errors) < len(order):
+                        with self._lock:
+                            self.fallbacks += 1
+                        launch("fallback")
+                    continue
+                with self._lock:
+                    health.wins += 1
+                ROUTED.inc(task=self.task, provider=health.provider.name, role=role, outcome="won")
+                for other_task, (other, other_role) in pending.items():
+                    ROUTED.inc(task=self.task, provider=other.provider.name, role=other_role, outcome="lost")
+                    other_task.add_done_callback(_discard_result)  # left to finish, as in complete()
+                return result
+        raise AllProvidersFailed("; ".join(f"{name}: {e}" for name, e in errors))
+
+    async def astream(self, messages):
+        order = self._start_call("first_token")
+        items = asyncio.Queue()
+        attempts = []  # (health, role, stop event, task)
+        errors = []
+
+        async def produce(index, health, stop):
+            try:
+                self._claim(health)
+            except CircuitOpen as e:
+                items.put_nowait((index, "error", e))
+                return
+            started = time.monotonic()
+            first = True
+            try:
+                async with aclosing(health.provider.astream(messages)) as tokens:
+                    async for token in tokens:
+                        if first:
+                            self._record(health, "first_token", time.monotonic() - started, True)
+                            first = False
+                        if stop.is_set():
+                            return
+                        items.put_nowait((index, "token", token))
+                if first:
+                    self._record(health, "first_token", time.monotonic() - started, True)
+                items.put_nowait((index, "done", None))
+            except asyncio.CancelledError:
+                if first:
+                    self._abandon(health)
+                raise
+            except Exception as e:
+                if first:
+                    self._record(health, "first_token", time.monotonic() - started, False)
+                items.put_nowait((index, "error", e))
+
+        def launch(role):
+            health, stop = order[len(attempts)], asyncio.Event()
+            task = asyncio.ensure_future(produce(len(attempts), health, stop))
+            attempts.append((health, role, stop, task))
+
+        launch("primary")
+        hedge_delay = self._hedge_delay(order[0], "first_token") if len(order) > 1 else None
+        hedge_at = time.monotonic() + hedge_delay if hedge_delay else None
+        winner = None
+        live = 1
+        try:
+            while True:
+                timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at else self.item_timeout
+                try:
+                    index, kind, value = await asyncio.wait_for(items.get(), timeout)
+                except asyncio.TimeoutError:
+                    if hedge_at is None:
+                        raise TimeoutError(f"{attempts[winner or 0][0].provider.name} stopped responding")
+                    hedge_at = None
+                    if len(attempts) < len(order):
+                        with self._lock:
+                            self.hedges += 1
+                        launch("hedge")
+                        live += 1
+                    continue
+                health, role, _, _ = attempts[index]
+                if winner is None and kind != "error":
+                    winner = index
+                    hedge_at = None
+                    with self._lock:
+                        health.wins += 1
+                    ROUTED.inc(task=self.task, provider=health.provider.name, role=role, outcome="won")
+                    for i, (other, other_role, stop, _) in enumerate(attempts):
+                        if i != index:
+                            stop.set()
+                            ROUTED.inc(task=self.task, provider=other.provider.name, role=other_role, outcome="lost")
+                if winner is None:
+                    live -= 1
+                    errors.append((health.provider.name, value))
+                    ROUTED.inc(task=self.task, provider=health.provider.name, role=role, outcome="error")
+                    if live == 0:
+                        if len(attempts) >= len(order):
+                            raise AllProvidersFailed("; ".join(f"{name}: {e}" for name, e in errors))
+                        with self._lock:
+                            self.fallbacks += 1
+                        launch("fallback")
+                        live += 1
+                    continue
+                if index != winner:
+                    continue
+                if kind == "token":
+                    yield value
+                elif kind == "done":
+                    return
+                else:
+                    raise value
+        finally:
+            # Losers stop at their first token (so it is still timed); the
+            # winner is cancelled if the caller left mid-stream
+            for _, _, stop, _ in attempts:
+                stop.set()
+            if winner is not None:
+                attempts[winner][3].cancel()
+
+    # Single-prompt helpers, the shape quizgen expects for call= and stream=
+    def complete_text(self, prompt):
+        return self.complete([{"role": "user", "content": prompt}])
+
+    def stream_text(self, prompt):
+        return self.stream([{"role": "user", "content": prompt}])
+
+    async def acomplete_text(self, prompt):
+        return await self.acomplete([{"role": "user", "content": prompt}])
+
+    def astream_text(self, prompt):
+        return self.astream([{"role": "user", "content": prompt}])
+
+    def stats(self):
+        current = [h.provider.name for h in self.order()]
+        now = time.monotonic()
+        with self._lock:
+            providers = {}
+            for h in self.health:
+                providers[h.provider.name] = {
+                    "calls": h.calls,
+                    "errors": h.errors,
+                    "wins": h.wins,
+                    "error_rate": round(h.error_rate(), 3),
+                    "p50_ms": {m: round((h.latency(m, 0.5) or 0) * 1000, 1) for m in h.latencies},
+                    "p95_ms": {m: round((h.latency(m, 0.95) or 0) * 1000, 1) for m in h.latencies},
+                    "open_for_s": round(max(0.0, h.open_until - now), 1),
+                    "probing": h.probing,
+                }
+            return {
+                "task": self.task,
+                "order": current,
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "fallbacks": self.fallbacks,
+                "providers": providers,
+            }
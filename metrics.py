@@ -0,0 +1,385 @@
+# metrics.py
+# In-process timing instrumentation, exposed at /metrics in the Prometheus
+# text format (no client library needed):
+#
+#   - per-route latency histograms and in-flight gauges
+#   - SQL statement count and time per request (SQLAlchemy cursor events)
+#   - template rendering and other timed sections (bcrypt, ...)
+#   - upstream call durations, time to first token and tokens/sec for LLMs
+#
+# init_app() wires the Flask and SQLAlchemy hooks; upstream_call() and
+# track_stream() (atrack_stream() for async clients) are used by the LLM clients. With METRICS_PROFILING=1 a
+# request sent with "X-Profile: 1" (or ?profile=1) is sampled by
+# SamplingProfiler and its folded stacks are written to instance/profiles.
+import math
+import os
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LLM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+REGISTRY = []
+
+
+# =====================================================
+# Metric types
+# =====================================================
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_labels(self.labels, key)} {_fmt(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        # fn: read the value at scrape time instead of tracking it
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def render(self):
+        if self.fn is not None:
+            try:
+                self.set(self.fn())
+            except Exception:
+                pass
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines, cumulative = [], 0
+        for bound, n in zip(self.buckets + (math.inf,), counts):
+            cumulative += n
+            le = 'le="' + _fmt(bound) + '"'
+            lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_fmt(total)}")
+        lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# =====================================================
+# Metrics
+# =====================================================
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time to produce a response (headers, for streamed bodies)",
+    ("method", "route", "status"))
+IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being handled", ("route",))
+REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries", "SQL statements executed per request", ("route",), COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram("http_request_db_seconds", "Time spent in SQL per request", ("route",))
+QUERY_SECONDS = Histogram("db_query_duration_seconds", "Duration of single SQL statements", ("statement",))
+TEMPLATE_SECONDS = Histogram("template_render_seconds", "Jinja template rendering time", ("template",))
+SECTION_SECONDS = Histogram(
+    "app_section_duration_seconds", "Timed code sections such as password hashing", ("section",))
+UPSTREAM_SECONDS = Histogram(
+    "upstream_request_duration_seconds", "Duration of calls to Gemini and Ollama",
+    ("upstream", "operation", "outcome"), LLM_BUCKETS)
+TTFT_SECONDS = Histogram(
+    "llm_time_to_first_token_seconds", "Time until a streamed LLM call yields its first token",
+    ("upstream",), LLM_BUCKETS)
+TOKENS_PER_SECOND = Histogram(
+    "llm_tokens_per_second", "Generation speed of streamed LLM calls after the first token",
+    ("upstream",), RATE_BUCKETS)
+TOKENS = Counter("llm_tokens_total", "Tokens received from streamed LLM calls", ("upstream",))
+PROMPT_TOKENS = Histogram(
+    "llm_prompt_tokens", "Prompt size per chat call: sent (estimated) and evaluated by the model (not reused)",
+    ("upstream", "kind"), TOKEN_BUCKETS)
+
+
+@contextmanager
+def timed(section):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        SECTION_SECONDS.observe(time.perf_counter() - started, section=section)
+
+
+# =====================================================
+# Upstream calls
+# =====================================================
+@contextmanager
+def upstream_call(upstream, operation):
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - started, upstream=upstream, operation=operation,
+                                 outcome=outcome)
+
+
+def track_stream(upstream, items, tokens=lambda item: 1):
+    # Relays a streamed LLM response, recording time to first token and
+    # tokens/sec. tokens(item) says how many tokens one item carries.
+    started = time.perf_counter()
+    first = None
+    count = 0
+    outcome = "error"
+    try:
+        for item in items:
+            if first is None:
+                first = time.perf_counter()
+                TTFT_SECONDS.observe(first - started, upstream=upstream)
+            count += tokens(item)
+            yield item
+        outcome = "ok"
+    except GeneratorExit:
+        outcome = "cancelled"  # the consumer stopped early (client went away)
+        raise
+    finally:
+        ended = time.perf_counter()
+        UPSTREAM_SECONDS.observe(ended - started, upstream=upstream, operation="stream", outcome=outcome)
+        if count:
+            TOKENS.inc(count, upstream=upstream)
+        if first is not None and count > 1 and ended > first:
+            TOKENS_PER_SECOND.observe((count - 1) / (ended - first), upstream=upstream)
+
+
+async def atrack_stream(upstream, items, tokens=lambda item: 1):
+    # track_stream() for async iterators
+    started = time.perf_counter()
+    first = None
+    count = 0
+    outcome = "error"
+    try:
+        async for item in items:
+            if first is None:
+                first = time.perf_counter()
+                TTFT_SECONDS.observe(first - started, upstream=upstream)
+            count += tokens(item)
+            yield item
+        outcome = "ok"
+    except GeneratorExit:
+        outcome = "cancelled"
+        raise
+    finally:
+        ended = time.perf_counter()
+        UPSTREAM_SECONDS.observe(ended - started, upstream=upstream, operation="stream", outcome=outcome)
+        if count:
+            TOKENS.inc(count, upstream=upstream)
+        if first is not None and count > 1 and ended > first:
+            TOKENS_PER_SECOND.observe((count - 1) / (ended - first), upstream=upstream)
+
+
+# =====================================================
+# Sampling profiler
+# =====================================================
+class SamplingProfiler:
+    # Samples one thread's Python stack every `interval` seconds from a helper
+    # thread; the result is in "folded" form (frame;frame;frame count), which
+    # flamegraph.pl and speedscope read directly.
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples = _Tally()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def folded(self):
+        return "".join(f"{stack} {n}\n" for stack, n in self.samples.most_common())
+
+
+# =====================================================
+# Flask and SQLAlchemy hooks
+# =====================================================
+_request_db = ContextVar("request_db", default=None)  # [queries, seconds] for the current request
+
+
+def _on_before_cursor(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _on_after_cursor(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    QUERY_SECONDS.observe(elapsed, statement=statement.lstrip().split(None, 1)[0].lower() if statement else "")
+    stats = _request_db.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += elapsed
+
+
+def init_app(app, engine, profile_dir=None):
+    from flask import g, request
+    from flask.signals import before_render_template, template_rendered
+    from sqlalchemy import event
+
+    profiling = os.getenv("METRICS_PROFILING", "0") == "1"
+    profile_dir = profile_dir or os.path.join(app.instance_path, "profiles")
+
+    event.listen(engine, "before_cursor_execute", _on_before_cursor)
+    event.listen(engine, "after_cursor_execute", _on_after_cursor)
+
+    def route():
+        return request.url_rule.rule if request.url_rule else "<unmatched>"
+
+    @app.before_request
+    def _start_request():
+        g.metrics_started = time.perf_counter()
+        g.metrics_route = route()
+        g.metrics_db = [0, 0.0]
+        _request_db.set(g.metrics_db)
+        IN_FLIGHT.inc(route=g.metrics_route)
+        if profiling and (request.headers.get("X-Profile") == "1" or request.args.get("profile") == "1"):
+            g.profiler = SamplingProfiler().start()
+
+    def finish_profile(response=None):
+        profiler = g.pop("profiler", None)
+        if profiler is None:
+            return
+        profiler.stop()
+        os.makedirs(profile_dir, exist_ok=True)
+        name = "%s-%s.folded" % (time.strftime("%Y%m%d-%H%M%S"), re.sub(r"\W+", "_", g.metrics_route).strip("_"))
+        with open(os.path.join(profile_dir, name), "w") as f:
+            f.write(profiler.folded())
+        if response is not None:
+            response.headers["X-Profile-File"] = name
+
+    @app.after_request
+    def _record_status(response):
+        g.metrics_status = response.status_code
+        finish_profile(response)
+        return response
+
+    @app.teardown_request
+    def _finish_request(exc):
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return
+        finish_profile()
+        elapsed = time.perf_counter() - started
+        name = g.metrics_route
+        queries, db_seconds = g.metrics_db
+        REQUEST_SECONDS.observe(elapsed, method=request.method, route=name, status=g.get("metrics_status", 500))
+        REQUEST_DB_QUERIES.observe(queries, route=name)
+        REQUEST_DB_SECONDS.observe(db_seconds, route=name)
+        IN_FLIGHT.dec(route=name)
+
+    def _template_started(sender, template, context, **extra):
+        g.setdefault("metrics_templates", []).append(time.perf_counter())
+
+    def _template_done(sender, template, context, **extra):
+        stack = g.get("metrics_templates")
+        if stack:
+            TEMPLATE_SECONDS.observe(time.perf_counter() - stack.pop(), template=template.name or "<string>")
+
+    before_render_template.connect(_template_started, app, weak=False)
+    template_rendered.connect(_template_done, app, weak=False)
@@ -0,0 +1,303 @@
+# migrations.py
+# Versioned schema migrations for notes.db plus SQLite connection tuning.
+#
+# The schema version is kept in PRAGMA user_version. Each migration runs in
+# its own BEGIN IMMEDIATE transaction together with the version bump, so a
+# crash never leaves a half-applied step, and several workers starting at
+# once apply each step exactly once. Databases created before versioning
+# (user_version 0, tables already present) are upgraded in place.
+from sqlalchemy import event
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_column(conn, table, column, ddl):
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+# =====================================================
+# Migrations (append only, never edit a released step)
+# =====================================================
+def m001_core_tables(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS user ("
+        " id INTEGER PRIMARY KEY,"
+        " username VARCHAR(80) NOT NULL UNIQUE,"
+        " password VARCHAR(255) NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS note ("
+        " id INTEGER PRIMARY KEY,"
+        " title VARCHAR(200) NOT NULL,"
+        " content TEXT NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS subject ("
+        " id INTEGER PRIMARY KEY,"
+        " name VARCHAR(100) NOT NULL,"
+        " user_id INTEGER NOT NULL REFERENCES user(id))"
+    )
+    _add_column(conn, "note", "attachment", "VARCHAR(255)")
+
+
+def m002_note_owner(conn):
+    _add_column(conn, "note", "user_id", "INTEGER REFERENCES user(id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_note_user_id_id ON note (user_id, id)")
+
+
+def m003_attachment_blobs(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS attachment_blob ("
+        " path VARCHAR(255) PRIMARY KEY,"
+        " sha256 VARCHAR(64) NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " refcount INTEGER NOT NULL DEFAULT 0)"
+    )
+
+
+def m004_attachment_text(conn):
+    _add_column(conn, "note", "attachment_text", "TEXT")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS extraction_job ("
+        " id INTEGER PRIMARY KEY,"
+        " note_id INTEGER NOT NULL,"
+        " path VARCHAR(255) NOT NULL,"
+        " status VARCHAR(16) NOT NULL DEFAULT 'pending',"  # pending/running/done/failed/skipped
+        " attempts INTEGER NOT NULL DEFAULT 0,"
+        " error TEXT,"
+        " chars INTEGER,"
+        " created_at REAL NOT NULL,"
+        " started_at REAL,"
+        " finished_at REAL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_extraction_job_status ON extraction_job (status, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_extraction_job_note ON extraction_job (note_id, id)")
+
+
+def m005_note_search(conn):
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5("
+        " title, content, attachment_text, owner,"
+        " tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+    conn.execute("DELETE FROM note_fts")
+    conn.execute(
+        "INSERT INTO note_fts (rowid, title, content, attachment_text, owner) "
+        "SELECT id, title, content, COALESCE(attachment_text, ''), "
+        "       CASE WHEN user_id IS NULL THEN '' ELSE 'u' || user_id END FROM note"
+    )
+
+
+def m006_subject_constraints(conn):
+    # Keep the oldest of any duplicate (user_id, name) pairs before enforcing uniqueness
+    conn.execute("DELETE FROM subject WHERE id NOT IN (SELECT MIN(id) FROM subject GROUP BY user_id, name)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_subject_user_name ON subject (user_id, name)")
+
+
+def m007_note_chunks(conn):
+    # Word windows of each note for the embedding index (embeddings.py). The
+    # vectors themselves are written by EmbeddingIndex.sync() on startup.
+    from embeddings import chunk_note
+
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS note_chunk ("
+        " id INTEGER PRIMARY KEY,"
+        " note_id INTEGER NOT NULL,"
+        " user_id INTEGER NOT NULL,"
+        " ord INTEGER NOT NULL,"
+        " text TEXT NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_note_chunk_note ON note_chunk (note_id, ord)")
+    conn.execute("DELETE FROM note_chunk")
+    rows = conn.execute(
+        "SELECT id, title, content, attachment_text, user_id FROM note WHERE user_id IS NOT NULL ORDER BY id"
+    )
+    conn.executemany(
+        "INSERT INTO note_chunk (note_id, user_id, ord, text) VALUES (?, ?, ?, ?)",
+        ((note_id, user_id, i, chunk)
+         for note_id, title, content, attachment_text, user_id in rows
+         for i, chunk in enumerate(chunk_note(title, content, attachment_text))),
+    )
+
+
+def m008_chat_memory(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS chat_turn ("
+        " id INTEGER PRIMARY KEY,"
+        " conversation_id VARCHAR(32) NOT NULL,"
+        " user_id INTEGER,"
+        " role VARCHAR(16) NOT NULL,"
+        " content TEXT NOT NULL,"
+        " tokens INTEGER NOT NULL,"
+        " created_at REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_chat_turn_conversation ON chat_turn (conversation_id, id)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS chat_summary ("
+        " conversation_id VARCHAR(32) PRIMARY KEY,"
+        " summary TEXT NOT NULL,"
+        " turns INTEGER NOT NULL DEFAULT 0,"  # turns folded into the summary so far
+        " updated_at REAL NOT NULL)"
+    )
+
+
+def m009_rate_buckets(conn):
+    # Token buckets for admission control (admission.SQLiteBucketStore)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS rate_bucket ("
+        " key VARCHAR(64) PRIMARY KEY,"
+        " tokens REAL NOT NULL,"
+        " updated REAL NOT NULL)"
+    )
+
+
+def m010_review_items(conn):
+    # Spaced-repetition state per user and quiz question (reviews.py)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS review_item ("
+        " id INTEGER PRIMARY KEY,"
+        " user_id INTEGER NOT NULL,"
+        " question_key VARCHAR(40) NOT NULL,"  # sha1 of the normalized question text
+        " topic VARCHAR(200) NOT NULL,"
+        " topic_key VARCHAR(200) NOT NULL,"
+        " question TEXT NOT NULL,"
+        " easiness REAL NOT NULL,"
+        " interval_days REAL NOT NULL,"
+        " repetitions INTEGER NOT NULL,"
+        " due_at REAL NOT NULL,"
+        " reviewed_at REAL,"
+        " UNIQUE (user_id, question_key))"
+    )
+    # Covers the due-today queries, including the per-topic counts for /spin
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_review_item_due ON review_item (user_id, due_at, topic_key)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS review_attempt ("
+        " id INTEGER PRIMARY KEY,"
+        " item_id INTEGER NOT NULL,"
+        " user_id INTEGER NOT NULL,"
+        " quality INTEGER NOT NULL,"
+        " answered_at REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_review_attempt_item ON review_attempt (item_id)")
+
+
+def m011_extraction_backoff(conn):
+    # A failed extraction job waits until not_before before its next attempt
+    _add_column(conn, "extraction_job", "not_before", "REAL")
+
+
+def m012_note_owner_backfill(conn):
+    # m002 gave existing notes no owner, which hides them from everyone. With a
+    # single account they can only be that account's; with several they stay
+    # unowned until "flask claim-notes" hands them out (init_db says so).
+    from embeddings import chunk_note
+
+    users = conn.execute("SELECT id FROM user LIMIT 2").fetchall()
+    if len(users) != 1:
+        return
+    (user_id,) = users[0]
+    rows = conn.execute(
+        "SELECT id, title, content, attachment_text FROM note WHERE user_id IS NULL ORDER BY id"
+    ).fetchall()
+    if not rows:
+        return
+    conn.execute("UPDATE note SET user_id = ? WHERE user_id IS NULL", (user_id,))
+    # Same index rows m005 and m007 would have written for an owned note
+    conn.executemany("UPDATE note_fts SET owner = ? WHERE rowid = ?", ((f"u{user_id}", r[0]) for r in rows))
+    conn.executemany(
+        "INSERT INTO note_chunk (note_id, user_id, ord, text) VALUES (?, ?, ?, ?)",
+        ((note_id, user_id, i, chunk)
+         for note_id, title, content, attachment_text in rows
+         for i, chunk in enumerate(chunk_note(title, content, attachment_text))),
+    )
+
+
+def m013_quiz_cache(conn):
+    # Generated quiz variants (quiz_cache.py); used to be created by QuizCache itself
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS quiz_cache ("
+        " cache_key TEXT NOT NULL,"
+        " variant INTEGER NOT NULL,"
+        " questions TEXT NOT NULL,"
+        " created_at REAL NOT NULL,"
+        " PRIMARY KEY (cache_key, variant))"
+    )
+
+
+MIGRATIONS = [
+    m001_core_tables,
+    m002_note_owner,
+    m003_attachment_blobs,
+    m004_attachment_text,
+    m005_note_search,
+    m006_subject_constraints,
+    m007_note_chunks,
+    m008_chat_memory,
+    m009_rate_buckets,
+    m010_review_items,
+    m011_extraction_backoff,
+    m012_note_owner_backfill,
+    m013_quiz_cache,
+]
+
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(engine):
+    # Returns the names of the migrations that were applied.
+    applied = []
+    raw = engine.raw_connection()
+    try:
+        conn = raw.driver_connection
+        previous_isolation = conn.isolation_level
+        conn.isolation_level = None  # we issue BEGIN/COMMIT ourselves
+        try:
+            for version, step in enumerate(MIGRATIONS, start=1):
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # Re-check under the write lock: another worker may have got here first
+                    if current_version(conn) >= version:
+                        conn.execute("COMMIT")
+                        continue
+                    step(conn)
+                    conn.execute(f"PRAGMA user_version = {version}")
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                applied.append(step.__name__)
+        finally:
+            conn.isolation_level = previous_isolation
+    finally:
+        raw.close()
+    return applied
+
+
+# =====================================================
+# Connection setup
+# =====================================================
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",      # readers no longer wait for writers
+    "PRAGMA synchronous = NORMAL",    # safe with WAL, far fewer fsyncs
+    "PRAGMA busy_timeout = 5000",     # wait for the write lock instead of failing
+    "PRAGMA cache_size = -20000",     # ~20 MB page cache per connection
+    "PRAGMA temp_store = MEMORY",
+)
+
+
+def apply_pragmas(dbapi_conn):
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def tune_sqlite(engine):
+    if engine.dialect.name != "sqlite":
+        return
+    event.listen(engine, "connect", lambda dbapi_conn, record: apply_pragmas(dbapi_conn))
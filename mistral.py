@@ -1,24 +1,70 @@
-import subprocess
-import json
+import metrics
+from llm_dispatch import time_left
+from ollama_client import AsyncOllamaClient, OllamaClient
+
+# One client per process; its connection pool keeps the Ollama connection
+# (and, via keep_alive, the model) warm between questions.
+# Configure with OLLAMA_HOST, OLLAMA_MODEL, OLLAMA_KEEP_ALIVE, OLLAMA_TIMEOUT.
+# Calls made through the LLM dispatcher time out with its deadline instead.
+_client = None
+# The asyncio client for the ASGI mode; its connections belong to the event loop that made them
+_async_client = None
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = OllamaClient()
+    return _client
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOllamaClient()
+    return _async_client
+
+def reset_client():
+    # Forget the clients without closing their sockets: after a fork they
+    # still belong to the parent process
+    global _client, _async_client
+    _client = None
+    _async_client = None
 
 def ask_mistral(question):
-    ollama_path = r"C:\Users\Nihar Gunaji Sawant\AppData\Local\Programs\Ollama\ollama.exe"
-
-    process = subprocess.run(
-        [ollama_path, "run", "mistral", question],
-        capture_output=True,
-        text=True,
-        encoding="utf-8"
-    )
-
-    output = process.stdout.strip()
-
-    # Try to parse as JSON if possible, otherwise return raw text
-    try:
-        parsed = json.loads(output)
-        return parsed.get("response") or parsed.get("completion") or output
-    except json.JSONDecodeError:
-        return output
+    with metrics.upstream_call("ollama", "generate"):
+        return get_client().generate(question, timeout=time_left()).strip()
+
+def stream_mistral(question):
+    # Yields the answer token by token as the model produces it
+    return metrics.track_stream("ollama", get_client().stream(question, timeout=time_left()))
+
+def _record_prompt(messages, final):
+    sent = sum(len(m["content"]) for m in messages) // 4
+    metrics.PROMPT_TOKENS.observe(sent, upstream="ollama", kind="sent")
+    if "prompt_eval_count" in final:
+        metrics.PROMPT_TOKENS.observe(final["prompt_eval_count"], upstream="ollama", kind="evaluated")
+
+def chat_mistral(messages):
+    # messages: chat history in Ollama's format, newest user turn last
+    with metrics.upstream_call("ollama", "chat"):
+        final = get_client().chat(messages, timeout=time_left())
+    _record_prompt(messages, final)
+    return (final.get("message") or {}).get("content", "").strip()
+
+def stream_chat_mistral(messages):
+    return metrics.track_stream(
+        "ollama", get_client().stream_chat(messages, on_done=lambda final: _record_prompt(messages, final),
+                                           timeout=time_left()))
+
+# Coroutine versions of the calls above, for the ASGI mode
+async def achat_mistral(messages):
+    with metrics.upstream_call("ollama", "chat"):
+        final = await get_async_client().chat(messages)
+    _record_prompt(messages, final)
+    return (final.get("message") or {}).get("content", "").strip()
+
+def astream_chat_mistral(messages):
+    return metrics.atrack_stream(
+        "ollama", get_async_client().stream_chat(messages, on_done=lambda final: _record_prompt(messages, final)))
 
 if __name__ == "__main__":
     print("Type 'exit' or 'quit' to stop.")
@@ -0,0 +1,324 @@
+# notes_io.py
+# Bulk export and import of a user's subjects and notes as JSON Lines:
+#
+#   {"type": "export", "version": 1, "exported_at": 1760000000.0}
+#   {"type": "subject", "name": "Biology"}
+#   {"type": "note", "id": 7, "title": "...", "content": "...",
+#    "attachment": "ab/cd/<sha256>.pdf", "attachment_text": "..."}
+#
+# With attachments the export is a tar stream instead: the attached files
+# first (attachments/<path>), then the records in notes-000001.jsonl,
+# notes-000002.jsonl, ... members of at most one batch each. Files come first
+# so an import has stored them by the time a note refers to them.
+#
+# Both directions stream. The export reads one query with a streaming cursor
+# in batches (stream_results), and the tar members are written header by header,
+# so nothing larger than a batch or a read buffer is held in memory. The
+# import inserts each batch in its own transaction with Core executemany
+# statements and indexes it for search and chat in bulk, bypassing the
+# per-note ORM events.
+import json
+import os
+import re
+import tarfile
+import time
+
+from sqlalchemy import Column, Integer, MetaData, Table, Text, insert, text
+
+import embeddings
+import extraction
+import search
+
+FORMAT_VERSION = 1
+BATCH_SIZE = int(os.getenv("NOTES_IO_BATCH", 1000))
+READ_SIZE = 64 * 1024
+MAX_LINE = 16 * 1024 * 1024
+MAX_ERRORS = 10  # reported back; the rest are only counted
+BLOCK = tarfile.BLOCKSIZE
+CONTENT_PATH = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.?\w*$")
+
+_note_table = Table("note", MetaData(), Column("id", Integer, primary_key=True), Column("title", Text),
+                    Column("content", Text), Column("attachment", Text), Column("attachment_text", Text),
+                    Column("user_id", Integer))
+
+
+# =====================================================
+# Export
+# =====================================================
+def _dump(record):
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def export_batches(conn, user_id, batch_size=BATCH_SIZE):
+    # Yields lists of encoded JSONL lines, header and subjects first
+    subjects = conn.execute(text("SELECT name FROM subject WHERE user_id = :user_id ORDER BY name"),
+                            {"user_id": user_id}).scalars()
+    yield [_dump({"type": "export", "version": FORMAT_VERSION, "exported_at": time.time()})] + \
+        [_dump({"type": "subject", "name": name}) for name in subjects]
+    result = conn.execution_options(stream_results=True).execute(
+        text("SELECT id, title, content, attachment, attachment_text FROM note WHERE user_id = :user_id ORDER BY id"),
+        {"user_id": user_id},
+    )
+    for rows in result.partitions(batch_size):
+        yield [_dump({"type": "note", "id": r.id, "title": r.title, "content": r.content,
+                      "attachment": r.attachment, "attachment_text": r.attachment_text}) for r in rows]
+
+
+def export_jsonl(engine, user_id, batch_size=BATCH_SIZE):
+    with engine.connect() as conn:
+        for lines in export_batches(conn, user_id, batch_size):
+            if lines:
+                yield b"".join(lines)
+
+
+def _tar_header(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def _tar_padding(size):
+    return b"\0" * (-size % BLOCK)
+
+
+def export_tar(engine, store, user_id, batch_size=BATCH_SIZE):
+    with engine.connect() as conn:
+        paths = conn.execution_options(stream_results=True).execute(
+            text("SELECT DISTINCT attachment FROM note WHERE user_id = :user_id AND attachment IS NOT NULL "
+                 "ORDER BY attachment"),
+            {"user_id": user_id},
+        ).scalars()
+        for path in paths:
+            full = store.full_path(path)
+            try:
+                f = open(full, "rb")
+            except OSError:
+                continue  # missing on disk; the note keeps its text
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                yield _tar_header(f"attachments/{path}", size)
+                written = 0
+                for chunk in iter(lambda: f.read(READ_SIZE), b""):
+                    chunk = chunk[:size - written]
+                    written += len(chunk)
+                    yield chunk
+                yield b"\0" * (size - written) + _tar_padding(size)  # a file that shrank meanwhile
+        for number, lines in enumerate(export_batches(conn, user_id, batch_size), start=1):
+            if lines:
+                data = b"".join(lines)
+                yield _tar_header(f"notes-{number:06d}.jsonl", len(data)) + data + _tar_padding(len(data))
+    yield b"\0" * (2 * BLOCK)  # end of archive
+
+
+# =====================================================
+# Import
+# =====================================================
+class BadImport(ValueError):
+    pass
+
+
+class NoteImporter:
+    def __init__(self, engine, store, user_id, batch_size=BATCH_SIZE):
+        self.engine = engine
+        self.store = store
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self._notes = []
+        self._subjects = []
+        self._renamed = {}  # attachment path in the archive -> stored path, when they differ
+        self._unreferenced = set()  # stored paths no imported note has taken a reference on yet
+        self.stats = {"notes": 0, "subjects": 0, "attachments": 0, "missing_attachments": 0,
+                      "unreferenced_attachments": 0, "skipped": 0, "errors": []}
+
+    def _error(self, message):
+        self.stats["skipped"] += 1
+        if len(self.stats["errors"]) < MAX_ERRORS:
+            self.stats["errors"].append(message)
+
+    # ---------- Records ----------
+    def add_line(self, line, where):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            record = json.loads(line)
+        except ValueError:
+            self._error(f"{where}: not valid JSON")
+            return
+        if not isinstance(record, dict):
+            self._error(f"{where}: not a JSON object")
+            return
+        kind = record.get("type")
+        if kind == "note":
+            self.add_note(record, where)
+        elif kind == "subject":
+            name = record.get("name")
+            if isinstance(name, str) and name.strip():
+                self._subjects.append(name.strip()[:100])
+            else:
+                self._error(f"{where}: subject without a name")
+        elif kind == "export":
+            version = record.get("version", FORMAT_VERSION)
+            if not isinstance(version, int) or version > FORMAT_VERSION:
+                raise BadImport(f"unsupported export format version {version!r}")
+        else:
+            self._error(f"{where}: unknown record type {kind!r}")
+
+    def add_note(self, record, where):
+        title, content = record.get("title"), record.get("content")
+        if not isinstance(title, str) or not title.strip() or not isinstance(content, str) or not content.strip():
+            self._error(f"{where}: note needs a title and content")
+            return
+        attachment = record.get("attachment")
+        if attachment is not None:
+            attachment = self._renamed.get(attachment, attachment) if isinstance(attachment, str) else None
+            if attachment is None or not self._stored(attachment):
+                self.stats["missing_attachments"] += 1
+                attachment = None
+        attachment_text = record.get("attachment_text")
+        self._notes.append({
+            "title": title.strip()[:200], "content": content.strip(), "attachment": attachment,
+            "attachment_text": attachment_text if isinstance(attachment_text, str) else None,
+            "user_id": self.user_id,
+        })
+        if len(self._notes) >= self.batch_size:
+            self.flush()
+
+    def _stored(self, path):
+        # Only content-addressed files are shared between notes (see attachments.py)
+        return bool(CONTENT_PATH.match(path)) and os.path.isfile(self.store.full_path(path))
+
+    # ---------- Attachments ----------
+    def add_attachment(self, name, fileobj):
+        # Stored under its content address; the name only links it to the notes
+        staged = self.store.stage(fileobj, os.path.splitext(name)[1])
+        self.store.commit(staged)
+        if staged.path != name:
+            self._renamed[name] = staged.path
+        self._unreferenced.add(staged.path)
+        self.stats["attachments"] += 1
+
+    def _remove_unreferenced(self):
+        # Files in the archive that no note refers to have no attachment_blob
+        # row, so nothing would ever remove them. As in remove_released_files,
+        # the write lock is taken before the check, so an upload of the same
+        # content either has its row already or re-creates the file after us.
+        for path in self._unreferenced:
+            with self.engine.begin() as conn:
+                conn.execute(text("DELETE FROM attachment_blob WHERE path = :path AND refcount <= 0"),
+                             {"path": path})
+                if conn.execute(text("SELECT 1 FROM attachment_blob WHERE path = :path"), {"path": path}).first():
+                    continue
+                self.store.remove(path)
+            self.stats["unreferenced_attachments"] += 1
+        self._unreferenced.clear()
+
+    # ---------- Writing ----------
+    def flush(self):
+        notes, subjects = self._notes, self._subjects
+        self._notes, self._subjects = [], []
+        if not notes and not subjects:
+            return
+        with self.engine.begin() as conn:
+            if subjects:
+                inserted = conn.execute(
+                    text("INSERT INTO subject (name, user_id) VALUES (:name, :user_id) ON CONFLICT DO NOTHING"),
+                    [{"name": name, "user_id": self.user_id} for name in subjects],
+                ).rowcount
+                self.stats["subjects"] += max(inserted, 0)
+            changes = self._insert_notes(conn, notes) if notes else []
+        embeddings.apply(changes)  # after the commit, like the ORM path
+        self.stats["notes"] += len(notes)
+
+    def _insert_notes(self, conn, notes):
+        ids = conn.execute(insert(_note_table).returning(_note_table.c.id, sort_by_parameter_order=True), notes)
+        for (note_id,), note in zip(ids, notes):
+            note["id"] = note_id
+        # One reference per note, as acquire_attachment() takes for an upload
+        refs = {}
+        for note in notes:
+            if note["attachment"]:
+                refs[note["attachment"]] = refs.get(note["attachment"], 0) + 1
+        if refs:
+            self._unreferenced.difference_update(refs)
+            conn.execute(
+                text("INSERT INTO attachment_blob (path, sha256, size, refcount) VALUES (:path, :sha256, :size, :n) "
+                     "ON CONFLICT(path) DO UPDATE SET refcount = refcount + excluded.refcount"),
+                [{"path": path, "n": n, "size": os.path.getsize(self.store.full_path(path)),
+                  "sha256": os.path.splitext(os.path.basename(path))[0]}
+                 for path, n in refs.items()],
+            )
+        for note in notes:
+            if note["attachment"] and note["attachment_text"] is None:
+                extraction.enqueue(conn, note["id"], note["attachment"])
+        search.index_rows(conn, notes)
+        return embeddings.index_rows(conn, notes)
+
+    # ---------- Streams ----------
+    def read_jsonl(self, stream, name="line"):
+        for number, line in enumerate(_lines(stream), start=1):
+            self.add_line(line, f"{name} {number}")
+
+    def read_tar(self, stream):
+        with tarfile.open(fileobj=stream, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                if member.name.startswith("attachments/"):
+                    self.add_attachment(member.name[len("attachments/"):], archive.extractfile(member))
+                elif member.name.endswith(".jsonl"):
+                    self.read_jsonl(archive.extractfile(member), member.name)
+
+    def read(self, stream):
+        # A JSONL or (optionally compressed) tar stream; returns the stats
+        head = stream.read(BLOCK)
+        stream = _Rewound(head, stream)
+        try:
+            if head[:2] in (b"\x1f\x8b", b"BZ") or head[257:262] == b"ustar":
+                self.read_tar(stream)
+            else:
+                self.read_jsonl(stream)
+            self.flush()
+        finally:
+            self._remove_unreferenced()
+        return self.stats
+
+
+class _Rewound:
+    # A stream with bytes already read put back in front
+    def __init__(self, head, stream):
+        self._head = head
+        self._stream = stream
+
+    def read(self, size=-1):
+        if not self._head:
+            return self._stream.read(size)
+        if size is None or size < 0:
+            data, self._head = self._head + self._stream.read(), b""
+            return data
+        data, self._head = self._head[:size], self._head[size:]
+        if len(data) < size:
+            data += self._stream.read(size - len(data))
+        return data
+
+
+def _lines(stream):
+    # Lines of a binary stream, read in fixed-size pieces. Only the newly read
+    # bytes are searched for a line end, so a long line costs linear time.
+    buffer = bytearray()
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            break
+        start = len(buffer)
+        buffer += chunk
+        end = buffer.rfind(b"\n", start)
+        if end >= 0:
+            yield from bytes(buffer[:end]).split(b"\n")
+            del buffer[:end + 1]
+        if len(buffer) > MAX_LINE:
+            raise BadImport("a line is longer than 16 MB")
+    if buffer:
+        yield bytes(buffer)
@@ -0,0 +1,275 @@
+# ollama_client.py
+# Small client for the Ollama HTTP API that reuses keep-alive connections
+# instead of spawning `ollama run` per message. OllamaClient blocks the
+# calling thread; AsyncOllamaClient is the same client on httpx (optional),
+# for the ASGI serving mode (see asgi.py), where a call waiting on the model
+# costs a coroutine rather than a thread.
+import http.client
+import json
+import os
+import queue
+import socket
+from urllib.parse import urlsplit
+
+try:
+    import httpx
+except ImportError:  # optional: only AsyncOllamaClient needs it
+    httpx = None
+
+DEFAULT_HOST = "http://127.0.0.1:11434"
+
+
+class OllamaError(RuntimeError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, host, port, size=4, connect_timeout=5.0, read_timeout=120.0):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self, read_timeout=None):
+        # read_timeout: for this request only, instead of the pool's
+        try:
+            conn, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+            conn.connect()
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            reused = False
+        conn.sock.settimeout(read_timeout or self.read_timeout)
+        return conn, reused
+
+    def release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _settings(host, model, keep_alive, timeout, connect_timeout, pool_size):
+    url = urlsplit(host or os.getenv("OLLAMA_HOST", DEFAULT_HOST))
+    if not url.scheme:
+        url = urlsplit("http://" + url.geturl())
+    return {
+        "model": model or os.getenv("OLLAMA_MODEL", "mistral"),
+        # Keep the model loaded between calls ("5m", "1h", -1 for forever)
+        "keep_alive": keep_alive if keep_alive is not None else os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+        "host": url.hostname or "127.0.0.1",
+        "port": url.port or 11434,
+        "size": int(pool_size or os.getenv("OLLAMA_POOL_SIZE", 4)),
+        "connect_timeout": float(connect_timeout or os.getenv("OLLAMA_CONNECT_TIMEOUT", 5)),
+        "read_timeout": float(timeout or os.getenv("OLLAMA_TIMEOUT", 120)),
+    }
+
+
+def _payload(model, keep_alive, prompt, stream, options=None, messages=None):
+    payload = {"model": model, "stream": stream, "keep_alive": keep_alive}
+    if messages is not None:
+        payload["messages"] = messages
+    else:
+        payload["prompt"] = prompt
+    if options:
+        payload["options"] = options
+    return payload
+
+
+class OllamaClient:
+    def __init__(self, host=None, model=None, keep_alive=None, timeout=None,
+                 connect_timeout=None, pool_size=None):
+        settings = _settings(host, model, keep_alive, timeout, connect_timeout, pool_size)
+        self.model = settings.pop("model")
+        self.keep_alive = settings.pop("keep_alive")
+        self.pool = ConnectionPool(**settings)
+
+    # ---------- HTTP ----------
+    def _open(self, path, payload, timeout=None):
+        body = json.dumps(payload).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        # A reused connection may have been closed by the server; retry once on a fresh one.
+        for attempt in range(2):
+            conn, reused = None, False
+            try:
+                conn, reused = self.pool.acquire(timeout)
+                conn.request("POST", path, body=body, headers=headers)
+                resp = conn.getresponse()
+            except (http.client.HTTPException, OSError) as e:
+                if conn is not None:
+                    conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise OllamaError(f"Could not reach Ollama at {self.pool.host}:{self.pool.port}: {e}") from e
+            if resp.status != 200:
+                detail = resp.read().decode("utf-8", "replace")
+                conn.close()
+                raise OllamaError(f"Ollama returned {resp.status}: {detail}")
+            return conn, resp
+
+    def _finish(self, conn, resp):
+        if resp.will_close:
+            conn.close()
+        else:
+            self.pool.release(conn)
+
+    def _payload(self, prompt, stream, options=None, messages=None):
+        return _payload(self.model, self.keep_alive, prompt, stream, options, messages)
+
+    def _request(self, path, payload, timeout=None):
+        conn, resp = self._open(path, payload, timeout)
+        try:
+            data = json.loads(resp.read())
+        except ValueError as e:
+            conn.close()
+            raise OllamaError("Invalid JSON from Ollama") from e
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()  # timed out mid-answer: the connection is unusable
+            raise OllamaError(f"Ollama stopped answering: {e}") from e
+        self._finish(conn, resp)
+        return data
+
+    def _lines(self, path, payload, timeout=None):
+        # Yields the objects of a streamed (NDJSON) response, the final "done" one included
+        conn, resp = self._open(path, payload, timeout)
+        done = False
+        try:
+            for line in resp:
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                if data.get("error"):
+                    raise OllamaError(data["error"])
+                done = bool(data.get("done"))
+                yield data
+                if done:
+                    break
+        finally:
+            if done:
+                resp.read()
+                self._finish(conn, resp)
+            else:
+                conn.close()
+
+    # ---------- Public API ----------
+    # timeout: socket timeout for this call (OLLAMA_TIMEOUT when None); for a
+    # stream it bounds every wait for the next line
+    def generate(self, prompt, options=None, timeout=None) -> str:
+        return self._request("/api/generate", self._payload(prompt, False, options), timeout).get("response", "")
+
+    def stream(self, prompt, options=None, timeout=None):
+        # Yields response tokens as Ollama produces them (NDJSON lines).
+        for data in self._lines("/api/generate", self._payload(prompt, True, options), timeout):
+            if data.get("response"):
+                yield data["response"]
+
+    def chat(self, messages, options=None, timeout=None) -> dict:
+        # messages: [{"role": "system"|"user"|"assistant", "content": ...}].
+        # Returns Ollama's final object (message.content plus token counts).
+        # Ollama reuses the evaluated prompt of the previous call when the new
+        # one starts with it, so prompt_eval_count only covers the new part.
+        return self._request("/api/chat", self._payload(None, False, options, messages=messages), timeout)
+
+    def stream_chat(self, messages, options=None, on_done=None, timeout=None):
+        # Yields reply tokens; on_done(final object) runs once the reply is complete
+        for data in self._lines("/api/chat", self._payload(None, True, options, messages=messages), timeout):
+            content = (data.get("message") or {}).get("content")
+            if content:
+                yield content
+            if data.get("done") and on_done is not None:
+                on_done(data)
+
+    def close(self):
+        self.pool.close()
+
+
+# =====================================================
+# asyncio client
+# =====================================================
+class AsyncOllamaClient:
+    # The coroutine counterpart of OllamaClient, with the same settings, on
+    # an httpx.AsyncClient (keep-alive pool, chunked bodies). Used from one
+    # event loop only.
+    def __init__(self, host=None, model=None, keep_alive=None, timeout=None,
+                 connect_timeout=None, pool_size=None):
+        if httpx is None:
+            raise OllamaError("The async Ollama client needs the 'httpx' package")
+        settings = _settings(host, model, keep_alive, timeout, connect_timeout, pool_size)
+        self.model = settings["model"]
+        self.keep_alive = settings["keep_alive"]
+        self.base_url = f"http://{settings['host']}:{settings['port']}"
+        self.http = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=httpx.Timeout(settings["read_timeout"], connect=settings["connect_timeout"]),
+            # Like ConnectionPool, only the idle connections are bounded
+            transport=httpx.AsyncHTTPTransport(
+                retries=1, limits=httpx.Limits(max_connections=None, max_keepalive_connections=settings["size"])),
+        )
+
+    # ---------- HTTP ----------
+    def _unreachable(self, e):
+        return OllamaError(f"Could not reach Ollama at {self.base_url}: {e!r}")
+
+    async def _request(self, path, payload):
+        try:
+            resp = await self.http.post(path, json=payload)
+        except httpx.HTTPError as e:
+            raise self._unreachable(e) from e
+        if resp.status_code != 200:
+            raise OllamaError(f"Ollama returned {resp.status_code}: {resp.text}")
+        try:
+            return resp.json()
+        except ValueError as e:
+            raise OllamaError("Invalid JSON from Ollama") from e
+
+    async def _lines(self, path, payload):
+        # Yields the objects of a streamed (NDJSON) response, read to the end
+        # of the body so the connection goes back to the pool
+        try:
+            async with self.http.stream("POST", path, json=payload) as resp:
+                if resp.status_code != 200:
+                    detail = (await resp.aread()).decode("utf-8", "replace")
+                    raise OllamaError(f"Ollama returned {resp.status_code}: {detail}")
+                async for line in resp.aiter_lines():
+                    if not line.strip():
+                        continue
+                    data = json.loads(line)
+                    if data.get("error"):
+                        raise OllamaError(data["error"])
+                    yield data
+        except httpx.HTTPError as e:
+            raise self._unreachable(e) from e
+
+    # ---------- Public API ----------
+    async def generate(self, prompt, options=None) -> str:
+        data = await self._request("/api/generate", _payload(self.model, self.keep_alive, prompt, False, options))
+        return data.get("response", "")
+
+    async def stream(self, prompt, options=None):
+        async for data in self._lines("/api/generate", _payload(self.model, self.keep_alive, prompt, True, options)):
+            if data.get("response"):
+                yield data["response"]
+
+    async def chat(self, messages, options=None) -> dict:
+        return await self._request(
+            "/api/chat", _payload(self.model, self.keep_alive, None, False, options, messages=messages))
+
+    async def stream_chat(self, messages, options=None, on_done=None):
+        payload = _payload(self.model, self.keep_alive, None, True, options, messages=messages)
+        async for data in self._lines("/api/chat", payload):
+            content = (data.get("message") or {}).get("content")
+            if content:
+                yield content
+            if data.get("done") and on_done is not None:
+                on_done(data)
+
+    async def close(self):
+        await self.http.aclose()
@@ -0,0 +1,178 @@
+# pregen.py
+# Keeps a few ready-made quizzes per (subject, difficulty) for users who were
+# active recently, so /quiz and /spin can hand one out without waiting on
+# Gemini. Pools live in memory in each process; a background thread refills
+# any pool below the low-water mark, within a global upstream budget.
+import os
+import threading
+import time
+from collections import deque
+
+from quiz_cache import normalize_key
+from quizgen import validate_questions
+from llm_dispatch import percentile
+from admission import Rejected
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst or max(1, rate_per_minute)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class QuizPregenerator:
+    def __init__(self, generate, pool_size=None, low_water=None, difficulties=None,
+                 budget_per_minute=None, active_window=None, interval=5.0, question_count=5):
+        # generate(topic, difficulty) -> list of validated questions
+        self.generate = generate
+        self.question_count = question_count
+        self.pool_size = int(pool_size or os.getenv("PREGEN_POOL_SIZE", 3))
+        self.low_water = int(low_water or os.getenv("PREGEN_LOW_WATER", 1))
+        self.difficulties = difficulties or os.getenv("PREGEN_DIFFICULTIES", "auto").split(",")
+        self.budget = TokenBucket(int(budget_per_minute or os.getenv("PREGEN_BUDGET_PER_MIN", 20)))
+        self.active_window = int(active_window or os.getenv("PREGEN_ACTIVE_WINDOW", 30 * 60))
+        self.interval = interval
+        self._pools = {}    # key -> deque of quizzes
+        self._active = {}   # user id -> (last seen, [subject names])
+        self._refilling = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_errors = 0
+        self.budget_skips = 0
+        self.deferred = 0  # refills turned away by admission control while users were busy
+        self._refill_times = deque(maxlen=500)
+
+    # ---------- Request side ----------
+    def mark_active(self, user_id, subjects):
+        with self._lock:
+            self._active[user_id] = (time.monotonic(), list(subjects))
+        self.start()
+        self._wake.set()
+
+    def pop(self, topic, difficulty):
+        key = normalize_key(topic, difficulty)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool:
+                self.hits += 1
+                quiz = pool.popleft()
+            else:
+                self.misses += 1
+                quiz = None
+            if quiz is not None and len(pool) < self.low_water:
+                self._wake.set()
+        return quiz
+
+    def ready(self, topic, difficulty):
+        with self._lock:
+            return bool(self._pools.get(normalize_key(topic, difficulty)))
+
+    # ---------- Background refill ----------
+    def _wanted(self):
+        cutoff = time.monotonic() - self.active_window
+        wanted = {}
+        with self._lock:
+            for user_id, (seen, subjects) in list(self._active.items()):
+                if seen < cutoff:
+                    del self._active[user_id]
+                    continue
+                for name in subjects:
+                    for difficulty in self.difficulties:
+                        wanted.setdefault(normalize_key(name, difficulty), (name, difficulty))
+            # Forget pools nobody is studying any more
+            for key in list(self._pools):
+                if key not in wanted:
+                    del self._pools[key]
+                    self._refilling.discard(key)
+        return wanted
+
+    def refill_once(self):
+        # Top up every low pool by one quiz; returns how many were generated
+        generated = 0
+        for key, (topic, difficulty) in self._wanted().items():
+            with self._lock:
+                pool = self._pools.setdefault(key, deque(maxlen=self.pool_size))
+                # Start refilling below the low-water mark, keep going until full
+                if len(pool) < self.low_water:
+                    self._refilling.add(key)
+                if key not in self._refilling:
+                    continue
+                if len(pool) >= self.pool_size:
+                    self._refilling.discard(key)
+                    continue
+            if not self.budget.take():
+                self.budget_skips += 1
+                break
+            started = time.monotonic()
+            try:
+                quiz = self.generate(topic, difficulty)
+            except Rejected:
+                self.deferred += 1
+                break
+            except Exception as e:
+                self.refill_errors += 1
+                print(f"Quiz pre-generation failed for {topic!r}: {e}")
+                continue
+            # A pooled quiz is handed out again and again; never pool a short one
+            if not validate_questions(quiz, self.question_count):
+                self.refill_errors += 1
+                print(f"Quiz pre-generation for {topic!r} returned an incomplete quiz")
+                continue
+            with self._lock:
+                self._pools.setdefault(key, deque(maxlen=self.pool_size)).append(quiz)
+                self.refills += 1
+                self._refill_times.append(time.monotonic() - started)
+            generated += 1
+        return generated
+
+    def _loop(self):
+        while True:
+            try:
+                if self.refill_once():
+                    continue
+            except Exception as e:
+                print("Quiz pre-generation error:", e)
+            self._wake.wait(timeout=self.interval)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name="quiz-pregen", daemon=True)
+                    self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            times = sorted(self._refill_times)
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "pools": {key: len(pool) for key, pool in self._pools.items()},
+                "active_users": len(self._active),
+                "refills": self.refills,
+                "refill_errors": self.refill_errors,
+                "budget_skips": self.budget_skips,
+                "deferred": self.deferred,
+                "refill_ms_avg": round(sum(times) / len(times) * 1000, 1) if times else 0.0,
+                "refill_ms_p95": round(percentile(times, 0.95) * 1000, 1),
+            }
@@ -0,0 +1,171 @@
+# quiz_cache.py
+# Two-level cache for generated quizzes: an in-process LRU (TTL + max size)
+# in front of a SQLite table that lives next to notes.db. Each key holds up to
+# a few validated variants which are handed out round-robin; a key is served
+# from its first variant on, and every later put adds one until the set is
+# full (wants_more() tells the caller to generate another). Variants expire
+# ttl seconds after they were generated, in both levels; the LRU re-reads a
+# key every `refresh` seconds to pick up other processes' puts.
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from migrations import m013_quiz_cache
+from quizgen import validate_questions
+
+DIFFICULTIES = {"auto", "easy", "medium", "hard"}
+
+
+def normalize_topic(topic: str) -> str:
+    topic = unicodedata.normalize("NFKC", topic or "").casefold()
+    topic = re.sub(r"[^\w\s]", " ", topic)
+    return " ".join(topic.split())
+
+
+def normalize_key(topic: str, difficulty: str) -> str:
+    topic = normalize_topic(topic)
+    difficulty = (difficulty or "auto").strip().lower()
+    if difficulty not in DIFFICULTIES:
+        difficulty = "auto"
+    return f"{topic}|{difficulty}"
+
+
+class QuizCache:
+    def __init__(self, db_path, ttl=24 * 3600, max_entries=512, variants=3, question_count=5, refresh=60,
+                 create_table=True):
+        # create_table: False when db_path is a database migrations.py keeps up to date
+        self.db_path = db_path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.max_entries = max_entries
+        self.variants = variants
+        self.question_count = question_count
+        self.hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()  # key -> (loaded_at, [(created_at, questions)])
+        self._cursor = {}          # key -> next variant index to hand out
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if create_table:
+            self._create_table()
+
+    # ---------- SQLite ----------
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _create_table(self):
+        # A file of its own (or api.py's): the same step migrations.py applies to notes.db
+        conn = self._conn()
+        m013_quiz_cache(conn)
+        conn.commit()
+
+    def _load(self, key):
+        cutoff = time.time() - self.ttl
+        rows = self._conn().execute(
+            "SELECT created_at, questions FROM quiz_cache WHERE cache_key = ? AND created_at >= ? ORDER BY variant",
+            (key, cutoff),
+        ).fetchall()
+        return [(created_at, json.loads(questions)) for created_at, questions in rows]
+
+    # ---------- LRU ----------
+    def _remember(self, key, variants):
+        self._lru[key] = (time.monotonic(), variants)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            old_key, _ = self._lru.popitem(last=False)
+            self._cursor.pop(old_key, None)
+
+    def _variants(self, key):
+        # An entry is good for `refresh` seconds and until its oldest variant
+        # expires; a key without variants is not remembered, so another
+        # process's first put shows up at once
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry and time.monotonic() - entry[0] < self.refresh \
+                    and min(created_at for created_at, _ in entry[1]) >= cutoff:
+                self._lru.move_to_end(key)
+                return [questions for _, questions in entry[1]]
+        variants = self._load(key)
+        with self._lock:
+            if variants:
+                self._remember(key, variants)
+            else:
+                self._lru.pop(key, None)
+        return [questions for _, questions in variants]
+
+    # ---------- Public API ----------
+    def get(self, topic, difficulty):
+        # Served from the first variant on; repeat users rotate through
+        # whatever variants the key has so far
+        key = normalize_key(topic, difficulty)
+        variants = self._variants(key)
+        with self._lock:
+            if not variants:
+                self.misses += 1
+                return None
+            idx = self._cursor.get(key, 0) % len(variants)
+            self._cursor[key] = (idx + 1) % len(variants)
+            self.hits += 1
+            return variants[idx]
+
+    def wants_more(self, topic, difficulty) -> bool:
+        # True while a key that has variants has fewer than it may hold
+        key = normalize_key(topic, difficulty)
+        with self._lock:
+            entry = self._lru.get(key)
+            return entry is not None and len(entry[1]) < self.variants
+
+    def put(self, topic, difficulty, questions) -> bool:
+        if not validate_questions(questions, self.question_count):
+            return False
+        key = normalize_key(topic, difficulty)
+        now = time.time()
+        conn = self._conn()
+        with self._lock:
+            conn.execute("DELETE FROM quiz_cache WHERE created_at < ?", (now - self.ttl,))
+            count, next_variant = conn.execute(
+                "SELECT COUNT(*), COALESCE(MAX(variant) + 1, 0) FROM quiz_cache WHERE cache_key = ?", (key,)
+            ).fetchone()
+            if count >= self.variants:
+                # Replace the oldest variant
+                conn.execute(
+                    "UPDATE quiz_cache SET questions = ?, created_at = ? WHERE cache_key = ? AND variant = "
+                    "(SELECT variant FROM quiz_cache WHERE cache_key = ? ORDER BY created_at LIMIT 1)",
+                    (json.dumps(questions), now, key, key),
+                )
+            else:
+                conn.execute(
+                    "INSERT INTO quiz_cache (cache_key, variant, questions, created_at) VALUES (?, ?, ?, ?)",
+                    (key, next_variant, json.dumps(questions), now),
+                )
+            conn.commit()
+            self._lru.pop(key, None)
+        return True
+
+    def clear(self):
+        conn = self._conn()
+        with self._lock:
+            conn.execute("DELETE FROM quiz_cache")
+            conn.commit()
+            self._lru.clear()
+            self._cursor.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "entries": len(self._lru),
+            }
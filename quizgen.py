@@ -0,0 +1,269 @@
+# quizgen.py
+# Shared quiz generation for app.py, api.py and terminalquiz.py: prompt
+# building, the Gemini call, parsing and validation. Model output goes through
+# json_stream.JSONItemStream, so each question is checked on its own and
+# stream_quiz() can hand out question 1 before question 5 has been written.
+# generate_batch() packs several topics into as few model calls as fit the
+# output budget, then retries only the topics whose questions came back invalid.
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from json_stream import JSONItemStream, compile_schema
+from llm_dispatch import time_left
+
+MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+QUESTION_FIELDS = ("question", "options", "answer", "explanation")
+# Rough output cost of one question (question, 4 options, explanation, JSON)
+TOKENS_PER_QUESTION = 150
+MAX_OUTPUT_TOKENS = int(os.getenv("QUIZ_BATCH_MAX_OUTPUT_TOKENS", 8000))
+
+
+class QuizError(Exception):
+    def __init__(self, message, raw=None):
+        super().__init__(message)
+        self.raw = raw
+
+
+# =====================================================
+# Validation
+# =====================================================
+QUESTION_SCHEMA = {
+    "type": "object",
+    "required": QUESTION_FIELDS,
+    "properties": {
+        "question": {"type": "string", "minLength": 1},
+        "options": {"type": "array", "minItems": 4, "maxItems": 4, "items": {"type": "string"}},
+        "answer": {"type": "integer", "minimum": 0, "maximum": 3},
+        "explanation": {"type": "string"},
+    },
+}
+check_question = compile_schema(QUESTION_SCHEMA)
+
+
+def validate_question(q) -> bool:
+    return check_question(q) is None
+
+
+def validate_questions(quiz, count=5) -> bool:
+    return isinstance(quiz, list) and len(quiz) == count and all(validate_question(q) for q in quiz)
+
+
+# =====================================================
+# Prompts
+# =====================================================
+QUESTION_SPEC = """Each question should include:
+      - "question": string
+      - "options": array of 4 strings
+      - "answer": index (0-3)
+      - "explanation": short string"""
+
+
+def quiz_prompt(topic, difficulty="auto", count=5):
+    return f"""
+    You are an assistant that generates educational multiple-choice quizzes.
+    Produce exactly {count} questions on "{topic}".
+    {QUESTION_SPEC}
+    Difficulty: {difficulty}
+    Output STRICT JSON: an array of {count} objects. Do NOT output anything else.
+    """
+
+
+def batch_prompt(items, count=5):
+    # items: list of (id, topic, difficulty)
+    topics = "\n".join(f'    - "{item_id}": "{topic}" (difficulty: {difficulty})' for item_id, topic, difficulty in items)
+    return f"""
+    You are an assistant that generates educational multiple-choice quizzes.
+    For EACH topic below, produce exactly {count} questions:
+{topics}
+    {QUESTION_SPEC}
+    Output STRICT JSON: one object whose keys are the topic ids above and whose
+    values are arrays of {count} question objects. Do NOT output anything else.
+    """
+
+
+# =====================================================
+# Model call and parsing
+# =====================================================
+_configured = False
+
+
+def _genai():
+    # The SDK is slow to import, and routes that never call Gemini should work
+    # without a key, so it is imported and configured on first use.
+    global _configured
+    import google.generativeai as genai
+
+    if not _configured:
+        key = os.getenv("GEMINI_API_KEY")
+        if not key:
+            raise QuizError("GEMINI_API_KEY is not set")
+        genai.configure(api_key=key)
+        _configured = True
+    return genai
+
+
+def call_model(prompt) -> str:
+    genai = _genai()
+    model = genai.GenerativeModel(MODEL_NAME)
+    # Within a dispatcher call the request gives up at its deadline
+    timeout = time_left()
+    with metrics.upstream_call("gemini", "generate"):
+        resp = model.generate_content(prompt, request_options={"timeout": timeout} if timeout else None)
+        return resp.text if hasattr(resp, "text") else str(resp)
+
+
+def _stream_text(prompt):
+    genai = _genai()
+    model = genai.GenerativeModel(MODEL_NAME)
+    for chunk in model.generate_content(prompt, stream=True):
+        try:
+            text = chunk.text
+        except ValueError:  # chunk without text parts (e.g. a safety stop)
+            continue
+        if text:
+            yield text
+
+
+def stream_model(prompt):
+    # Yields the response text chunk by chunk as Gemini produces it. Chunks
+    # hold many tokens; ~4 characters per token is close enough for metrics.
+    return metrics.track_stream("gemini", _stream_text(prompt), tokens=lambda text: max(1, len(text) // 4))
+
+
+def _check_count(parser, valid, count):
+    if not valid:
+        raise QuizError(parser.summary(), parser.text)
+    if valid < count:
+        reasons = f" ({parser.summary()})" if parser.rejected else ""
+        raise QuizError(f"Only {valid} of {count} questions were valid{reasons}", parser.text)
+
+
+def parse_quiz(text, count=5):
+    # Invalid questions are dropped one by one; fails unless count are left,
+    # so a short quiz is never served or cached
+    parser = JSONItemStream(check_question)
+    quiz = parser.feed(text)[:count]
+    parser.close()
+    _check_count(parser, len(quiz), count)
+    return quiz
+
+
+def generate_quiz(topic, difficulty="auto", count=5, call=call_model):
+    return parse_quiz(call(quiz_prompt(topic, difficulty, count)), count)
+
+
+def stream_quiz(topic, difficulty="auto", count=5, stream=stream_model):
+    # Yields each question as soon as it is complete and valid; like
+    # parse_quiz, raises QuizError at the end if fewer than count were
+    parser = JSONItemStream(check_question)
+    sent = 0
+    for chunk in stream(quiz_prompt(topic, difficulty, count)):
+        for q in parser.feed(chunk):
+            if sent < count:
+                sent += 1
+                yield q
+    parser.close()
+    _check_count(parser, sent, count)
+
+
+# =====================================================
+# Async variants (ASGI mode)
+# =====================================================
+# The same calls through the SDK's asyncio API; call= and stream= take
+# coroutine functions and async iterators (see LLMRouter.acomplete_text).
+async def acall_model(prompt) -> str:
+    genai = _genai()
+    model = genai.GenerativeModel(MODEL_NAME)
+    with metrics.upstream_call("gemini", "generate"):
+        resp = await model.generate_content_async(prompt)
+        return resp.text if hasattr(resp, "text") else str(resp)
+
+
+async def _astream_text(prompt):
+    genai = _genai()
+    model = genai.GenerativeModel(MODEL_NAME)
+    async for chunk in await model.generate_content_async(prompt, stream=True):
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            yield text
+
+
+def astream_model(prompt):
+    return metrics.atrack_stream("gemini", _astream_text(prompt), tokens=lambda text: max(1, len(text) // 4))
+
+
+async def agenerate_quiz(topic, difficulty="auto", count=5, call=acall_model):
+    return parse_quiz(await call(quiz_prompt(topic, difficulty, count)), count)
+
+
+async def astream_quiz(topic, difficulty="auto", count=5, stream=astream_model):
+    parser = JSONItemStream(check_question)
+    sent = 0
+    async for chunk in stream(quiz_prompt(topic, difficulty, count)):
+        for q in parser.feed(chunk):
+            if sent < count:
+                sent += 1
+                yield q
+    parser.close()
+    _check_count(parser, sent, count)
+
+
+# =====================================================
+# Batches
+# =====================================================
+def pack(items, count=5, max_output_tokens=MAX_OUTPUT_TOKENS):
+    # Split items into groups whose expected output fits one call
+    per_call = max(1, max_output_tokens // (count * TOKENS_PER_QUESTION))
+    return [items[i:i + per_call] for i in range(0, len(items), per_call)]
+
+
+def _run_pack(items, count, call):
+    # Returns ({id: quiz}, {id: error}) for one model call
+    ids = {f"t{i + 1}": item for i, item in enumerate(items)}
+    try:
+        text = call(batch_prompt([(i, t, d) for i, (t, d) in ids.items()], count))
+    except Exception as e:
+        return {}, {i: str(e) for i in ids}
+    parser = JSONItemStream(check_question, grouped=True)
+    groups = {}
+    for item_id, q in parser.feed(text):
+        groups.setdefault(item_id, []).append(q)
+    parser.close()
+    good, bad = {}, {}
+    for i in ids:
+        quiz = groups.get(i, [])[:count]
+        # A short topic is retried rather than cached with missing questions
+        if len(quiz) == count:
+            good[i] = quiz
+        else:
+            bad[i] = f"{len(quiz)} of {count} questions valid"
+    return good, bad
+
+
+def generate_batch(items, count=5, call=call_model, retries=1, max_output_tokens=MAX_OUTPUT_TOKENS):
+    # items: list of (topic, difficulty). Returns (results, errors), both keyed
+    # by the (topic, difficulty) tuple.
+    items = list(dict.fromkeys(items))
+    results, errors = {}, {}
+    pending = items
+    for _ in range(retries + 1):
+        if not pending:
+            break
+        packs = pack(pending, count, max_output_tokens)
+        with ThreadPoolExecutor(max_workers=min(len(packs), 8)) as pool:
+            outcomes = list(pool.map(lambda p: (p, _run_pack(p, count, call)), packs))
+        pending = []
+        for group, (good, bad) in outcomes:
+            for i, item in enumerate(group):
+                item_id = f"t{i + 1}"
+                if item_id in good:
+                    results[item] = good[item_id]
+                    errors.pop(item, None)
+                else:
+                    errors[item] = bad[item_id]
+                    pending.append(item)
+    return results, errors
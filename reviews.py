@@ -0,0 +1,251 @@
+# reviews.py
+# Spaced repetition for quiz questions (SM-2).
+#
+# Every answered question becomes a review_item for that user, keyed by the
+# normalized question text, and every answer is appended to review_attempt.
+# Answering updates the item's schedule at once:
+#
+#   correct -> quality 4, wrong -> quality 1 (callers may pass 0-5 directly)
+#   quality >= 3: interval 1 day, then 6 days, then interval * easiness
+#   quality <  3: start over at 1 day
+#   easiness moves with the quality, never below 1.3
+#
+# The schedule of an item is a pure function of its attempts, so recompute()
+# can rebuild every item from the attempt log: after a change to the rules
+# above, or nightly to repair anything that went wrong along the way. It
+# replays the log with NumPy, one array step per attempt number, so the cost
+# is a handful of array operations per step rather than a loop over rows.
+#
+# "Due" means due_at before the end of the current day (server time); the
+# (user_id, due_at, topic_key) index answers the per-user due queries.
+import hashlib
+import itertools
+import json
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from quiz_cache import normalize_topic
+
+try:
+    import numpy as np
+except ImportError:  # optional: only recompute() needs it
+    np = None
+
+DAY = 24 * 3600
+DEFAULT_EASINESS = 2.5
+MIN_EASINESS = 1.3
+MAX_INTERVAL_DAYS = 365
+PASS_QUALITY = 3
+QUALITY_CORRECT = 4
+QUALITY_WRONG = 1
+
+
+# =====================================================
+# Scheduling rule
+# =====================================================
+def _select(condition, if_true, if_false):
+    return if_true if condition else if_false
+
+
+def schedule(easiness, interval, repetitions, quality, where=_select):
+    # One SM-2 step. Works on plain numbers, or on arrays with where=np.where.
+    passed = quality >= PASS_QUALITY
+    grown = where(repetitions == 0, 1.0, where(repetitions == 1, 6.0, interval * easiness))
+    interval = where(passed, grown, 1.0)
+    interval = where(interval > MAX_INTERVAL_DAYS, MAX_INTERVAL_DAYS, interval)
+    repetitions = where(passed, repetitions + 1, 0)
+    miss = 5 - quality
+    easiness = easiness + 0.1 - miss * (0.08 + miss * 0.02)
+    easiness = where(easiness < MIN_EASINESS, MIN_EASINESS, easiness)
+    return easiness, interval, repetitions
+
+
+def question_key(question):
+    body = normalize_topic(question.get("question") if isinstance(question, dict) else question)
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+
+def end_of_day(now=None):
+    today = datetime.fromtimestamp(now if now is not None else time.time()).date()
+    return datetime.combine(today + timedelta(days=1), datetime.min.time()).timestamp()
+
+
+# =====================================================
+# Answers and due items
+# =====================================================
+def record_answer(conn, user_id, topic, question, choice=None, quality=None, now=None):
+    # Stores one answer and reschedules the question; returns the new schedule.
+    # question is the quiz question dict ({"question", "options", "answer", ...}).
+    now = now if now is not None else time.time()
+    if quality is None:
+        quality = QUALITY_CORRECT if choice == question.get("answer") else QUALITY_WRONG
+    key = question_key(question)
+    # Insert first: two first answers to the same question cannot both create
+    # the item, and the write lock is held before the schedule is read
+    conn.execute(
+        text("INSERT INTO review_item (user_id, question_key, topic, topic_key, question, easiness, "
+             "interval_days, repetitions, due_at) "
+             "VALUES (:user_id, :key, :topic, :topic_key, :question, :easiness, 0, 0, :now) "
+             "ON CONFLICT (user_id, question_key) DO NOTHING"),
+        {"user_id": user_id, "key": key, "topic": topic, "topic_key": normalize_topic(topic),
+         "question": json.dumps(question), "easiness": DEFAULT_EASINESS, "now": now},
+    )
+    item_id, easiness, interval, repetitions = conn.execute(
+        text("SELECT id, easiness, interval_days, repetitions FROM review_item "
+             "WHERE user_id = :user_id AND question_key = :key"),
+        {"user_id": user_id, "key": key},
+    ).one()
+    easiness, interval, repetitions = schedule(easiness, interval, repetitions, quality)
+    due_at = now + interval * DAY
+    conn.execute(
+        text("UPDATE review_item SET easiness = :easiness, interval_days = :interval, "
+             "repetitions = :repetitions, due_at = :due_at, reviewed_at = :now WHERE id = :id"),
+        {"easiness": easiness, "interval": interval, "repetitions": repetitions,
+         "due_at": due_at, "now": now, "id": item_id},
+    )
+    conn.execute(
+        text("INSERT INTO review_attempt (item_id, user_id, quality, answered_at) "
+             "VALUES (:item_id, :user_id, :quality, :now)"),
+        {"item_id": item_id, "user_id": user_id, "quality": quality, "now": now},
+    )
+    return {"item_id": item_id, "quality": quality, "interval_days": round(interval, 2),
+            "repetitions": repetitions, "due_at": due_at}
+
+
+def due_counts(conn, user_id, now=None):
+    # {normalized topic: questions due by the end of today}
+    rows = conn.execute(
+        text("SELECT topic_key, COUNT(*) FROM review_item WHERE user_id = :user_id AND due_at < :cutoff "
+             "GROUP BY topic_key"),
+        {"user_id": user_id, "cutoff": end_of_day(now)},
+    )
+    return dict(rows.all())
+
+
+def due_items(conn, user_id, topic=None, limit=20, now=None):
+    # The most overdue questions first
+    params = {"user_id": user_id, "cutoff": end_of_day(now), "limit": limit}
+    where = "user_id = :user_id AND due_at < :cutoff"
+    if topic:
+        where += " AND topic_key = :topic_key"
+        params["topic_key"] = normalize_topic(topic)
+    rows = conn.execute(
+        text(f"SELECT id, topic, question, due_at, interval_days, repetitions FROM review_item "
+             f"WHERE {where} ORDER BY due_at LIMIT :limit"),
+        params,
+    )
+    return [
+        {"item_id": r.id, "topic": r.topic, "question": json.loads(r.question), "due_at": r.due_at,
+         "interval_days": round(r.interval_days, 2), "repetitions": r.repetitions}
+        for r in rows
+    ]
+
+
+# =====================================================
+# Batch recompute
+# =====================================================
+def recompute(engine):
+    # Rebuild every item's schedule from review_attempt in one write
+    # transaction; returns the number of items whose schedule changed.
+    if np is None:
+        raise RuntimeError("NumPy is required to recompute review schedules")
+    raw = engine.raw_connection()
+    try:
+        conn = raw.driver_connection
+        previous_isolation = conn.isolation_level
+        conn.isolation_level = None  # we issue BEGIN/COMMIT ourselves
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                updated = _recompute(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.isolation_level = previous_isolation
+    finally:
+        raw.close()
+    return updated
+
+
+def _replay(item_ids, qualities, answered_at):
+    # Attempts in the order they were made -> final state per item
+    order = np.argsort(item_ids, kind="stable")
+    item_ids, qualities, answered_at = item_ids[order], qualities[order], answered_at[order]
+    items, first, counts = np.unique(item_ids, return_index=True, return_counts=True)
+    slot = np.repeat(np.arange(len(items)), counts)   # attempt -> item position
+    rank = np.arange(len(item_ids)) - first[slot]     # attempt -> its number for that item
+    by_rank = np.argsort(rank, kind="stable")
+    bounds = np.searchsorted(rank[by_rank], np.arange(counts.max() + 1))
+
+    easiness = np.full(len(items), DEFAULT_EASINESS)
+    interval = np.zeros(len(items))
+    repetitions = np.zeros(len(items), dtype=np.int64)
+    reviewed_at = np.zeros(len(items))
+    # Step k applies every item's k-th attempt; an item appears at most once per step
+    for k in range(len(bounds) - 1):
+        attempts = by_rank[bounds[k]:bounds[k + 1]]
+        at = slot[attempts]
+        easiness[at], interval[at], repetitions[at] = schedule(
+            easiness[at], interval[at], repetitions[at], qualities[attempts], where=np.where)
+        reviewed_at[at] = answered_at[attempts]
+    return items, easiness, interval, repetitions, reviewed_at + interval * DAY, reviewed_at
+
+
+def _recompute(conn):
+    (count,) = conn.execute("SELECT COUNT(*) FROM review_attempt").fetchone()
+    if not count:
+        return 0
+    cursor = conn.execute("SELECT item_id, quality, answered_at FROM review_attempt ORDER BY id")
+    data = np.fromiter(itertools.chain.from_iterable(cursor), dtype=np.float64, count=count * 3).reshape(count, 3)
+    state = _replay(data[:, 0].astype(np.int64), data[:, 1], data[:, 2])
+    changed = _changed(conn, state)
+    state = [column[changed] for column in state]
+    if not len(state[0]):
+        return 0
+    conn.execute(
+        "CREATE TEMP TABLE review_recompute (id INTEGER PRIMARY KEY, easiness REAL, interval_days REAL, "
+        "repetitions INTEGER, due_at REAL, reviewed_at REAL)"
+    )
+    try:
+        conn.executemany("INSERT INTO review_recompute VALUES (?, ?, ?, ?, ?, ?)",
+                         zip(*(column.tolist() for column in state)))
+        # Rewriting most rows is about twice as fast with the due index built afterwards
+        rebuild_index = len(state[0]) > _count_items(conn) // 4
+        if rebuild_index:
+            conn.execute("DROP INDEX ix_review_item_due")
+        conn.execute(
+            "UPDATE review_item SET easiness = r.easiness, interval_days = r.interval_days, "
+            "repetitions = r.repetitions, due_at = r.due_at, reviewed_at = r.reviewed_at "
+            "FROM review_recompute AS r WHERE review_item.id = r.id"
+        )
+        if rebuild_index:
+            conn.execute("CREATE INDEX ix_review_item_due ON review_item (user_id, due_at, topic_key)")
+    finally:
+        conn.execute("DROP TABLE temp.review_recompute")
+    return len(state[0])
+
+
+def _count_items(conn):
+    return conn.execute("SELECT COUNT(*) FROM review_item").fetchone()[0]
+
+
+def _changed(conn, state):
+    # Mask of the replayed items whose stored schedule differs. Answers keep
+    # items up to date, so usually only a few rows need writing, and writes
+    # (row plus due index) are what a full recompute would spend most time on.
+    items, easiness, interval, repetitions, due_at, _ = state
+    count = _count_items(conn)
+    cursor = conn.execute("SELECT id, easiness, interval_days, repetitions, due_at FROM review_item ORDER BY id")
+    stored = np.fromiter(itertools.chain.from_iterable(cursor), dtype=np.float64, count=count * 5).reshape(count, 5)
+    at = np.searchsorted(stored[:, 0], items)
+    found = at < count
+    found[found] = stored[at[found], 0] == items[found]
+    row = stored[np.where(found, at, 0)]
+    same = (found & np.isclose(row[:, 1], easiness, rtol=0, atol=1e-9)
+            & np.isclose(row[:, 2], interval, rtol=0, atol=1e-9)
+            & (row[:, 3] == repetitions) & np.isclose(row[:, 4], due_at, rtol=0, atol=1e-3))
+    return ~same
@@ -0,0 +1,129 @@
+# search.py
+# Full-text search over notes with an SQLite FTS5 table. Rows are kept in
+# sync from SQLAlchemy mapper events, so the index changes in the same
+# transaction as the note itself.
+import html
+import re
+
+from sqlalchemy import event, text
+
+# The table itself is created by migrations.py (m005_note_search).
+# prefix='2 3' adds prefix indexes so "photo*" style queries stay index lookups.
+# The owner column holds a single "u<user_id>" token; matching on it lets FTS
+# intersect posting lists instead of filtering every hit afterwards.
+FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5("
+    " title, content, attachment_text, owner,"
+    " tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+# Column weights for bm25(): title matches count most, attachment text least
+RANK = "bm25(note_fts, 10.0, 1.0, 0.5, 0.0)"
+_HL_OPEN, _HL_CLOSE = "\x02", "\x03"
+_TERM = re.compile(r"\w+\*?", re.UNICODE)
+
+
+def owner_token(user_id):
+    return f"u{user_id}" if user_id is not None else ""
+
+
+def _row(note):
+    return {
+        "id": note.id,
+        "title": note.title or "",
+        "content": note.content or "",
+        "attachment_text": getattr(note, "attachment_text", None) or "",
+        "owner": owner_token(note.user_id),
+    }
+
+
+def index_note(conn, note):
+    row = _row(note)
+    conn.execute(text("DELETE FROM note_fts WHERE rowid = :id"), row)
+    conn.execute(
+        text("INSERT INTO note_fts (rowid, title, content, attachment_text, owner) "
+             "VALUES (:id, :title, :content, :attachment_text, :owner)"),
+        row,
+    )
+
+
+def set_attachment_text(conn, note_id, attachment_text):
+    conn.execute(
+        text("UPDATE note_fts SET attachment_text = :text WHERE rowid = :id"),
+        {"text": attachment_text or "", "id": note_id},
+    )
+
+
+def remove_note(conn, note_id):
+    conn.execute(text("DELETE FROM note_fts WHERE rowid = :id"), {"id": note_id})
+
+
+def watch(model):
+    # Keep note_fts in step with every insert/update/delete of the model
+    event.listen(model, "after_insert", lambda mapper, conn, note: index_note(conn, note))
+    event.listen(model, "after_update", lambda mapper, conn, note: index_note(conn, note))
+    event.listen(model, "after_delete", lambda mapper, conn, note: remove_note(conn, note.id))
+
+
+def index_rows(conn, rows):
+    # Bulk variant of index_note() for new notes (bulk import, rebuild);
+    # rows: mappings with id, title, content, attachment_text, user_id
+    if rows:
+        conn.execute(
+            text("INSERT INTO note_fts (rowid, title, content, attachment_text, owner) "
+                 "VALUES (:id, :title, :content, :attachment_text, :owner)"),
+            [dict(r, attachment_text=r["attachment_text"] or "", owner=owner_token(r["user_id"])) for r in rows],
+        )
+
+
+def rebuild(conn, batch_size=5000):
+    conn.execute(text("DELETE FROM note_fts"))
+    last_id, total = 0, 0
+    while True:
+        rows = conn.execute(
+            text("SELECT id, title, content, attachment_text, user_id FROM note WHERE id > :last ORDER BY id LIMIT :n"),
+            {"last": last_id, "n": batch_size},
+        ).mappings().all()
+        if not rows:
+            break
+        index_rows(conn, rows)
+        last_id = rows[-1]["id"]
+        total += len(rows)
+    conn.execute(text("INSERT INTO note_fts (note_fts) VALUES ('optimize')"))
+    return total
+
+
+def to_match(query):
+    # Turn free text into a safe FTS5 expression: every term is quoted (so
+    # operators and punctuation in user input can't break the query) and a
+    # trailing * makes it a prefix query.
+    terms = []
+    for term in _TERM.findall(query or ""):
+        word = term.rstrip("*").replace('"', "")
+        if word:
+            terms.append(f'"{word}"*' if term.endswith("*") else f'"{word}"')
+    return " ".join(terms)
+
+
+def _highlight(snippet):
+    escaped = html.escape(snippet or "")
+    return escaped.replace(_HL_OPEN, "<mark>").replace(_HL_CLOSE, "</mark>")
+
+
+def search(conn, user_id, query, limit=20):
+    terms = to_match(query)
+    if not terms:
+        return []
+    match = f'{{title content attachment_text}}: ({terms}) AND owner: "{owner_token(user_id)}"'
+    rows = conn.execute(
+        text(
+            f"SELECT rowid AS id, title, {RANK} AS rank,"
+            f" snippet(note_fts, -1, '{_HL_OPEN}', '{_HL_CLOSE}', '…', 16) AS snippet"
+            " FROM note_fts WHERE note_fts MATCH :match"
+            " ORDER BY rank LIMIT :limit"
+        ),
+        {"match": match, "limit": limit},
+    ).mappings().all()
+    return [
+        {"id": r["id"], "title": r["title"], "snippet": _highlight(r["snippet"]), "rank": round(r["rank"], 4)}
+        for r in rows
+    ]
@@ -106,20 +106,86 @@ function sendMessage() {
     chatWindow.appendChild(thinkingMsg);
     chatWindow.scrollTop = chatWindow.scrollHeight;
 
-    fetch("/chat_ai", {   // <-- change /chat to /chat_ai
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ message })
-})
-.then(res => res.json())
-.then(data => {
-    thinkingMsg.innerHTML = `<p>${data.reply}</p>`;
-    chatWindow.scrollTop = chatWindow.scrollHeight;
-})
-.catch(err => {
-    thinkingMsg.innerHTML = `<p>Error: Could not connect to server.</p>`;
-    console.error(err);
-});
+    streamReply(message, thinkingMsg).catch(err => {
+        thinkingMsg.innerHTML = `<p>Error: Could not connect to server.</p>`;
+        console.error(err);
+    });
+}
+
+// Fallback for browsers without streaming fetch bodies
+function fetchReply(message, thinkingMsg) {
+    return fetch("/chat_ai", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ message })
+    })
+    .then(res => res.json())
+    .then(data => {
+        thinkingMsg.innerHTML = `<p>${data.reply || `Error: ${data.error}`}</p>`;
+        chatWindow.scrollTop = chatWindow.scrollHeight;
+    });
+}
+
+// Render tokens from /chat_ai/stream (Server-Sent Events) as they arrive
+async function streamReply(message, thinkingMsg) {
+    if (!window.ReadableStream || !window.TextDecoder) {
+        return fetchReply(message, thinkingMsg);
+    }
+    const res = await fetch("/chat_ai/stream", {
+        method: "POST",
+        headers: { "Content-Type": "application/json", "Accept": "text/event-stream" },
+        body: JSON.stringify({ message })
+    });
+    if (res.status === 401 || res.status === 429) {
+        // Not logged in, or too many requests: retrying without streaming would not help
+        const data = await res.json().catch(() => ({}));
+        thinkingMsg.innerHTML = "";
+        const p = document.createElement("p");
+        p.textContent = `Error: ${data.error || "Please try again later."}`;
+        thinkingMsg.appendChild(p);
+        return;
+    }
+    if (!res.ok || !res.body) {
+        return fetchReply(message, thinkingMsg);
+    }
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    const p = document.createElement("p");
+    let buffer = "";
+    let started = false;
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line
+        let sep;
+        while ((sep = buffer.indexOf("\n\n")) !== -1) {
+            const raw = buffer.slice(0, sep);
+            buffer = buffer.slice(sep + 2);
+            let event = "message";
+            let data = "";
+            raw.split("\n").forEach(line => {
+                if (line.startsWith("event:")) event = line.slice(6).trim();
+                else if (line.startsWith("data:")) data += line.slice(5).trim();
+            });
+            const payload = data ? JSON.parse(data) : {};
+
+            if (event === "error") {
+                p.textContent = `Error: ${payload.error}`;
+            } else if (payload.token) {
+                p.textContent += payload.token;
+            }
+            if (!started) {
+                thinkingMsg.innerHTML = "";
+                thinkingMsg.appendChild(p);
+                started = true;
+            }
+            chatWindow.scrollTop = chatWindow.scrollHeight;
+        }
+    }
 }
 
 sendBtn.addEventListener("click", sendMessage);
@@ -266,6 +332,11 @@ window.addEventListener("DOMContentLoaded", () => {
   let idx = 0;
   let score = 0;
   let chosen = null;
+  let answered = false;
+  let streaming = false;  // more questions may still arrive
+  let run = 0;            // ignores questions from a quiz that was abandoned
+  let quizTopic = "";
+  const EXPECTED = 5;
 
   /* ===== Loader Control ===== */
   function showLoader(show) {
@@ -282,10 +353,11 @@ window.addEventListener("DOMContentLoaded", () => {
     showLoader(false);
   }
 
-  /* ===== Fetch Quiz from Server ===== */
-  async function fetchQuiz(topic, difficulty) {
-    showLoader(true); // show loader while fetching
-    try {
+  /* ===== Stream Quiz from Server ===== */
+  // Questions arrive one by one from /quiz/stream (Server-Sent Events)
+  async function streamQuiz(topic, difficulty, onQuestion) {
+    if (!window.ReadableStream || !window.TextDecoder) {
+      // Older browsers: fetch the whole quiz in one go
       const res = await fetch("/quiz", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
@@ -293,26 +365,65 @@ window.addEventListener("DOMContentLoaded", () => {
       });
       const data = await res.json();
       if (!data.ok) throw new Error(data.error || "Quiz generation failed");
-      return data.questions;
-    } catch (err) {
-      showError(err.message || "Could not generate quiz.");
-      throw err;
-    } finally {
-      showLoader(false); // hide loader after fetch
+      data.questions.forEach(onQuestion);
+      return data.questions.length;
     }
+    const res = await fetch("/quiz/stream", {
+      method: "POST",
+      headers: { "Content-Type": "application/json", "Accept": "text/event-stream" },
+      body: JSON.stringify({ topic, difficulty })
+    });
+    if (!res.ok || !res.body) {
+      const data = await res.json().catch(() => ({}));
+      throw new Error(data.error || "Quiz generation failed");
+    }
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let sep;
+      while ((sep = buffer.indexOf("\n\n")) !== -1) {
+        const raw = buffer.slice(0, sep);
+        buffer = buffer.slice(sep + 2);
+        let event = "message";
+        let data = "";
+        raw.split("\n").forEach(line => {
+          if (line.startsWith("event:")) event = line.slice(6).trim();
+          else if (line.startsWith("data:")) data += line.slice(5).trim();
+        });
+        const payload = data ? JSON.parse(data) : {};
+
+        if (event === "error") throw new Error(payload.error || "Quiz generation failed");
+        if (event === "done") return payload.count;
+        if (payload.question) onQuestion(payload.question);
+      }
+    }
+    throw new Error("Quiz stream ended early");
   }
 
   /* ===== Render Quiz Question ===== */
+  function updateProgress() {
+    const total = streaming ? Math.max(EXPECTED, questions.length) : questions.length;
+    quizProgress.textContent = `Q ${idx + 1}/${total}`;
+    // Next waits for the following question if it is still being generated
+    nextBtn.disabled = !answered || (streaming && idx + 1 >= questions.length);
+  }
+
   function renderQuestion(i) {
     chosen = null;
+    answered = false;
     const q = questions[i];
-    quizProgress.textContent = `Q ${i + 1}/${questions.length}`;
+    updateProgress();
     quizScore.textContent = `Score: ${score}`;
     quizQuestion.textContent = q.question;
     quizOptions.innerHTML = "";
     feedback.hidden = true;
     submitBtn.disabled = false;
-    nextBtn.disabled = true;
 
     q.options.forEach((opt, j) => {
       const id = `opt-${i}-${j}`;
@@ -360,11 +471,23 @@ window.addEventListener("DOMContentLoaded", () => {
     const q = questions[idx];
     const isCorrect = (chosen === q.answer);
     if (isCorrect) score++;
+    recordAnswer(q, chosen);
     showFeedback(isCorrect, q.explanation);
     quizScore.textContent = `Score: ${score}`;
-    nextBtn.disabled = false;
+    answered = true;
+    updateProgress();
   });
 
+  /* ===== Review Scheduling ===== */
+  // Best effort: the server schedules the question for spaced review
+  function recordAnswer(q, choice) {
+    fetch("/quiz/answer", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ topic: quizTopic, question: q, choice })
+    }).catch(err => console.error(err));
+  }
+
   /* ===== Next Question ===== */
   nextBtn.addEventListener("click", () => {
     idx++;
@@ -393,6 +516,8 @@ window.addEventListener("DOMContentLoaded", () => {
 
   /* ===== Retry Quiz ===== */
   retryBtn.addEventListener("click", () => {
+    run++;
+    streaming = false;
     questions = [];
     idx = 0;
     score = 0;
@@ -407,22 +532,39 @@ window.addEventListener("DOMContentLoaded", () => {
     const difficulty = diffSelect.value || "auto";
     if (!topic) return alert("Please enter a topic");
 
+    const thisRun = ++run;
+    quizTopic = topic;
+    questions = [];
+    idx = 0;
+    score = 0;
+    chosen = null;
+    answered = false;
+    streaming = true;
+    showLoader(true); // show loader until the first question arrives
+
     try {
-      showLoader(true); // show loader
-      questions = await fetchQuiz(topic, difficulty);
-      if (!Array.isArray(questions) || questions.length !== 5) throw new Error("Bad quiz data");
-
-      idx = 0;
-      score = 0;
-      chosen = null;
-      renderQuestion(0);
-      card.hidden = false;
-      feedback.hidden = true;
-      showLoader(false); // hide loader after quiz is ready
+      await streamQuiz(topic, difficulty, (q) => {
+        if (thisRun !== run) return;
+        questions.push(q);
+        if (questions.length === 1) {
+          showLoader(false);
+          renderQuestion(0);
+          card.hidden = false;
+          feedback.hidden = true;
+        } else {
+          updateProgress();
+        }
+      });
     } catch (err) {
-      showLoader(false);
-      showError(err.message || "Could not generate quiz.");
+      // Keep whatever questions already arrived; fail only if there are none
+      if (thisRun === run && !questions.length) showError(err.message || "Could not generate quiz.");
       console.error(err);
+    } finally {
+      if (thisRun === run) {
+        streaming = false;
+        if (questions.length) updateProgress();
+        else if (errorBox.hidden) showError("Could not generate quiz.");
+      }
     }
   });
 
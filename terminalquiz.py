@@ -1,43 +1,46 @@
 # terminal_quiz.py
+# Usage: python terminalquiz.py [username]
+# With a username, answers are recorded for spaced review in the app's
+# database (DATABASE_URL, default instance/notes.db), like quizzes taken in
+# the browser.
 import os
-import json
-import google.generativeai as genai
+import sys
 from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+import quizgen
+from quizgen import QuizError
+import migrations
+import reviews
 
-# Load API key from .env
+# Load API key from .env (quizgen configures Gemini on first use)
 load_dotenv()
-GEMINI_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_KEY:
-    raise RuntimeError("GEMINI_API_KEY not found in .env")
-
-genai.configure(api_key=GEMINI_KEY)
 
 def generate_quiz(topic, difficulty="auto"):
-    prompt = f"""
-    You are a helpful assistant that generates educational multiple-choice quizzes.
-    Produce exactly 3 MCQ questions about the topic: "{topic}".
-    For each question return: question (string), options (array of 4 strings), answer (index 0-3), explanation (short string).
-    Difficulty preference: {difficulty}.
-    Output must be STRICT JSON: an array of 3 objects.
-    Do NOT output any extra commentary or text.
-    """
-    model = genai.GenerativeModel("gemini-1.5-flash")
-    resp = model.generate_content(prompt)
-    text = resp.text if hasattr(resp, "text") else str(resp)
-    
-    # parse JSON safely
     try:
-        quiz = json.loads(text)
-    except Exception:
-        import re
-        m = re.search(r"(\[.*\])", text, flags=re.S)
-        if m:
-            quiz = json.loads(m.group(1))
-        else:
-            raise ValueError("Could not parse Gemini response as JSON:\n" + text)
-    return quiz
+        return quizgen.generate_quiz(topic, difficulty, count=3)
+    except QuizError as e:
+        raise ValueError(f"{e} in Gemini response:\n{e.raw}")
+
+def open_reviews(username):
+    # Returns (engine, user id), or None if there is no such user
+    url = os.getenv("DATABASE_URL") or "sqlite:///" + os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  "instance", "notes.db")
+    engine = create_engine(url)
+    migrations.tune_sqlite(engine)
+    migrations.migrate(engine)
+    with engine.connect() as conn:
+        user_id = conn.execute(text("SELECT id FROM user WHERE username = :name"), {"name": username}).scalar()
+    if user_id is None:
+        engine.dispose()
+        return None
+    return engine, user_id
 
-def run_terminal_quiz():
+def run_terminal_quiz(username=None):
+    recorder = None
+    if username:
+        recorder = open_reviews(username)
+        if recorder is None:
+            print(f"No user named {username!r}; answers will not be saved.")
     topic = input("Enter a topic for your quiz: ").strip()
     if not topic:
         print("Topic cannot be empty.")
@@ -49,12 +52,18 @@ def run_terminal_quiz():
         for idx, opt in enumerate(q['options']):
             print(f"{idx+1}. {opt}")
         ans = input("Your answer (1-4): ").strip()
-        if ans.isdigit() and int(ans)-1 == q['answer']:
+        choice = int(ans) - 1 if ans.isdigit() else None
+        if choice == q['answer']:
             print("Correct ✅")
             score += 1
         else:
             print(f"Incorrect ❌ | Correct: {q['options'][q['answer']]} | {q['explanation']}")
+        if recorder is not None:
+            engine, user_id = recorder
+            with engine.begin() as conn:
+                scheduled = reviews.record_answer(conn, user_id, topic, q, choice=choice)
+            print(f"Next review in {scheduled['interval_days']:g} day(s).")
     print(f"\nQuiz finished! Your score: {score}/{len(questions)}")
 
 if __name__ == "__main__":
-    run_terminal_quiz()
+    run_terminal_quiz(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,186 @@
+# thumbnails.py
+# Resized previews of image attachments at a few fixed sizes.
+#
+# Thumbnails are rendered by a process pool (Pillow decoding and resampling is
+# CPU-bound and would hold up request threads) and kept in a disk cache:
+#
+#   instance/thumbnails/ab/<sha1 of attachment path>-md.webp
+#
+# The cache is bounded by total size; least recently used files go first.
+# Each process tracks recency in memory and starts from file mtimes, so after
+# a restart the oldest renders are evicted first. Attachment paths never change
+# content (see attachments.py), so a thumbnail never needs invalidating, only
+# deleting when its attachment goes.
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional: originals are served instead
+    Image = None
+
+SIZES = {"sm": 160, "md": 480, "lg": 1024}  # longest edge in pixels
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp"}
+FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+MAX_AGE = 365 * 24 * 3600
+
+
+def render(source, target, max_edge, fmt):
+    # Runs in a worker process; returns the size of the written file
+    with Image.open(source) as im:
+        # JPEG can decode straight at a reduced scale, far cheaper than a full decode
+        im.draft("RGB", (max_edge, max_edge))
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((max_edge, max_edge), Image.LANCZOS, reducing_gap=2.0)
+        if fmt == "jpeg" and im.mode not in ("RGB", "L"):
+            im = im.convert("RGBA")
+            background = Image.new("RGB", im.size, (255, 255, 255))
+            background.paste(im, mask=im.getchannel("A"))
+            im = background
+        elif im.mode not in ("RGB", "RGBA", "L"):
+            im = im.convert("RGBA")
+        tmp = f"{target}.{os.getpid()}.tmp"
+        if fmt == "webp":
+            im.save(tmp, "WEBP", quality=80, method=4)
+        else:
+            im.save(tmp, "JPEG", quality=80, optimize=True, progressive=True)
+    os.replace(tmp, target)
+    return os.path.getsize(target)
+
+
+class ThumbnailService:
+    def __init__(self, upload_root, cache_dir, max_bytes=None, workers=None):
+        self.upload_root = upload_root
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes or int(os.getenv("THUMBNAIL_CACHE_MB", 512)) * 1024 * 1024)
+        self.workers = int(workers or os.getenv("THUMBNAIL_WORKERS", 2))
+        self._pool = None
+        self._lock = threading.RLock()  # a future that is already done runs its callback inline
+        self._files = None      # cache path -> size, least recently used first
+        self._bytes = 0
+        self._inflight = {}     # cache path -> Future
+        self.hits = 0
+        self.renders = 0
+        self.failures = 0
+        self.evictions = 0
+
+    def _executor(self):
+        if self._pool is None:
+            # spawn: never fork a process that is running Flask threads
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                max_tasks_per_child=200,
+            )
+        return self._pool
+
+    def _index(self):
+        # Called with the lock held
+        if self._files is None:
+            found = []
+            for root, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    if not name.endswith(".tmp"):
+                        st = os.stat(os.path.join(root, name))
+                        found.append((st.st_mtime, os.path.join(root, name), st.st_size))
+            found.sort()
+            self._files = OrderedDict((path, size) for _, path, size in found)
+            self._bytes = sum(self._files.values())
+        return self._files
+
+    def cache_path(self, path, size, fmt):
+        digest = hashlib.sha1(path.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}-{size}.{fmt}")
+
+    def source_path(self, path):
+        # None unless path names an image inside the upload folder
+        if os.path.splitext(path)[1].lower() not in IMAGE_EXTENSIONS:
+            return None
+        full = os.path.realpath(os.path.join(self.upload_root, *path.split("/")))
+        root = os.path.realpath(self.upload_root)
+        if not full.startswith(root + os.sep) or not os.path.isfile(full):
+            return None
+        return full
+
+    def get(self, path, size, fmt, timeout=30):
+        # Returns the cached thumbnail's file path, rendering it if needed.
+        # Raises KeyError for unknown sizes/formats, FileNotFoundError for
+        # anything that is not an image attachment.
+        max_edge = SIZES[size]
+        if fmt not in FORMATS:
+            raise KeyError(fmt)
+        target = self.cache_path(path, size, fmt)
+        with self._lock:
+            files = self._index()
+            if target in files and os.path.exists(target):
+                files.move_to_end(target)
+                self.hits += 1
+                return target
+            future = self._inflight.get(target)
+            if future is None:
+                source = self.source_path(path)
+                if source is None:
+                    raise FileNotFoundError(path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # Concurrent requests for the same thumbnail share one render
+                future = self._executor().submit(render, source, target, max_edge, fmt)
+                self._inflight[target] = future
+                future.add_done_callback(lambda f, target=target: self._rendered(target, f))
+        future.result(timeout=timeout)
+        return target
+
+    def _rendered(self, target, future):
+        with self._lock:
+            self._inflight.pop(target, None)
+            if future.exception() is not None:
+                self.failures += 1
+                return
+            files = self._index()
+            self._bytes += future.result() - files.pop(target, 0)
+            files[target] = future.result()
+            self.renders += 1
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held; trims to 90% so eviction does not run on every render
+        if self._bytes <= self.max_bytes:
+            return
+        while len(self._files) > 1 and self._bytes > self.max_bytes * 0.9:  # never the newest
+            path, size = self._files.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def discard(self, path):
+        # Drop every cached size of an attachment that is being deleted
+        with self._lock:
+            files = self._index()
+            for size in SIZES:
+                for fmt in FORMATS:
+                    target = self.cache_path(path, size, fmt)
+                    self._bytes -= files.pop(target, 0)
+                    try:
+                        os.remove(target)
+                    except FileNotFoundError:
+                        pass
+
+    def stats(self):
+        with self._lock:
+            files = self._index()
+            return {
+                "files": len(files),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "renders": self.renders,
+                "failures": self.failures,
+                "evictions": self.evictions,
+                "rendering": len(self._inflight),
+            }